@@ -1,6 +1,10 @@
-from flask import Flask, request, jsonify # type: ignore
-from utils.database import init_db, add_apartment_to_db, remove_apartment_from_db, list_apartments_from_db
-from utils.rabbitmq import publish_message
+from flask import Flask, Response, request, jsonify, stream_with_context # type: ignore
+from utils.database import init_db, add_apartment_to_db, remove_apartment_from_db, iter_apartments_from_db, iter_apartments_snapshot, outbox_covers, iter_outbox_events
+from utils.streaming import NDJSON_MIMETYPE, ndjson_lines, json_document
+from utils.rabbitmq import start_outbox_relay, get_publisher_stats
+from utils.bulk import IMPORT_FORMATS, read_records, import_apartments
+from utils.db import get_pool_stats
+from utils.version import data_etag, is_not_modified, get_version_stats
 import sqlite3
 import uuid
 
@@ -23,29 +27,58 @@ def add_apartment():
         apartment_id = str(uuid.uuid4())
         add_apartment_to_db(apartment_id, name, address, noise_level, floor)
 
-        publish_message("apartment_added", {
-            "apartment_id": apartment_id,
-            "name": name,
-            "address": address,
-            "noise_level": noise_level,
-            "floor": floor
-        })
-
         return jsonify({'message': 'Apartment added successfully'}), 201
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
 
+@app.route('/import', methods=['POST'])
+def bulk_import():
+    format = request.args.get('format') or IMPORT_FORMATS.get(request.mimetype)
+
+    if format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Send text/csv or application/x-ndjson, or pass format=csv|ndjson'}), 415
+
+    try:
+        records = read_records(request.stream, format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    report = import_apartments(records)
+
+    if report['imported']:
+        status = 201
+    elif report['failed']:
+        status = 400
+    else:
+        status = 200
+
+    return jsonify(report), status
+
+
 @app.route('/list', methods=['GET'])
 def list_apartments():
-    try:
-        apartments = list_apartments_from_db()
+    after = request.args.get('after')
+    limit = request.args.get('limit', type=int)
+    # id=<id>, repeatable, lists only those apartments.
+    apartment_ids = request.args.getlist('id') or None
 
-        return jsonify({'apartments': apartments}), 200
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    ndjson = request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == NDJSON_MIMETYPE
+    # Taken before the query: a change made while it runs gives the next request a new tag.
+    etag = data_etag(sorted(request.args.items(multi=True)), ndjson)
+    if is_not_modified(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers={'ETag': etag})
+
+    apartments = iter_apartments_from_db(after, limit, apartment_ids)
+
+    if ndjson:
+        return Response(stream_with_context(ndjson_lines(apartments)), mimetype=NDJSON_MIMETYPE, headers={'ETag': etag})
+
+    return Response(stream_with_context(json_document('apartments', apartments, limit)), mimetype='application/json', headers={'ETag': etag})
 
 
 @app.route('/remove', methods=['GET'])
@@ -61,16 +94,39 @@ def remove_apartment():
         if apartment is None:
             return jsonify({'error': 'Apartment not found'}), 404
 
-        publish_message("apartment_removed", {
-            "apartment_id": apartment_id
-        })
-
         return jsonify({'message': 'Apartment removed successfully'}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/snapshot', methods=['GET'])
+def snapshot():
+    # The first line carries the outbox sequence number the snapshot was taken at.
+    return Response(stream_with_context(ndjson_lines(iter_apartments_snapshot())), mimetype=NDJSON_MIMETYPE)
+
+
+@app.route('/events', methods=['GET'])
+def events():
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', type=int)
+
+    if after is None or after < 0:
+        return jsonify({'error': 'after must be a non-negative sequence number'}), 400
+
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
+
+    if not outbox_covers(after):
+        return jsonify({'error': 'Events after this sequence number are no longer available; load /snapshot instead'}), 410
+
+    return Response(stream_with_context(ndjson_lines(iter_outbox_events(after, limit))), mimetype=NDJSON_MIMETYPE)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({'publisher': get_publisher_stats(), 'db': get_pool_stats(), 'version': get_version_stats()}), 200
+
 
 @app.route('/')
 def hello(): 
@@ -79,5 +135,7 @@ def hello():
 
 init_db()
 
+start_outbox_relay()
+
 if __name__ == "__main__":
     app.run()
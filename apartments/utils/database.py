@@ -1,67 +1,219 @@
+import json
 import os
-import sqlite3
+import threading
+import time
+import uuid
+from utils.db import connection, transaction, read_transaction
+from utils.migrations import run_migrations, MIGRATIONS
+from utils.version import bump_version
 
 
 DATABASE = './data/apartments.db'
+SERVICE_NAME = 'apartments'
+# Published events are kept this long so replicas can catch up through /events.
+OUTBOX_RETENTION = float(os.getenv('OUTBOX_RETENTION', '86400'))
+# apartments_added carries rows as lists in this column order.
+APARTMENT_EVENT_FIELDS = ["apartment_id", "name", "address", "noise_level", "floor"]
+
+outbox_ready = threading.Event()
 
 
 def init_db():
-    if not os.path.exists(DATABASE):
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS apartments (
-                id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                address TEXT NOT NULL,
-                noise_level INTEGER NOT NULL,
-                floor INTEGER NOT NULL
-            )
-        ''')
-        conn.commit()
-        conn.close()
+    with connection(DATABASE) as conn:
+        run_migrations(conn, MIGRATIONS)
 
 
-def add_apartment_to_db(apartment_id, name, address, noise_level, floor):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+def write_outbox(cursor, event_type, data):
     cursor.execute('''
-        INSERT INTO apartments (id, name, address, noise_level, floor)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (apartment_id, name, address, noise_level, floor))
-    conn.commit()
-    conn.close()
+        INSERT INTO outbox (event_id, event_type, payload, created_at)
+        VALUES (?, ?, ?, ?)
+    ''', (str(uuid.uuid4()), event_type, json.dumps(data), time.time()))
+
+
+def outbox_event(seq, event_id, event_type, payload):
+    return {
+        "event": event_type,
+        "data": json.loads(payload),
+        "seq": seq,
+        "event_id": event_id,
+        "source": SERVICE_NAME
+    }
+
+
+def _last_outbox_seq(conn):
+    # AUTOINCREMENT keeps the highest seq ever handed out, even after the rows are pruned.
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'outbox'").fetchone()
+    return row[0] if row else 0
+
+
+def fetch_outbox_batch(after_seq, limit):
+    with connection(DATABASE) as conn:
+        cursor = conn.execute('''
+            SELECT seq, event_id, event_type, payload FROM outbox
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+        ''', (after_seq, limit))
+        return cursor.fetchall()
+
+
+def get_published_seq():
+    with connection(DATABASE) as conn:
+        return conn.execute("SELECT value FROM outbox_state WHERE name = 'published_seq'").fetchone()[0]
+
+
+def mark_outbox_published(seq):
+    with transaction(DATABASE) as conn:
+        conn.execute("UPDATE outbox_state SET value = MAX(value, ?) WHERE name = 'published_seq'", (seq,))
+        conn.execute('DELETE FROM outbox WHERE seq <= ? AND created_at < ?', (seq, time.time() - OUTBOX_RETENTION))
+
+
+def count_outbox():
+    with connection(DATABASE) as conn:
+        return conn.execute('''
+            SELECT COUNT(*) FROM outbox
+            WHERE seq > (SELECT value FROM outbox_state WHERE name = 'published_seq')
+        ''').fetchone()[0]
+
+
+def outbox_covers(after_seq):
+    """Whether every event after after_seq is still in the outbox."""
+    with read_transaction(DATABASE) as conn:
+        first_seq = conn.execute('SELECT MIN(seq) FROM outbox').fetchone()[0]
+        last_seq = _last_outbox_seq(conn)
+
+    if first_seq is None:
+        return after_seq == last_seq
+    return first_seq - 1 <= after_seq <= last_seq
+
+
+def iter_outbox_events(after_seq, limit=None, batch_size=500):
+    with connection(DATABASE) as conn:
+        cursor = conn.execute('''
+            SELECT seq, event_id, event_type, payload FROM outbox
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+        ''', (after_seq, -1 if limit is None else limit))
+
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield outbox_event(*row)
+        finally:
+            cursor.close()
+
+
+def add_apartment_to_db(apartment_id, name, address, noise_level, floor):
+    with transaction(DATABASE) as conn:
+        conn.execute('''
+            INSERT INTO apartments (id, name, address, noise_level, floor)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (apartment_id, name, address, noise_level, floor))
+        write_outbox(conn, "apartment_added", {
+            "apartment_id": apartment_id,
+            "name": name,
+            "address": address,
+            "noise_level": noise_level,
+            "floor": floor
+        })
+
+    bump_version()
+    outbox_ready.set()
+
+
+def add_apartments_to_db(apartments):
+    """Insert (id, name, address, noise_level, floor) rows with one apartments_added event."""
+    with transaction(DATABASE) as conn:
+        conn.executemany('''
+            INSERT INTO apartments (id, name, address, noise_level, floor)
+            VALUES (?, ?, ?, ?, ?)
+        ''', apartments)
+        write_outbox(conn, "apartments_added", {
+            "fields": APARTMENT_EVENT_FIELDS,
+            "apartments": [list(apartment) for apartment in apartments]
+        })
+
+    bump_version()
+    outbox_ready.set()
 
 
 def remove_apartment_from_db(apartment_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM apartments WHERE id = ?', (apartment_id,))
-    apartment = cursor.fetchone()
-
-    if apartment is None:
-        conn.close()
-        return None
-
-    cursor.execute('DELETE FROM apartments WHERE id = ?', (apartment_id,))
-    conn.commit()
-    conn.close()
+    with transaction(DATABASE) as conn:
+        apartment = conn.execute('SELECT * FROM apartments WHERE id = ?', (apartment_id,)).fetchone()
+
+        if apartment is None:
+            return None
+
+        conn.execute('DELETE FROM apartments WHERE id = ?', (apartment_id,))
+        write_outbox(conn, "apartment_removed", {
+            "apartment_id": apartment_id
+        })
+
+    bump_version()
+    outbox_ready.set()
     return apartment
 
 
-def list_apartments_from_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM apartments')
-    apartments = cursor.fetchall()
-    conn.close()
-    return [
-        {
-            'id': row[0],
-            'name': row[1],
-            'address': row[2],
-            'noise_level': row[3],
-            'floor': row[4]
-        }
-        for row in apartments
-    ]
+def _apartment(row):
+    return {
+        'id': row[0],
+        'name': row[1],
+        'address': row[2],
+        'noise_level': row[3],
+        'floor': row[4]
+    }
+
+
+def iter_apartments_from_db(after=None, limit=None, apartment_ids=None, batch_size=500):
+    """Yield apartments in id order, reading the cursor in batches rather than all at once.
+
+    apartment_ids limits them to those ids.
+    """
+    if apartment_ids is None:
+        id_filter = ''
+        id_params = ()
+    else:
+        id_filter = 'AND id IN (SELECT value FROM json_each(?))'
+        id_params = (json.dumps(list(apartment_ids)),)
+
+    with connection(DATABASE) as conn:
+        cursor = conn.execute(f'''
+            SELECT id, name, address, noise_level, floor FROM apartments
+            WHERE id > ? {id_filter}
+            ORDER BY id
+            LIMIT ?
+        ''', (after or '',) + id_params + (-1 if limit is None else limit,))
+
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield _apartment(row)
+        finally:
+            cursor.close()
+
+
+def iter_apartments_snapshot(batch_size=500):
+    """Yield a header with the outbox position, then every apartment, all read from one snapshot."""
+    with read_transaction(DATABASE) as conn:
+        yield {'source': SERVICE_NAME, 'seq': _last_outbox_seq(conn)}
+
+        cursor = conn.execute('SELECT id, name, address, noise_level, floor FROM apartments ORDER BY id')
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield _apartment(row)
+        finally:
+            cursor.close()
@@ -0,0 +1,122 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Pooled SQLite connections shared by request threads and background workers.
+# Connections run in autocommit mode (isolation_level=None), so a plain read is
+# its own short transaction and writes go through transaction(), which takes
+# the write lock up front with BEGIN IMMEDIATE. With WAL journaling readers
+# never wait for a writer.
+
+POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+STATEMENT_CACHE_SIZE = int(os.getenv('SQLITE_STATEMENT_CACHE_SIZE', '256'))
+
+_pools = {}
+_pools_lock = threading.Lock()
+_stats = {
+    'opened': 0,
+    'closed': 0,
+}
+
+
+def _open(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+    with _pools_lock:
+        _stats['opened'] += 1
+    return conn
+
+
+def _close(conn):
+    conn.close()
+    with _pools_lock:
+        _stats['closed'] += 1
+
+
+def _get_pool(path):
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return pool
+
+
+@contextmanager
+def connection(path):
+    pool = _get_pool(path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open(path)
+
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            _close(conn)
+
+
+@contextmanager
+def transaction(path):
+    with connection(path) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+@contextmanager
+def read_transaction(path):
+    """A consistent snapshot across several statements."""
+    with connection(path) as conn:
+        conn.execute('BEGIN')
+        try:
+            yield conn
+        finally:
+            conn.execute('ROLLBACK')
+
+
+def close_all():
+    with _pools_lock:
+        pools = list(_pools.values())
+
+    for pool in pools:
+        while True:
+            try:
+                _close(pool.get_nowait())
+            except queue.Empty:
+                break
+
+
+def get_pool_stats():
+    with _pools_lock:
+        stats = dict(_stats)
+        stats['idle'] = sum(pool.qsize() for pool in _pools.values())
+    stats['pool_size'] = POOL_SIZE
+    return stats
+
+
+atexit.register(close_all)
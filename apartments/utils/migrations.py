@@ -0,0 +1,76 @@
+# Schema changes are applied in order and recorded in PRAGMA user_version.
+# Each migration runs in its own BEGIN IMMEDIATE transaction against the
+# live database file, so an existing volume is upgraded in place on start-up
+# and a failed step leaves the previous version intact.
+
+def run_migrations(conn, migrations):
+    conn.isolation_level = None
+
+    for version, migration in enumerate(migrations, start=1):
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have applied it while we waited for the lock.
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                conn.execute('ROLLBACK')
+                continue
+
+            print(f"Applying migration {version}: {migration.__name__}", flush=True)
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+
+def create_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS apartments (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            address TEXT NOT NULL,
+            noise_level INTEGER NOT NULL,
+            floor INTEGER NOT NULL
+        )
+    ''')
+
+
+def create_outbox(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+
+def create_outbox_state(conn):
+    # Published outbox rows are kept for a while so replicas can catch up from them.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    # Rows left in the outbox by the earlier relay have not been published yet.
+    conn.execute('''
+        INSERT OR IGNORE INTO outbox_state (name, value)
+        SELECT 'published_seq', COALESCE(
+            MIN(seq) - 1,
+            (SELECT seq FROM sqlite_sequence WHERE name = 'outbox'),
+            0
+        ) FROM outbox
+    ''')
+
+
+MIGRATIONS = [
+    create_base_tables,
+    create_outbox,
+    create_outbox_state,
+]
@@ -1,32 +1,193 @@
 import pika # type: ignore
 import json
+import os
+import queue
+import threading
 import time
+from utils.database import outbox_ready, outbox_event, fetch_outbox_batch, get_published_seq, mark_outbox_published, count_outbox
 
-RABBITMQ_HOST = 'rabbitmq'
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
 APARTMENT_EXCHANGE = 'apartment_events'
 
-def publish_message(event_type, data):
-    max_retries = 5
-    for attempt in range(max_retries):
+PUBLISH_QUEUE_SIZE = int(os.getenv('PUBLISH_QUEUE_SIZE', '10000'))
+PUBLISH_BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE', '100'))
+PUBLISH_BATCH_WAIT = float(os.getenv('PUBLISH_BATCH_WAIT', '0.005'))
+RECONNECT_BACKOFF_MIN = 0.5
+RECONNECT_BACKOFF_MAX = 30.0
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1.0'))
+
+_publish_queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+_publisher_thread = None
+_relay_thread = None
+_publisher_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    'published': 0,
+    'failed_batches': 0,
+    'reconnects': 0,
+    'connected': False,
+    'batches': 0,
+    'last_confirm_latency_ms': None,
+    'max_confirm_latency_ms': None,
+    'total_confirm_latency_ms': 0.0,
+    'outbox_relayed_seq': 0,
+    'outbox_confirmed_seq': 0,
+}
+
+
+def _start_publisher():
+    global _publisher_thread
+
+    with _publisher_lock:
+        if _publisher_thread is None or not _publisher_thread.is_alive():
+            _publisher_thread = threading.Thread(target=_publisher_loop, name='rabbitmq-publisher', daemon=True)
+            _publisher_thread.start()
+
+
+def _connect():
+    rabbit_credentials = pika.PlainCredentials(username="guest", password="guest")
+    rabbit_conn_params = pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=rabbit_credentials)
+
+    connection = pika.BlockingConnection(rabbit_conn_params)
+    channel = connection.channel()
+    channel.exchange_declare(exchange=APARTMENT_EXCHANGE, exchange_type='fanout')
+    # A transaction per batch: the broker answers once for the whole of it,
+    # where confirms on a blocking channel wait on every message.
+    channel.tx_select()
+    return connection, channel
+
+
+def _next_batch():
+    batch = [_publish_queue.get()]
+    deadline = time.monotonic() + PUBLISH_BATCH_WAIT
+
+    while len(batch) < PUBLISH_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
         try:
-            print(f"Attempting to connect to RabbitMQ at {RABBITMQ_HOST}:5672... (attempt {attempt + 1})", flush=True)
-
-            rabbit_credentials = pika.PlainCredentials(username="guest", password="guest")
-            rabbit_conn_params = pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=rabbit_credentials)
-
-            connection = pika.BlockingConnection(rabbit_conn_params)
-            channel = connection.channel()
-            channel.exchange_declare(exchange=APARTMENT_EXCHANGE, exchange_type='fanout')
-
-            message = json.dumps({"event": event_type, "data": data})
-            channel.basic_publish(exchange=APARTMENT_EXCHANGE, routing_key='', body=message)
-            print(f"Message published: {message}", flush=True)
-            connection.close()
-            return
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"RabbitMQ connection error: {e}. Retrying in 3 seconds...", flush=True)
-            time.sleep(3)
-        except Exception as e:
-            print(f"An unexpected error occurred while publishing the message: {e}", flush=True)
+            if remaining > 0:
+                batch.append(_publish_queue.get(timeout=remaining))
+            else:
+                batch.append(_publish_queue.get_nowait())
+        except queue.Empty:
             break
-    print("Failed to connect to RabbitMQ after multiple attempts. Message not published.", flush=True)
\ No newline at end of file
+
+    return batch
+
+
+def _record_batch(size, latency_ms):
+    with _stats_lock:
+        _stats['published'] += size
+        _stats['batches'] += 1
+        _stats['last_confirm_latency_ms'] = latency_ms
+        _stats['total_confirm_latency_ms'] += latency_ms
+        if _stats['max_confirm_latency_ms'] is None or latency_ms > _stats['max_confirm_latency_ms']:
+            _stats['max_confirm_latency_ms'] = latency_ms
+
+
+def _confirm_outbox(seq):
+    with _stats_lock:
+        _stats['outbox_confirmed_seq'] = seq
+
+    try:
+        mark_outbox_published(seq)
+    except Exception as e:
+        # The rows are re-sent after a restart; consumers skip sequence numbers they have applied.
+        print(f"Failed to mark the outbox published up to {seq}: {e}", flush=True)
+
+
+def _publisher_loop():
+    connection = None
+    channel = None
+    backoff = RECONNECT_BACKOFF_MIN
+    batch = None
+
+    while True:
+        if batch is None:
+            batch = _next_batch()
+
+        try:
+            if connection is None or connection.is_closed:
+                print(f"Connecting publisher to RabbitMQ at {RABBITMQ_HOST}:5672...", flush=True)
+                connection, channel = _connect()
+                backoff = RECONNECT_BACKOFF_MIN
+                with _stats_lock:
+                    _stats['connected'] = True
+
+            started = time.monotonic()
+            for message, _ in batch:
+                channel.basic_publish(exchange=APARTMENT_EXCHANGE, routing_key='', body=message)
+            # Returns once the broker has taken every message of the batch.
+            channel.tx_commit()
+            _record_batch(len(batch), (time.monotonic() - started) * 1000)
+
+            confirmed_seq = max((seq for _, seq in batch if seq is not None), default=None)
+            batch = None
+            if confirmed_seq is not None:
+                _confirm_outbox(confirmed_seq)
+
+        except Exception as e:
+            # Whatever went wrong, the batch is kept and sent again: its rows are
+            # only marked published once the broker has committed them.
+            print(f"RabbitMQ publish error: {e}. Reconnecting in {backoff:.1f} seconds...", flush=True)
+            with _stats_lock:
+                _stats['failed_batches'] += 1
+                _stats['reconnects'] += 1
+                _stats['connected'] = False
+            try:
+                if connection is not None and connection.is_open:
+                    connection.close()
+            except Exception:
+                pass
+            connection = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+
+def _outbox_relay_loop():
+    relayed_seq = None
+
+    while True:
+        try:
+            if relayed_seq is None:
+                relayed_seq = get_published_seq()
+            rows = fetch_outbox_batch(relayed_seq, PUBLISH_BATCH_SIZE)
+        except Exception as e:
+            print(f"Failed to read the outbox: {e}. Retrying in {OUTBOX_POLL_INTERVAL} seconds...", flush=True)
+            time.sleep(OUTBOX_POLL_INTERVAL)
+            continue
+
+        if not rows:
+            outbox_ready.wait(OUTBOX_POLL_INTERVAL)
+            outbox_ready.clear()
+            continue
+
+        for seq, event_id, event_type, payload in rows:
+            message = json.dumps(outbox_event(seq, event_id, event_type, payload))
+            # Blocks while the publish queue is full, so the outbox absorbs broker outages.
+            _publish_queue.put((message, seq))
+            relayed_seq = seq
+
+        with _stats_lock:
+            _stats['outbox_relayed_seq'] = relayed_seq
+
+
+def start_outbox_relay():
+    global _relay_thread
+
+    _start_publisher()
+    with _publisher_lock:
+        if _relay_thread is None or not _relay_thread.is_alive():
+            _relay_thread = threading.Thread(target=_outbox_relay_loop, name='outbox-relay', daemon=True)
+            _relay_thread.start()
+
+
+def get_publisher_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+
+    total_latency_ms = stats.pop('total_confirm_latency_ms')
+    stats['avg_confirm_latency_ms'] = total_latency_ms / stats['batches'] if stats['batches'] else None
+    stats['queue_depth'] = _publish_queue.qsize()
+    stats['queue_capacity'] = PUBLISH_QUEUE_SIZE
+    stats['outbox_backlog'] = count_outbox()
+    return stats
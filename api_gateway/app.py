@@ -1,46 +1,314 @@
-from flask import Flask, request, jsonify # type: ignore
+from flask import Flask, Response, request, jsonify, stream_with_context # type: ignore
+import functools
+import json
+import math
 import requests # type: ignore
+import threading
+import time
+import urllib3 # type: ignore
+from requests.adapters import HTTPAdapter # type: ignore
+from utils.upstreams import UPSTREAMS, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT, STREAM_CHUNK_SIZE, filter_request_headers, filter_response_headers
+from utils.cache import CACHE_MAX_ENTRY_BYTES, cache_kind, cache_key, search_window, get_generation, get_cached_response, store_response, revalidation_etag, after_revalidation, get_cache_stats
+from utils.rabbitmq import listen_for_messages
+from utils.singleflight import is_coalesced, flight_key, run_once, get_single_flight_stats
+from utils.composite import call_result, run_composite, get_composite_stats
+from utils.overload import request_priority, acquire, observe, release, get_overload_stats
+from utils.ratelimit import RATE_LIMIT_KEY_HEADER, client_key, take, get_rate_limit_stats
+from utils.encoding import finish_response, stream_encoding, encode_stream, get_encoding_stats
 
 app = Flask(__name__)
 
-APARTMENT_SERVICE_URL = "http://apartments:5000"
-BOOKING_SERVICE_URL = "http://booking:5000"
-SEARCH_SERVICE_URL = "http://search:5000"
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# One keep-alive pool per upstream, shared by all request threads.
+sessions = {name: create_session() for name in UPSTREAMS}
+
+
+@app.before_request
+def rate_limit():
+    prefix = request.path.lstrip('/').partition('/')[0]
+    client = client_key(request.headers.get(RATE_LIMIT_KEY_HEADER), request.headers.get('X-Forwarded-For'), request.remote_addr)
+    retry_after = take(client, prefix)
+
+    if retry_after:
+        response = jsonify({'error': 'Too many requests'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response
 
 
 @app.route('/apartments/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def apartments_proxy(path):
-    url = f"{APARTMENT_SERVICE_URL}/{path}"
-    return forward_request(url)
+    return forward_request('apartments', path)
 
 
 @app.route('/bookings/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def bookings_proxy(path):
-    url = f"{BOOKING_SERVICE_URL}/{path}"
-    return forward_request(url)
+    return forward_request('bookings', path)
 
 
 @app.route('/search/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def search_proxy(path):
-    url = f"{SEARCH_SERVICE_URL}/{path}"
-    return forward_request(url)
+    return forward_request('search', path)
+
+
+def request_body():
+    if request.content_length is None and 'chunked' not in request.headers.get('Transfer-Encoding', '').lower():
+        return None
+
+    if request.content_length is not None and request.content_length <= STREAM_CHUNK_SIZE:
+        return request.get_data()
+
+    def generate():
+        while True:
+            chunk = request.stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    return generate()
+
+
+def error_response(message):
+    return 502, [('Content-Type', 'application/json')], json.dumps({'error': message}).encode()
+
+
+def overloaded_response(upstream, rejection):
+    body = json.dumps({'error': f"The {upstream} service is overloaded ({rejection['reason']})"}).encode()
+    return 503, [('Content-Type', 'application/json'), ('Retry-After', str(rejection['retry_after']))], body
+
+
+def stream_rest(response, ticket, body, chunks):
+    """A body too large to buffer: what was read of it, then the rest as it comes.
+
+    It comes back started, so that closing it, even before the first chunk,
+    closes the upstream response and frees the slot.
+    """
+    try:
+        yield
+        yield bytes(body)
+        yield from chunks
+    finally:
+        response.close()
+        release(ticket)
+
+
+def fetch_buffered(upstream, url, headers, query_pairs, priority, kind, key, generation):
+    """GET url and return (status, headers, body), storing a 200 in the cache when kind is set.
+
+    A body over CACHE_MAX_ENTRY_BYTES is not read whole: body is then an
+    iterator over it (stream_rest), to be closed once sent.
+    """
+    ticket, rejection = acquire(upstream, priority)
+    if rejection is not None:
+        return overloaded_response(upstream, rejection)
+
+    streamed = None
+    try:
+        try:
+            response = sessions[upstream].request(
+                method='GET',
+                url=url,
+                headers=headers,
+                params=query_pairs,
+                stream=True,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+            )
+        except requests.RequestException as e:
+            observe(ticket, False)
+            return error_response(f"Failed to connect to service: {str(e)}")
+
+        observe(ticket, response.status_code < 500)
+        try:
+            body = bytearray()
+            chunks = response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+            for chunk in chunks:
+                body += chunk
+                if len(body) > CACHE_MAX_ENTRY_BYTES:
+                    streamed = stream_rest(response, ticket, body, chunks)
+                    next(streamed)
+                    break
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            return error_response(f"Failed to read from service: {str(e)}")
+        finally:
+            if streamed is None:
+                response.close()
+    finally:
+        if streamed is None:
+            release(ticket)
+
+    response_headers = filter_response_headers(response.headers.items())
+    if streamed is not None:
+        return response.status_code, response_headers, streamed
 
+    body = bytes(body)
+    if kind is not None and response.status_code == 200:
+        window = search_window(query_pairs) if kind == 'search' else None
+        store_response(key, kind, window, generation, response.status_code, response_headers, body)
+    return response.status_code, response_headers, body
+
+
+def stream_response(status, headers, chunks, accept_encoding):
+    headers, encoding = stream_encoding(headers, accept_encoding)
+    if encoding is not None:
+        chunks = encode_stream(chunks, encoding)
+    return Response(stream_with_context(chunks), status=status, headers=headers)
+
+
+def forward_request(upstream, path):
+    url = f"{UPSTREAMS[upstream]}/{path}"
+    query_pairs = list(request.args.items(multi=True))
+    accept = request.headers.get('Accept')
+    accept_encoding = request.headers.get('Accept-Encoding')
+    if_none_match = request.headers.get('If-None-Match')
+    kind = cache_kind(request.method, upstream, path, query_pairs, accept)
+    data = request_body()
+    key = None
+    cached = None
+
+    if kind is not None:
+        key = cache_key(upstream, path, query_pairs, accept)
+        cached = get_cached_response(key)
+        if cached is not None and revalidation_etag(cached) is None:
+            status, headers, body = finish_response(cached['status'], cached['headers'] + [('X-Cache', 'HIT')], cached['body'], if_none_match, accept_encoding, cached.setdefault('encoded', {}))
+            return Response(body, status=status, headers=headers)
+    generation = get_generation()
+
+    coalesced = is_coalesced(request.method, upstream, path, query_pairs, accept)
+    priority = request_priority(request.method, upstream, path)
+
+    if data is None and (kind is not None or coalesced):
+        # A cacheable response is fetched whole, and If-None-Match is answered
+        # here from the cache; upstream it only carries the ETag of a cached
+        # copy being revalidated.
+        if kind is None:
+            upstream_if_none_match = if_none_match
+        else:
+            upstream_if_none_match = revalidation_etag(cached) if cached is not None else None
+        forwarded = {name: value for name, value in filter_request_headers(request.headers.items()) if name.lower() != 'if-none-match'}
+        if upstream_if_none_match is not None:
+            forwarded['If-None-Match'] = upstream_if_none_match
+
+        fetch = functools.partial(fetch_buffered, upstream, url, forwarded, query_pairs, priority, kind, key, generation)
+        if coalesced:
+            # None when the leader's fetch raised or its body was streamed; this request then makes its own.
+            result = run_once(flight_key(request.method, upstream, path, query_pairs, accept, upstream_if_none_match, generation), fetch) or fetch()
+        else:
+            result = fetch()
+
+        status, headers, body = result
+        if not isinstance(body, bytes):
+            # Too large to buffer: sent on as it comes, neither stored nor revalidated.
+            proxied = stream_response(status, headers + ([('X-Cache', 'MISS')] if kind is not None else []), body, accept_encoding)
+            proxied.call_on_close(body.close)
+            return proxied
+
+        encoded = None
+        if cached is not None:
+            status, headers, body, encoded = after_revalidation(cached, status, headers, body)
+        elif kind is not None:
+            headers = headers + [('X-Cache', 'MISS')]
+        status, headers, body = finish_response(status, headers, body, if_none_match, accept_encoding, encoded)
+        return Response(body, status=status, headers=headers)
+
+    ticket, rejection = acquire(upstream, priority)
+    if rejection is not None:
+        status, headers, body = overloaded_response(upstream, rejection)
+        return Response(body, status=status, headers=headers)
 
-def forward_request(url):
     try:
-        response = requests.request(
+        response = sessions[upstream].request(
             method=request.method,
             url=url,
-            headers={key: value for key, value in request.headers if key != 'Host'},
-            params=request.args,
-            data=request.data,
-            json=request.get_json(silent=True),
-            timeout=5
+            headers=dict(filter_request_headers(request.headers.items())),
+            params=query_pairs,
+            data=data,
+            stream=True,
+            timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
         )
-        return (response.content, response.status_code, response.headers.items())
     except requests.RequestException as e:
+        observe(ticket, False)
+        release(ticket)
         return jsonify({'error': f"Failed to connect to service: {str(e)}"}), 502
 
+    observe(ticket, response.status_code < 500)
+
+    def generate():
+        try:
+            for chunk in response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False):
+                yield chunk
+        finally:
+            response.close()
+
+    proxied = stream_response(response.status_code, filter_response_headers(response.headers.items()), generate(), accept_encoding)
+    # The slot stays taken while the body streams, and is freed even if the client never reads it.
+    proxied.call_on_close(functools.partial(release, ticket))
+    return proxied
+
+
+@app.route('/composite/<name>', methods=['GET'])
+def composite(name):
+    status, payload = run_composite(name, list(request.args.items(multi=True)), fetch_call)
+    headers = [('Content-Type', 'application/json')]
+    if status == 503:
+        headers.append(('Retry-After', '1'))
+    status, headers, body = finish_response(status, headers, json.dumps(payload).encode(), None, request.headers.get('Accept-Encoding'))
+    return Response(body, status=status, headers=headers)
+
+
+def fetch_call(call):
+    ticket, rejection = acquire(call['upstream'], request_priority('GET', call['upstream'], call['path']))
+    if rejection is not None:
+        return None
+
+    try:
+        remaining = call['expires'] - time.monotonic()
+        if remaining <= 0:
+            return None
+
+        try:
+            # The timeouts bound each connect and read; the deadline checks below bound the whole call.
+            response = sessions[call['upstream']].get(
+                f"{UPSTREAMS[call['upstream']]}/{call['path']}",
+                params=call['params'],
+                headers={'Accept': 'application/json'},
+                stream=True,
+                timeout=(min(UPSTREAM_CONNECT_TIMEOUT, remaining), remaining)
+            )
+        except requests.RequestException:
+            observe(ticket, False)
+            return None
+
+        observe(ticket, response.status_code < 500)
+        try:
+            content = bytearray()
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                content += chunk
+                if time.monotonic() >= call['expires']:
+                    return None
+        except (requests.RequestException, urllib3.exceptions.HTTPError):
+            return None
+        finally:
+            response.close()
+    finally:
+        release(ticket)
+
+    return call_result(response.status_code, bytes(content))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({'cache': get_cache_stats(), 'single_flight': get_single_flight_stats(), 'composite': get_composite_stats(), 'overload': get_overload_stats(), 'rate_limit': get_rate_limit_stats(), 'encoding': get_encoding_stats()}), 200
+
+
+threading.Thread(target=listen_for_messages, daemon=True).start()
 
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    app.run()
@@ -0,0 +1,319 @@
+import functools
+import json
+import math
+import threading
+from urllib.parse import parse_qsl
+import httpx # type: ignore
+from utils.upstreams import UPSTREAMS, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT, STREAM_CHUNK_SIZE, filter_request_headers, filter_response_headers
+from utils.cache import CACHE_MAX_ENTRY_BYTES, cache_kind, cache_key, search_window, get_generation, get_cached_response, store_response, revalidation_etag, after_revalidation, get_cache_stats
+from utils.rabbitmq import listen_for_messages
+from utils.singleflight import is_coalesced, flight_key, run_once_async, get_single_flight_stats
+from utils.composite import call_result, run_composite_async, get_composite_stats
+from utils.overload import request_priority, acquire_async, observe, release, get_overload_stats
+from utils.ratelimit import RATE_LIMIT_KEY_HEADER, client_key, take, get_rate_limit_stats
+from utils.encoding import finish_response, stream_encoding, encode_stream_async, get_encoding_stats
+
+
+# Run with: uvicorn asgi:app --host 0.0.0.0 --port 5000
+# Every in-flight request is a coroutine rather than a thread, so one process
+# can wait on thousands of upstream calls at once.
+
+clients = {}
+
+
+def create_client(base_url):
+    return httpx.AsyncClient(
+        base_url=base_url,
+        limits=httpx.Limits(max_connections=UPSTREAM_POOL_SIZE, max_keepalive_connections=UPSTREAM_POOL_SIZE),
+        timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+    )
+
+
+def get_client(upstream):
+    client = clients.get(upstream)
+    if client is None:
+        client = clients[upstream] = create_client(UPSTREAMS[upstream])
+    return client
+
+
+def encode_headers(headers):
+    return [(key.encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+
+
+async def send_body(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            for upstream in UPSTREAMS:
+                get_client(upstream)
+            threading.Thread(target=listen_for_messages, daemon=True).start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for client in clients.values():
+                await client.aclose()
+            clients.clear()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def request_body(scope, receive):
+    headers = dict((key.lower(), value) for key, value in scope['headers'])
+    if b'content-length' not in headers and b'chunked' not in headers.get(b'transfer-encoding', b'').lower():
+        return None
+
+    async def generate():
+        more_body = True
+        while more_body:
+            message = await receive()
+            more_body = message.get('more_body', False)
+            if message.get('body'):
+                yield message['body']
+
+    return generate()
+
+
+def error_response(message):
+    return 502, [('Content-Type', 'application/json')], json.dumps({'error': message}).encode()
+
+
+def overloaded_response(upstream, rejection):
+    body = json.dumps({'error': f"The {upstream} service is overloaded ({rejection['reason']})"}).encode()
+    return 503, [('Content-Type', 'application/json'), ('Retry-After', str(rejection['retry_after']))], body
+
+
+async def stream_rest(response, ticket, body, chunks):
+    """A body too large to buffer: what was read of it, then the rest as it comes.
+
+    It comes back started, so that closing it, even before the first chunk,
+    closes the upstream response and frees the slot.
+    """
+    try:
+        yield b''
+        yield bytes(body)
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await response.aclose()
+        release(ticket)
+
+
+async def fetch_buffered(upstream, path, headers, query_string, query_pairs, priority, kind, key, generation):
+    """GET path and return (status, headers, body), storing a 200 in the cache when kind is set.
+
+    A body over CACHE_MAX_ENTRY_BYTES is not read whole: body is then an
+    async iterator over it (stream_rest), to be closed once sent.
+    """
+    client = get_client(upstream)
+    ticket, rejection = await acquire_async(upstream, priority)
+    if rejection is not None:
+        return overloaded_response(upstream, rejection)
+
+    streamed = None
+    try:
+        try:
+            response = await client.send(client.build_request('GET', f"/{path}", params=query_string, headers=headers), stream=True)
+        except httpx.HTTPError as e:
+            observe(ticket, False)
+            return error_response(f"Failed to connect to service: {str(e)}")
+
+        observe(ticket, response.status_code < 500)
+        try:
+            body = bytearray()
+            chunks = response.aiter_raw(STREAM_CHUNK_SIZE)
+            async for chunk in chunks:
+                body += chunk
+                if len(body) > CACHE_MAX_ENTRY_BYTES:
+                    streamed = stream_rest(response, ticket, body, chunks)
+                    await streamed.__anext__()
+                    break
+        except httpx.HTTPError as e:
+            return error_response(f"Failed to read from service: {str(e)}")
+        finally:
+            if streamed is None:
+                await response.aclose()
+    finally:
+        if streamed is None:
+            release(ticket)
+
+    response_headers = filter_response_headers(response.headers.multi_items())
+    if streamed is not None:
+        return response.status_code, response_headers, streamed
+
+    body = bytes(body)
+    if kind is not None and response.status_code == 200:
+        window = search_window(query_pairs) if kind == 'search' else None
+        store_response(key, kind, window, generation, response.status_code, response_headers, body)
+    return response.status_code, response_headers, body
+
+
+async def send_stream(send, status, headers, chunks, accept_encoding):
+    headers, encoding = stream_encoding(headers, accept_encoding)
+    if encoding is not None:
+        chunks = encode_stream_async(chunks, encoding)
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+    async for chunk in chunks:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def forward_request(scope, receive, send, upstream, path):
+    headers = [(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']]
+    query_string = scope.get('query_string', b'').decode('latin-1')
+    query_pairs = parse_qsl(query_string, keep_blank_values=True)
+    accept = next((value for key, value in headers if key.lower() == 'accept'), None)
+    accept_encoding = next((value for key, value in headers if key.lower() == 'accept-encoding'), None)
+    if_none_match = next((value for key, value in headers if key.lower() == 'if-none-match'), None)
+    kind = cache_kind(scope['method'], upstream, path, query_pairs, accept)
+    content = request_body(scope, receive)
+    client = get_client(upstream)
+    key = None
+    cached = None
+
+    if kind is not None:
+        key = cache_key(upstream, path, query_pairs, accept)
+        cached = get_cached_response(key)
+        if cached is not None and revalidation_etag(cached) is None:
+            await send_body(send, *finish_response(cached['status'], cached['headers'] + [('X-Cache', 'HIT')], cached['body'], if_none_match, accept_encoding, cached.setdefault('encoded', {})))
+            return
+    generation = get_generation()
+    coalesced = is_coalesced(scope['method'], upstream, path, query_pairs, accept)
+    priority = request_priority(scope['method'], upstream, path)
+
+    if content is None and (kind is not None or coalesced):
+        # A cacheable response is fetched whole, and If-None-Match is answered
+        # here from the cache; upstream it only carries the ETag of a cached
+        # copy being revalidated.
+        if kind is None:
+            upstream_if_none_match = if_none_match
+        else:
+            upstream_if_none_match = revalidation_etag(cached) if cached is not None else None
+        forwarded = [(name, value) for name, value in filter_request_headers(headers) if name.lower() != 'if-none-match']
+        if upstream_if_none_match is not None:
+            forwarded.append(('If-None-Match', upstream_if_none_match))
+
+        fetch = functools.partial(fetch_buffered, upstream, path, forwarded, query_string, query_pairs, priority, kind, key, generation)
+        if coalesced:
+            # None when the body was streamed to another request; this one then makes its own.
+            result = await run_once_async(flight_key(scope['method'], upstream, path, query_pairs, accept, upstream_if_none_match, generation), fetch) or await fetch()
+        else:
+            result = await fetch()
+
+        status, response_headers, body = result
+        if not isinstance(body, bytes):
+            # Too large to buffer: sent on as it comes, neither stored nor revalidated.
+            try:
+                await send_stream(send, status, response_headers + ([('X-Cache', 'MISS')] if kind is not None else []), body, accept_encoding)
+            finally:
+                await body.aclose()
+            return
+
+        encoded = None
+        if cached is not None:
+            status, response_headers, body, encoded = after_revalidation(cached, status, response_headers, body)
+        elif kind is not None:
+            response_headers = response_headers + [('X-Cache', 'MISS')]
+        await send_body(send, *finish_response(status, response_headers, body, if_none_match, accept_encoding, encoded))
+        return
+
+    ticket, rejection = await acquire_async(upstream, priority)
+    if rejection is not None:
+        await send_body(send, *overloaded_response(upstream, rejection))
+        return
+
+    try:
+        try:
+            upstream_request = client.build_request(
+                scope['method'],
+                f"/{path}",
+                params=query_string,
+                headers=filter_request_headers(headers),
+                content=content,
+            )
+            response = await client.send(upstream_request, stream=True)
+        except httpx.HTTPError as e:
+            observe(ticket, False)
+            await send_json(send, 502, {'error': f"Failed to connect to service: {str(e)}"})
+            return
+
+        observe(ticket, response.status_code < 500)
+        try:
+            await send_stream(send, response.status_code, filter_response_headers(response.headers.multi_items()), response.aiter_raw(STREAM_CHUNK_SIZE), accept_encoding)
+        finally:
+            await response.aclose()
+    finally:
+        release(ticket)
+
+
+async def fetch_call(call):
+    client = get_client(call['upstream'])
+    ticket, rejection = await acquire_async(call['upstream'], request_priority('GET', call['upstream'], call['path']))
+    if rejection is not None:
+        return None
+
+    # Released even when the call is cancelled at its deadline.
+    try:
+        try:
+            response = await client.get(f"/{call['path']}", params=call['params'], headers={'Accept': 'application/json'})
+        except httpx.HTTPError:
+            observe(ticket, False)
+            return None
+
+        observe(ticket, response.status_code < 500)
+        return call_result(response.status_code, response.content)
+    finally:
+        release(ticket)
+
+
+def request_client(scope):
+    headers = dict((key.decode('latin-1').lower(), value.decode('latin-1')) for key, value in scope['headers'])
+    address = scope.get('client')
+    return client_key(headers.get(RATE_LIMIT_KEY_HEADER.lower()), headers.get('x-forwarded-for'), address[0] if address else None)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    if scope['path'] == '/metrics':
+        await send_json(send, 200, {'cache': get_cache_stats(), 'single_flight': get_single_flight_stats(), 'composite': get_composite_stats(), 'overload': get_overload_stats(), 'rate_limit': get_rate_limit_stats(), 'encoding': get_encoding_stats()})
+        return
+
+    prefix, _, path = scope['path'].lstrip('/').partition('/')
+    retry_after = take(request_client(scope), prefix)
+    if retry_after:
+        body = json.dumps({'error': 'Too many requests'}).encode()
+        await send_body(send, 429, [('Content-Type', 'application/json'), ('Retry-After', str(math.ceil(retry_after)))], body)
+        return
+
+    if prefix == 'composite' and scope['method'] == 'GET':
+        query_pairs = parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        status, payload = await run_composite_async(path, query_pairs, fetch_call)
+        accept_encoding = next((value.decode('latin-1') for key, value in scope['headers'] if key.lower() == b'accept-encoding'), None)
+        await send_body(send, *finish_response(status, [('Content-Type', 'application/json')], json.dumps(payload).encode(), None, accept_encoding))
+        return
+
+    if prefix not in UPSTREAMS or not path:
+        await send_json(send, 404, {'error': 'Not found'})
+        return
+
+    await forward_request(scope, receive, send, prefix, path)
@@ -0,0 +1,77 @@
+"""Load shedding benchmark.
+
+Fills each upstream up to what searches may use of its concurrency limit,
+then sends one request per gateway route, in process, and reports whether
+it was admitted or turned away and how long it waited. Writes and reads
+still fit; searches (POST /search/batch included) are shed after their
+short queue timeout. Exits with status 1 when a route is let through or
+turned away out of priority order.
+
+    python benchmarks/overload.py --limit 20
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils import overload  # noqa: E402
+from utils.overload import PRIORITY_NAMES, PRIORITY_SEARCH, acquire, release, request_priority  # noqa: E402
+
+ROUTES = [
+    ('GET', 'apartments', 'add'),
+    ('POST', 'apartments', 'import'),
+    ('GET', 'apartments', 'list'),
+    ('GET', 'bookings', 'add'),
+    ('POST', 'bookings', 'batch'),
+    ('GET', 'bookings', 'list'),
+    ('GET', 'search', 'search'),
+    ('POST', 'search', 'batch'),
+]
+
+
+def saturate(upstream, limit):
+    """Hold as many slots of upstream as searches may use."""
+    overload._upstreams[upstream]['limit'] = float(limit)
+    held = []
+    while overload._upstreams[upstream]['in_flight'] < overload._capacity(overload._upstreams[upstream], PRIORITY_SEARCH):
+        ticket, _ = acquire(upstream, PRIORITY_SEARCH)
+        held.append(ticket)
+    return held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--limit', type=int, default=20, help='concurrency limit of every upstream')
+    args = parser.parse_args()
+
+    print(f"{'route':>24} {'priority':>8} {'outcome':>13} {'wait ms':>8}")
+
+    out_of_order = []
+    for method, upstream, path in ROUTES:
+        held = saturate(upstream, args.limit)
+        priority = request_priority(method, upstream, path)
+
+        started = time.perf_counter()
+        ticket, rejection = acquire(upstream, priority)
+        waited = time.perf_counter() - started
+        if ticket is not None:
+            release(ticket)
+        for slot in held:
+            release(slot)
+
+        outcome = 'admitted' if ticket is not None else rejection['reason']
+        route = f'{method} /{upstream}/{path}'
+        print(f"{route:>24} {PRIORITY_NAMES[priority]:>8} {outcome:>13} {waited * 1000:>8.1f}", flush=True)
+
+        if (ticket is None) != (priority == PRIORITY_SEARCH):
+            out_of_order.append(route)
+
+    if out_of_order:
+        print(f"Out of priority order: {', '.join(out_of_order)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
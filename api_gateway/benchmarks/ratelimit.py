@@ -0,0 +1,75 @@
+"""Rate limiter overhead benchmark.
+
+Times take() per request, in process, for a number of active clients
+spread over the route prefixes, on one thread and on several at once (as
+the WSGI gateway's request threads call it), and reports the buckets held
+afterwards. Every client gets an ample budget, so the time is that of the
+common, allowed path.
+
+    python benchmarks/ratelimit.py --clients 1 1000 100000 --threads 1 8
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils import ratelimit  # noqa: E402
+from utils.ratelimit import RATE_LIMITS, client_key, take  # noqa: E402
+
+
+def requests_for(clients, count, seed):
+    rng = random.Random(seed)
+    prefixes = list(RATE_LIMITS)
+    addresses = [client_key(None, None, f'10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}') for index in range(clients)]
+    return [(rng.choice(addresses), rng.choice(prefixes)) for _ in range(count)]
+
+
+def run(requests):
+    for client, prefix in requests:
+        take(client, prefix)
+
+
+def timed(requests, threads):
+    """Seconds for all threads to get through their share of requests."""
+    shares = [requests[index::threads] for index in range(threads)]
+    workers = [threading.Thread(target=run, args=(share,)) for share in shares]
+
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 1000, 100000])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--requests', type=int, default=500000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Budgets large enough that nothing is limited: the cost measured is that of letting a request through.
+    for prefix in RATE_LIMITS:
+        RATE_LIMITS[prefix] = (1e9, 1e9)
+
+    print(f"{'clients':>8} {'threads':>7} {'ns/request':>11} {'requests/s':>12} {'buckets':>8}")
+
+    for clients in args.clients:
+        requests = requests_for(clients, args.requests, args.seed)
+
+        for threads in args.threads:
+            ratelimit._buckets.clear()
+            run(requests[:1000])
+            elapsed = timed(requests, threads)
+            buckets = ratelimit.get_rate_limit_stats()['buckets']
+            print(f"{clients:>8} {threads:>7} {elapsed / len(requests) * 1e9:>11.0f} {len(requests) / elapsed:>12.0f} {buckets:>8}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
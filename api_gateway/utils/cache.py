@@ -0,0 +1,217 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from utils.upstreams import wants_ndjson
+
+
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '10000'))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_MAX_ENTRY_BYTES = int(os.getenv('CACHE_MAX_ENTRY_BYTES', str(4 * 1024 * 1024)))
+CACHE_TTL = float(os.getenv('CACHE_TTL', '30'))
+
+# (upstream, path) -> kind of cached response, used to decide what an event invalidates.
+CACHEABLE_ROUTES = {
+    ('apartments', 'list'): 'list',
+    ('search', 'search'): 'search',
+}
+
+# Search results come from the search service's replica, which applies an
+# event some time after the gateway has seen it and invalidated: a fetch
+# that starts in between gets the old results, and the generation check
+# cannot tell. So a cached search is revalidated on every hit with its
+# ETag, the replica's data version, which the search service answers with a
+# 304 before running any query. The apartment list comes from the service
+# that publishes the events, after its commit, and needs no revalidation.
+REVALIDATED_KINDS = frozenset(['search'])
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_size = 0
+_generation = 0
+# Caching stays off until the invalidation subscriber is connected.
+_enabled = False
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'expired': 0,
+    'evictions': 0,
+    'invalidations': 0,
+    'stores': 0,
+    'stale_stores_skipped': 0,
+    'revalidated': 0,
+    'revalidated_changed': 0,
+    'served_stale': 0,
+}
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def set_enabled(enabled):
+    global _enabled
+
+    _enabled = enabled
+    if not enabled:
+        clear()
+
+
+def cache_kind(method, upstream, path, query_pairs, accept):
+    # NDJSON lists stream through; they are never read whole to be stored.
+    if method != 'GET' or not _enabled or wants_ndjson(query_pairs, accept):
+        return None
+    return CACHEABLE_ROUTES.get((upstream, path))
+
+
+def cache_key(upstream, path, query_pairs, accept):
+    return (upstream, path, tuple(sorted(query_pairs)), accept or '')
+
+
+def search_window(query_pairs):
+    args = dict(query_pairs)
+    return parse_date(args.get('from')), parse_date(args.get('to'))
+
+
+def get_generation():
+    with _lock:
+        return _generation
+
+
+def _remove(key):
+    global _size
+
+    entry = _entries.pop(key)
+    _size -= entry['size']
+
+
+def get_cached_response(key):
+    with _lock:
+        entry = _entries.get(key)
+
+        if entry is None:
+            _stats['misses'] += 1
+            return None
+
+        if entry['expires'] <= time.monotonic():
+            _remove(key)
+            _stats['expired'] += 1
+            _stats['misses'] += 1
+            return None
+
+        _entries.move_to_end(key)
+        _stats['hits'] += 1
+        return entry
+
+
+def revalidation_etag(entry):
+    """The ETag to revalidate entry with before it is served, or None when it is served as is."""
+    if entry['kind'] not in REVALIDATED_KINDS:
+        return None
+    return next((value for name, value in entry['headers'] if name.lower() == 'etag'), None)
+
+
+def after_revalidation(entry, status, headers, body):
+    """(status, headers, body, encoded) to send once the upstream answered a revalidation of entry.
+
+    A 304 confirms the entry. An upstream error leaves it standing as well,
+    within its TTL as it is; anything else is the new response.
+    """
+    if status == 304 or status >= 500:
+        with _lock:
+            _stats['revalidated' if status == 304 else 'served_stale'] += 1
+        cache_status = 'REVALIDATED' if status == 304 else 'STALE'
+        return entry['status'], entry['headers'] + [('X-Cache', cache_status)], entry['body'], entry.setdefault('encoded', {})
+
+    with _lock:
+        _stats['revalidated_changed'] += 1
+    return status, headers + [('X-Cache', 'MISS')], body, None
+
+
+def store_response(key, kind, window, generation, status, headers, body):
+    """Store a response unless an invalidation arrived while it was being fetched."""
+    global _size
+
+    size = len(body)
+    if size > CACHE_MAX_ENTRY_BYTES:
+        return
+
+    with _lock:
+        if generation != _generation:
+            _stats['stale_stores_skipped'] += 1
+            return
+
+        if key in _entries:
+            _remove(key)
+
+        _entries[key] = {
+            'kind': kind,
+            'window': window,
+            'status': status,
+            'headers': headers,
+            'body': body,
+            'size': size,
+            'expires': time.monotonic() + CACHE_TTL,
+        }
+        _size += size
+        _stats['stores'] += 1
+
+        while _entries and (len(_entries) > CACHE_MAX_ENTRIES or _size > CACHE_MAX_BYTES):
+            _remove(next(iter(_entries)))
+            _stats['evictions'] += 1
+
+
+def _invalidate(matches):
+    global _generation
+
+    with _lock:
+        _generation += 1
+        stale = [key for key, entry in _entries.items() if matches(entry)]
+        for key in stale:
+            _remove(key)
+        _stats['invalidations'] += len(stale)
+
+
+def invalidate_apartments():
+    _invalidate(lambda entry: entry['kind'] in ('list', 'search'))
+
+
+def _overlaps(window, start, end):
+    window_from, window_to = window
+    if window_from is None or window_to is None:
+        return True
+    return start <= window_to and end >= window_from
+
+
+def invalidate_booking_windows(ranges):
+    """Drop the search results whose date window overlaps any of the given (start, end) ranges."""
+    ranges = [(parse_date(start), parse_date(end)) for start, end in ranges]
+
+    if not ranges or any(start is None or end is None for start, end in ranges):
+        _invalidate(lambda entry: entry['kind'] == 'search')
+        return
+
+    _invalidate(lambda entry: entry['kind'] == 'search' and any(_overlaps(entry['window'], start, end) for start, end in ranges))
+
+
+def clear():
+    _invalidate(lambda entry: True)
+
+
+def get_cache_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_entries)
+        stats['bytes'] = _size
+        stats['enabled'] = _enabled
+
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else None
+    stats['max_entries'] = CACHE_MAX_ENTRIES
+    stats['max_bytes'] = CACHE_MAX_BYTES
+    stats['ttl'] = CACHE_TTL
+    return stats
@@ -0,0 +1,330 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from utils.upstreams import UPSTREAMS
+
+
+# Composite endpoints: one gateway request that fans out to several upstream
+# calls at once and merges their answers, instead of the client making them
+# one after another and joining them itself.
+#
+# Each endpoint is a plan, a generator that yields the calls of a stage as
+# {name: call} and is sent back {name: result}, where a result is the status
+# and parsed JSON body, or None for a call that failed or missed its
+# deadline. Plans answer without the calls they can do without, marking the
+# response degraded and listing what is missing. The same plans run on the
+# threads of the WSGI gateway and on the event loop of the ASGI one.
+
+COMPOSITE_DEADLINE = float(os.getenv('COMPOSITE_DEADLINE', '1.0'))
+COMPOSITE_MAX_APARTMENTS = int(os.getenv('COMPOSITE_MAX_APARTMENTS', '100'))
+COMPOSITE_WORKERS = int(os.getenv('COMPOSITE_WORKERS', '32'))
+
+_executor = None
+_lock = threading.Lock()
+# Calls handed to the pool and not finished yet, those past their deadline included.
+_busy = 0
+_stats = {
+    'composites': {},
+    'calls': {upstream: {'calls': 0, 'failed': 0, 'timed_out': 0, 'saturated': 0} for upstream in UPSTREAMS},
+    'saturated': 0,
+}
+
+
+def call(upstream, path, params, deadline=None):
+    return {
+        'upstream': upstream,
+        'path': path,
+        'params': params,
+        'deadline': COMPOSITE_DEADLINE if deadline is None else deadline,
+    }
+
+
+def call_result(status, content):
+    try:
+        body = json.loads(content)
+    except ValueError:
+        body = None
+    return {'status': status, 'body': body}
+
+
+def _rows(result, key, id_field):
+    """The list under key in a successful call's body; None if the call did not succeed.
+
+    A body whose rows are not objects with a string id_field counts as a
+    call that did not succeed too, rather than failing the whole plan.
+    """
+    if result is None or result['status'] != 200 or not isinstance(result['body'], dict):
+        return None
+    rows = result['body'].get(key)
+    if not isinstance(rows, list) or not all(isinstance(row, dict) and isinstance(row.get(id_field), str) for row in rows):
+        return None
+    return rows
+
+
+def apartment_plan(query_pairs):
+    """An apartment with its bookings: ?id=<apartment>[&history=true]."""
+    args = dict(query_pairs)
+    apartment_id = args.get('id')
+    if not apartment_id:
+        raise ValueError('id is required')
+
+    booking_params = [('apartment', apartment_id)]
+    if 'history' in args:
+        booking_params.append(('history', args['history']))
+
+    results = yield {
+        'apartment': call('apartments', 'list', [('id', apartment_id)]),
+        'bookings': call('bookings', 'list', booking_params),
+    }
+
+    apartments = _rows(results['apartment'], 'apartments', 'id')
+    bookings = _rows(results['bookings'], 'bookings', 'apartment_id')
+    missing = [name for name, rows in (('apartment', apartments), ('bookings', bookings)) if rows is None]
+
+    if len(missing) == len(results):
+        return 502, {'error': 'No service answered in time', 'missing': missing}
+    if apartments == []:
+        return 404, {'error': 'Apartment not found'}
+
+    return 200, {
+        'apartment': apartments[0] if apartments else None,
+        'bookings': bookings,
+        'degraded': bool(missing),
+        'missing': missing,
+    }
+
+
+def availability_plan(query_pairs):
+    """The apartments free over a /search query, with current details and bookings.
+
+    The search runs first; the details and bookings of what it found are
+    then fetched together. Without them the search's own copy of the
+    details is returned, and bookings is null.
+    """
+    args = dict(query_pairs)
+    try:
+        limit = int(args.get('limit') or COMPOSITE_MAX_APARTMENTS)
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= COMPOSITE_MAX_APARTMENTS:
+        raise ValueError(f"limit must be an integer between 1 and {COMPOSITE_MAX_APARTMENTS}")
+
+    search_params = [(key, value) for key, value in query_pairs if key != 'limit'] + [('limit', str(limit))]
+    results = yield {'search': call('search', 'search', search_params)}
+
+    search = results['search']
+    if search is None:
+        return 502, {'error': 'The search service did not answer in time'}
+    if search['status'] != 200:
+        return search['status'], search['body']
+
+    found = _rows(search, 'apartments', 'id')
+    if found is None:
+        return 502, {'error': 'The search service sent an unreadable answer'}
+    if not found:
+        return 200, {'apartments': [], 'degraded': False, 'missing': []}
+
+    apartment_ids = [apartment['id'] for apartment in found]
+    results = yield {
+        'details': call('apartments', 'list', [('id', apartment_id) for apartment_id in apartment_ids]),
+        'bookings': call('bookings', 'list', [('apartment', apartment_id) for apartment_id in apartment_ids]),
+    }
+
+    details = _rows(results['details'], 'apartments', 'id')
+    bookings = _rows(results['bookings'], 'bookings', 'apartment_id')
+    missing = [name for name, rows in (('details', details), ('bookings', bookings)) if rows is None]
+
+    bookings_by_apartment = {}
+    for booking in bookings or ():
+        bookings_by_apartment.setdefault(booking['apartment_id'], []).append(booking)
+    details_by_id = {apartment['id']: apartment for apartment in details or ()}
+
+    apartments = []
+    for apartment in found:
+        if details is not None:
+            if apartment['id'] not in details_by_id:
+                # Removed since the search service last heard of it.
+                continue
+            # Stay searches add earliest or gaps, which the details leave in place.
+            apartment = dict(apartment, **details_by_id[apartment['id']])
+        apartment['bookings'] = None if bookings is None else bookings_by_apartment.get(apartment['id'], [])
+        apartments.append(apartment)
+
+    return 200, {'apartments': apartments, 'degraded': bool(missing), 'missing': missing}
+
+
+COMPOSITES = {
+    'apartment': apartment_plan,
+    'availability': availability_plan,
+}
+
+
+def _record_call(upstream, outcome):
+    with _lock:
+        stats = _stats['calls'][upstream]
+        stats['calls'] += 1
+        if outcome is not None:
+            stats[outcome] += 1
+
+
+def _record(name, status, payload, elapsed):
+    with _lock:
+        stats = _stats['composites'].setdefault(name, {
+            'requests': 0,
+            'degraded': 0,
+            'errors': 0,
+            'last_ms': 0,
+            'max_ms': 0,
+        })
+        stats['requests'] += 1
+        if status >= 500:
+            stats['errors'] += 1
+        elif isinstance(payload, dict) and payload.get('degraded'):
+            stats['degraded'] += 1
+        stats['last_ms'] = round(elapsed * 1000, 3)
+        stats['max_ms'] = max(stats['max_ms'], stats['last_ms'])
+
+
+def _get_executor():
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=COMPOSITE_WORKERS, thread_name_prefix='composite')
+        return _executor
+
+
+def _run_call(fetch, call):
+    global _busy
+
+    try:
+        # Queued until past its deadline: nobody waits for the result any more.
+        if time.monotonic() >= call['expires']:
+            return None
+        return fetch(call)
+    finally:
+        with _lock:
+            _busy -= 1
+
+
+def _take_worker():
+    global _busy
+
+    with _lock:
+        if _busy >= COMPOSITE_WORKERS:
+            return False
+        _busy += 1
+        return True
+
+
+def gather(calls, fetch):
+    """Run fetch(call) for all calls on a thread pool; each result is None past the call's deadline.
+
+    call['expires'] is the deadline as a time.monotonic() value, and fetch
+    must give up by then, so a call that missed it does not keep holding a
+    worker. A call that finds every worker busy is not made at all.
+    """
+    started = time.monotonic()
+    executor = _get_executor()
+    futures = {}
+    results = {}
+
+    for name, call in calls.items():
+        # The calls run side by side, so each deadline counts from when they were all sent.
+        call['expires'] = started + call['deadline']
+        if _take_worker():
+            futures[name] = executor.submit(_run_call, fetch, call)
+        else:
+            results[name] = None
+            _record_call(call['upstream'], 'saturated')
+
+    for name, future in futures.items():
+        remaining = max(0, calls[name]['expires'] - time.monotonic())
+        try:
+            results[name] = future.result(timeout=remaining)
+            _record_call(calls[name]['upstream'], None if results[name] is not None else 'failed')
+        except FutureTimeoutError:
+            results[name] = None
+            _record_call(calls[name]['upstream'], 'timed_out')
+
+    return results
+
+
+async def _fetch_before_deadline(call, fetch):
+    try:
+        result = await asyncio.wait_for(fetch(call), call['deadline'])
+    except asyncio.TimeoutError:
+        _record_call(call['upstream'], 'timed_out')
+        return None
+
+    _record_call(call['upstream'], None if result is not None else 'failed')
+    return result
+
+
+async def gather_async(calls, fetch):
+    """Await fetch(call) for all calls at once; each result is None past the call's deadline."""
+    names = list(calls)
+    results = await asyncio.gather(*[_fetch_before_deadline(calls[name], fetch) for name in names])
+    return dict(zip(names, results))
+
+
+def run_composite(name, query_pairs, fetch):
+    """Answer composite name on this thread; fetch(call) returns a call_result or None. Returns (status, payload)."""
+    if name not in COMPOSITES:
+        return 404, {'error': 'Not found'}
+
+    with _lock:
+        saturated = _busy >= COMPOSITE_WORKERS
+        if saturated:
+            _stats['saturated'] += 1
+    if saturated:
+        # Every worker is still on earlier calls: queueing would only run this one past its deadlines.
+        return 503, {'error': 'Too many composite requests in progress'}
+
+    started = time.monotonic()
+    plan = COMPOSITES[name](query_pairs)
+    try:
+        calls = next(plan)
+        while True:
+            calls = plan.send(gather(calls, fetch))
+    except StopIteration as stop:
+        status, payload = stop.value
+    except ValueError as e:
+        status, payload = 400, {'error': str(e)}
+
+    _record(name, status, payload, time.monotonic() - started)
+    return status, payload
+
+
+async def run_composite_async(name, query_pairs, fetch):
+    """Answer composite name on the event loop; fetch(call) is a coroutine function. Returns (status, payload)."""
+    if name not in COMPOSITES:
+        return 404, {'error': 'Not found'}
+
+    started = time.monotonic()
+    plan = COMPOSITES[name](query_pairs)
+    try:
+        calls = next(plan)
+        while True:
+            calls = plan.send(await gather_async(calls, fetch))
+    except StopIteration as stop:
+        status, payload = stop.value
+    except ValueError as e:
+        status, payload = 400, {'error': str(e)}
+
+    _record(name, status, payload, time.monotonic() - started)
+    return status, payload
+
+
+def get_composite_stats():
+    with _lock:
+        return {
+            'composites': {name: dict(stats) for name, stats in _stats['composites'].items()},
+            'calls': {upstream: dict(stats) for upstream, stats in _stats['calls'].items()},
+            'saturated': _stats['saturated'],
+            'busy_workers': _busy,
+            'workers': COMPOSITE_WORKERS,
+        }
@@ -0,0 +1,186 @@
+import gzip
+import os
+import threading
+import zlib
+
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
+
+
+# How responses leave the gateway: conditional GETs are answered against the
+# response's ETag, and JSON bodies are compressed with the best coding the
+# client accepts. The upstreams are always asked for identity bodies, so the
+# cache and single-flight hold one copy that every client can be sent.
+
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+COMPRESSIBLE_TYPES = frozenset(['application/json', 'application/x-ndjson'])
+
+_lock = threading.Lock()
+_stats = {
+    'not_modified': 0,
+    'compressed': {'br': 0, 'gzip': 0},
+    'bytes_in': 0,
+    'bytes_out': 0,
+}
+
+
+def _header(headers, name):
+    name = name.lower()
+    return next((value for key, value in headers if key.lower() == name), None)
+
+
+def _opaque(tag):
+    tag = tag.strip()
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value names etag (weak comparison, as for GET)."""
+    if not if_none_match or not etag:
+        return False
+    tags = if_none_match.split(',')
+    return any(tag.strip() == '*' for tag in tags) or _opaque(etag) in (_opaque(tag) for tag in tags)
+
+
+def choose_encoding(accept_encoding):
+    """'br', 'gzip' or None, from an Accept-Encoding header value."""
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip().lower()] = weight
+
+    candidates = ['br', 'gzip'] if brotli is not None else ['gzip']
+    ranked = [(weights.get(coding, weights.get('*', 0.0)), -position, coding) for position, coding in enumerate(candidates)]
+    weight, _, coding = max(ranked)
+    return coding if weight > 0 else None
+
+
+def is_compressible(headers):
+    content_type = (_header(headers, 'Content-Type') or '').partition(';')[0].strip().lower()
+    return content_type in COMPRESSIBLE_TYPES and _header(headers, 'Content-Encoding') is None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL)
+
+
+def _count(encoding, size_in, size_out):
+    with _lock:
+        _stats['compressed'][encoding] += 1
+        _stats['bytes_in'] += size_in
+        _stats['bytes_out'] += size_out
+
+
+def finish_response(status, headers, body, if_none_match, accept_encoding, encoded=None):
+    """The (status, headers, body) to send for a buffered response.
+
+    encoded, if given, is a dict kept with a cached body that remembers its
+    compressed forms, so a cache hit does not compress again.
+    """
+    if status == 200 and etag_matches(if_none_match, _header(headers, 'ETag')):
+        with _lock:
+            _stats['not_modified'] += 1
+        kept = [(key, value) for key, value in headers if key.lower() in ('etag', 'cache-control', 'vary', 'x-cache')]
+        return 304, kept, b''
+
+    if not is_compressible(headers):
+        return status, headers, body
+
+    headers = headers + [('Vary', 'Accept-Encoding')]
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None or len(body) < COMPRESS_MIN_BYTES:
+        return status, headers, body
+
+    compressed = encoded.get(encoding) if encoded is not None else None
+    if compressed is None:
+        compressed = compress(body, encoding)
+        if encoded is not None:
+            encoded[encoding] = compressed
+    _count(encoding, len(body), len(compressed))
+
+    return status, headers + [('Content-Encoding', encoding)], compressed
+
+
+def stream_encoding(headers, accept_encoding):
+    """(headers, encoding) for a streamed response; encoding is None when it goes out as is."""
+    if not is_compressible(headers):
+        return headers, None
+
+    headers = headers + [('Vary', 'Accept-Encoding')]
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None:
+        return headers, None
+    return headers + [('Content-Encoding', encoding)], encoding
+
+
+def _compressor(encoding):
+    """The (process, finish) functions of a streaming compressor.
+
+    process(chunk) returns all the compressed output for chunk, flushed, so
+    an NDJSON feed still goes out row by row instead of waiting for the
+    compressor's buffers to fill.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return (lambda chunk: compressor.process(chunk) + compressor.flush()), compressor.finish
+    # wbits 31: deflate in a gzip wrapper.
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return (lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+
+
+def encode_stream(chunks, encoding):
+    process, finish = _compressor(encoding)
+    size_in = size_out = 0
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        data = process(chunk)
+        size_in += len(chunk)
+        size_out += len(data)
+        yield data
+
+    data = finish()
+    _count(encoding, size_in, size_out + len(data))
+    yield data
+
+
+async def encode_stream_async(chunks, encoding):
+    process, finish = _compressor(encoding)
+    size_in = size_out = 0
+
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        data = process(chunk)
+        size_in += len(chunk)
+        size_out += len(data)
+        yield data
+
+    data = finish()
+    _count(encoding, size_in, size_out + len(data))
+    yield data
+
+
+def get_encoding_stats():
+    with _lock:
+        stats = dict(_stats, compressed=dict(_stats['compressed']))
+    stats['ratio'] = stats['bytes_out'] / stats['bytes_in'] if stats['bytes_in'] else None
+    stats['brotli_available'] = brotli is not None
+    return stats
@@ -0,0 +1,302 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from utils.upstreams import UPSTREAMS, UPSTREAM_POOL_SIZE
+
+
+# Overload protection per upstream, so one slow service cannot tie up the
+# gateway for the others.
+#
+# Concurrency limit: at most `limit` requests are in flight to an upstream.
+# The limit adapts AIMD-style: it grows by about one per limit's worth of
+# fast successes, and is cut by OVERLOAD_DECREASE_FACTOR when a call fails or
+# takes longer than OVERLOAD_LATENCY_TARGET (at most once per target, so one
+# burst of slow calls counts once).
+#
+# Priorities: writes go first, then reads, then searches. A request that
+# finds no room waits in its priority's queue for up to its queue timeout;
+# freed slots go to the highest priority waiting. Searches only ever use
+# OVERLOAD_LOW_PRIORITY_SHARE of the limit, so writes keep some headroom.
+#
+# Circuit breaker: OVERLOAD_BREAKER_FAILURES failures in a row open it, and
+# requests are turned away at once for OVERLOAD_BREAKER_COOLDOWN seconds.
+# After that a single probe request is let through; its success closes the
+# breaker, its failure opens it again.
+#
+# acquire() and acquire_async() return (ticket, None) or (None, rejection),
+# rejection being {'reason': ..., 'retry_after': seconds}. observe(ticket, ok)
+# reports how the call went once its headers are in, and release(ticket)
+# frees the slot once the response is done.
+
+OVERLOAD_INITIAL_LIMIT = int(os.getenv('OVERLOAD_INITIAL_LIMIT', '20'))
+OVERLOAD_MIN_LIMIT = int(os.getenv('OVERLOAD_MIN_LIMIT', '1'))
+OVERLOAD_MAX_LIMIT = int(os.getenv('OVERLOAD_MAX_LIMIT', str(UPSTREAM_POOL_SIZE)))
+OVERLOAD_LATENCY_TARGET = float(os.getenv('OVERLOAD_LATENCY_TARGET', '0.5'))
+OVERLOAD_DECREASE_FACTOR = float(os.getenv('OVERLOAD_DECREASE_FACTOR', '0.7'))
+OVERLOAD_QUEUE_TIMEOUT = float(os.getenv('OVERLOAD_QUEUE_TIMEOUT', '1.0'))
+OVERLOAD_LOW_PRIORITY_QUEUE_TIMEOUT = float(os.getenv('OVERLOAD_LOW_PRIORITY_QUEUE_TIMEOUT', '0.1'))
+OVERLOAD_LOW_PRIORITY_SHARE = float(os.getenv('OVERLOAD_LOW_PRIORITY_SHARE', '0.75'))
+OVERLOAD_BREAKER_FAILURES = int(os.getenv('OVERLOAD_BREAKER_FAILURES', '5'))
+OVERLOAD_BREAKER_COOLDOWN = float(os.getenv('OVERLOAD_BREAKER_COOLDOWN', '5'))
+
+PRIORITY_WRITE = 0
+PRIORITY_READ = 1
+PRIORITY_SEARCH = 2
+PRIORITY_NAMES = ('write', 'read', 'search')
+QUEUE_TIMEOUTS = (OVERLOAD_QUEUE_TIMEOUT, OVERLOAD_QUEUE_TIMEOUT / 2, OVERLOAD_LOW_PRIORITY_QUEUE_TIMEOUT)
+
+# The writes, whatever their method: the services take most of them as GETs,
+# and POST /search/batch is a read.
+WRITE_ROUTES = frozenset([
+    ('apartments', 'add'),
+    ('apartments', 'remove'),
+    ('apartments', 'import'),
+    ('bookings', 'add'),
+    ('bookings', 'batch'),
+    ('bookings', 'change'),
+    ('bookings', 'cancel'),
+])
+
+_lock = threading.Lock()
+
+
+def _upstream_state():
+    return {
+        'limit': float(OVERLOAD_INITIAL_LIMIT),
+        'in_flight': 0,
+        'queues': tuple(deque() for _ in PRIORITY_NAMES),
+        'last_decrease': 0.0,
+        'breaker': 'closed',
+        'failures': 0,
+        'opened_at': 0.0,
+        'probing': False,
+        'stats': {
+            'admitted': 0,
+            'queued': 0,
+            'queue_ms_total': 0.0,
+            'max_queue_ms': 0.0,
+            'rejected': {'breaker_open': 0, 'shed': 0, 'queue_timeout': 0},
+            'rejected_by_priority': {name: 0 for name in PRIORITY_NAMES},
+            'successes': 0,
+            'failures': 0,
+            'slow': 0,
+            'breaker_opened': 0,
+        },
+    }
+
+
+_upstreams = {upstream: _upstream_state() for upstream in UPSTREAMS}
+
+
+def request_priority(method, upstream, path):
+    if (upstream, path) in WRITE_ROUTES:
+        return PRIORITY_WRITE
+    if upstream == 'search':
+        return PRIORITY_SEARCH
+    return PRIORITY_READ
+
+
+def _capacity(state, priority):
+    limit = max(OVERLOAD_MIN_LIMIT, int(state['limit']))
+    if priority == PRIORITY_SEARCH:
+        return max(1, int(limit * OVERLOAD_LOW_PRIORITY_SHARE))
+    return limit
+
+
+def _breaker_allows(state, now):
+    """Whether the breaker lets a request through; takes the probe slot when half open."""
+    if state['breaker'] == 'closed':
+        return True
+    if state['breaker'] == 'open':
+        if now - state['opened_at'] < OVERLOAD_BREAKER_COOLDOWN:
+            return False
+        state['breaker'] = 'half_open'
+        state['probing'] = False
+    if state['probing']:
+        return False
+    state['probing'] = True
+    return True
+
+
+def _retry_after(state, now):
+    if state['breaker'] == 'open':
+        return max(1, math.ceil(OVERLOAD_BREAKER_COOLDOWN - (now - state['opened_at'])))
+    return 1
+
+
+def _reject(state, priority, reason, now):
+    state['stats']['rejected'][reason] += 1
+    state['stats']['rejected_by_priority'][PRIORITY_NAMES[priority]] += 1
+    return None, {'reason': reason, 'retry_after': _retry_after(state, now)}
+
+
+def _ticket(upstream, priority, queued_at, now):
+    stats = _upstreams[upstream]['stats']
+    stats['admitted'] += 1
+    queue_ms = (now - queued_at) * 1000
+    stats['queue_ms_total'] += queue_ms
+    stats['max_queue_ms'] = max(stats['max_queue_ms'], queue_ms)
+    return {'upstream': upstream, 'priority': priority, 'admitted_at': now, 'observed': False, 'released': False}
+
+
+def _try_admit(upstream, priority, waiter):
+    """Under the lock: admit at once, queue waiter, or reject. Returns (ticket, rejection), both None when queued."""
+    state = _upstreams[upstream]
+    now = time.monotonic()
+
+    if not _breaker_allows(state, now):
+        return _reject(state, priority, 'breaker_open', now)
+
+    # Waiters of the same or a higher priority go first.
+    ahead = any(state['queues'][level] for level in range(priority + 1))
+    if not ahead and state['in_flight'] < _capacity(state, priority):
+        state['in_flight'] += 1
+        return _ticket(upstream, priority, now, now), None
+
+    if state['breaker'] == 'half_open':
+        # The probe only goes out if it can go out now.
+        state['probing'] = False
+        return _reject(state, priority, 'breaker_open', now)
+    if QUEUE_TIMEOUTS[priority] <= 0:
+        return _reject(state, priority, 'shed', now)
+
+    waiter['queued_at'] = now
+    state['queues'][priority].append(waiter)
+    state['stats']['queued'] += 1
+    return None, None
+
+
+def _hand_over(state):
+    """Under the lock: give free slots to the waiters, highest priority first."""
+    for priority, queue in enumerate(state['queues']):
+        while queue and state['in_flight'] < _capacity(state, priority):
+            waiter = queue.popleft()
+            state['in_flight'] += 1
+            waiter['granted_at'] = time.monotonic()
+            waiter['wake']()
+
+
+def _give_up(upstream, priority, waiter):
+    """Under the lock, once a waiter is woken or its queue timeout passed: its ticket, or the rejection."""
+    state = _upstreams[upstream]
+    if 'granted_at' in waiter:
+        return _ticket(upstream, priority, waiter['queued_at'], waiter['granted_at']), None
+
+    state['queues'][priority].remove(waiter)
+    return _reject(state, priority, 'queue_timeout', time.monotonic())
+
+
+def acquire(upstream, priority):
+    """Take a slot for a call to upstream, waiting on this thread for up to the priority's queue timeout."""
+    granted = threading.Event()
+    waiter = {'wake': granted.set}
+
+    with _lock:
+        ticket, rejection = _try_admit(upstream, priority, waiter)
+    if ticket is not None or rejection is not None:
+        return ticket, rejection
+
+    granted.wait(QUEUE_TIMEOUTS[priority])
+    with _lock:
+        return _give_up(upstream, priority, waiter)
+
+
+async def acquire_async(upstream, priority):
+    """Take a slot for a call to upstream, waiting on the event loop for up to the priority's queue timeout."""
+    loop = asyncio.get_running_loop()
+    granted = loop.create_future()
+
+    def wake():
+        loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+    waiter = {'wake': wake}
+    with _lock:
+        ticket, rejection = _try_admit(upstream, priority, waiter)
+    if ticket is not None or rejection is not None:
+        return ticket, rejection
+
+    try:
+        await asyncio.wait_for(asyncio.shield(granted), QUEUE_TIMEOUTS[priority])
+    except asyncio.TimeoutError:
+        pass
+    except asyncio.CancelledError:
+        # The client went away while waiting: hand back the slot if one came.
+        with _lock:
+            ticket, _ = _give_up(upstream, priority, waiter)
+        if ticket is not None:
+            release(ticket)
+        raise
+    with _lock:
+        return _give_up(upstream, priority, waiter)
+
+
+def observe(ticket, ok):
+    """Record how the call went: ok is False for connection errors, timeouts and 5xx responses."""
+    if ticket['observed']:
+        return
+    ticket['observed'] = True
+
+    with _lock:
+        state = _upstreams[ticket['upstream']]
+        stats = state['stats']
+        now = time.monotonic()
+        slow = now - ticket['admitted_at'] > OVERLOAD_LATENCY_TARGET
+        if slow:
+            stats['slow'] += 1
+
+        if ok:
+            stats['successes'] += 1
+            state['failures'] = 0
+            if state['breaker'] == 'half_open':
+                state['breaker'] = 'closed'
+                state['probing'] = False
+        else:
+            stats['failures'] += 1
+            state['failures'] += 1
+            if state['breaker'] == 'half_open' or (state['breaker'] == 'closed' and state['failures'] >= OVERLOAD_BREAKER_FAILURES):
+                state['breaker'] = 'open'
+                state['opened_at'] = now
+                state['probing'] = False
+                stats['breaker_opened'] += 1
+
+        if ok and not slow:
+            state['limit'] = min(OVERLOAD_MAX_LIMIT, state['limit'] + 1 / state['limit'])
+        elif now - state['last_decrease'] >= OVERLOAD_LATENCY_TARGET:
+            state['limit'] = max(OVERLOAD_MIN_LIMIT, state['limit'] * OVERLOAD_DECREASE_FACTOR)
+            state['last_decrease'] = now
+
+
+def release(ticket):
+    """Free the ticket's slot; calling it again does nothing."""
+    if ticket['released']:
+        return
+    ticket['released'] = True
+
+    with _lock:
+        state = _upstreams[ticket['upstream']]
+        state['in_flight'] -= 1
+        # A probe that never reported back does not keep the breaker half open forever.
+        if state['breaker'] == 'half_open' and not ticket['observed']:
+            state['probing'] = False
+        _hand_over(state)
+
+
+def get_overload_stats():
+    with _lock:
+        stats = {}
+        for upstream, state in _upstreams.items():
+            counts = state['stats']
+            stats[upstream] = dict(
+                counts,
+                rejected=dict(counts['rejected']),
+                rejected_by_priority=dict(counts['rejected_by_priority']),
+                avg_queue_ms=counts['queue_ms_total'] / counts['admitted'] if counts['admitted'] else None,
+                limit=round(state['limit'], 2),
+                in_flight=state['in_flight'],
+                waiting={name: len(queue) for name, queue in zip(PRIORITY_NAMES, state['queues'])},
+                breaker=state['breaker'],
+            )
+        return stats
@@ -0,0 +1,91 @@
+import pika # type: ignore
+import os
+import json
+import time
+from utils.cache import invalidate_apartments, invalidate_booking_windows, set_enabled, clear
+
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+APARTMENT_EXCHANGE = 'apartment_events'
+BOOKING_EXCHANGE = 'booking_events'
+
+
+def handle_apartment_event(event_type, data):
+    invalidate_apartments()
+
+
+def handle_booking_event(event_type, data):
+    if event_type == 'booking_added':
+        ranges = [(data.get('start_date'), data.get('end_date'))]
+    elif event_type == 'bookings_added':
+        fields = data.get('fields', [])
+        ranges = [
+            (booking.get('start_date'), booking.get('end_date'))
+            for booking in (dict(zip(fields, row)) for row in data.get('bookings', []))
+        ]
+    elif event_type == 'booking_changed':
+        ranges = [
+            (data.get('old_start_date'), data.get('old_end_date')),
+            (data.get('new_start_date'), data.get('new_end_date')),
+        ]
+    elif event_type == 'booking_canceled':
+        ranges = [(data.get('start_date'), data.get('end_date'))]
+    else:
+        ranges = []
+
+    invalidate_booking_windows(ranges)
+
+
+def listen_for_messages():
+    while True:
+        connection = None
+        try:
+            rabbit_credentials = pika.PlainCredentials(username="guest", password="guest")
+            rabbit_conn_params = pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=rabbit_credentials)
+
+            connection = pika.BlockingConnection(rabbit_conn_params)
+            channel = connection.channel()
+
+            channel.exchange_declare(exchange=APARTMENT_EXCHANGE, exchange_type='fanout')
+            channel.exchange_declare(exchange=BOOKING_EXCHANGE, exchange_type='fanout')
+
+            result = channel.queue_declare('', exclusive=True)
+            queue_name = result.method.queue
+            channel.queue_bind(exchange=APARTMENT_EXCHANGE, queue=queue_name)
+            channel.queue_bind(exchange=BOOKING_EXCHANGE, queue=queue_name)
+
+            # Events may have been missed while we were disconnected.
+            clear()
+            set_enabled(True)
+
+            def callback(ch, method, properties, body):
+                try:
+                    message = json.loads(body)
+                    event_type = message['event']
+                    data = message['data']
+
+                    if method.exchange == APARTMENT_EXCHANGE:
+                        handle_apartment_event(event_type, data)
+                    elif method.exchange == BOOKING_EXCHANGE:
+                        handle_booking_event(event_type, data)
+                except Exception as e:
+                    # What it changed is unknown, so nothing cached can be trusted.
+                    print(f"Skipping malformed event {body!r}: {e}. Clearing the cache.", flush=True)
+                    clear()
+
+            channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
+
+            print("Listening for cache invalidation events...", flush=True)
+            channel.start_consuming()
+        except Exception as e:
+            # Without the events nothing would invalidate: stop caching until reconnected.
+            set_enabled(False)
+            if isinstance(e, pika.exceptions.AMQPConnectionError):
+                print("RabbitMQ not available. Retrying in 3 seconds...", flush=True)
+            else:
+                print(f"Cache invalidation listener failed: {e}. Reconnecting in 3 seconds...", flush=True)
+            try:
+                if connection is not None and connection.is_open:
+                    connection.close()
+            except Exception:
+                pass
+            time.sleep(3)
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Per-client rate limiting: a token bucket for each client and route prefix.
+# A bucket holds up to `burst` tokens and refills at `rate` per second; each
+# request takes one, and a request that finds less than one is answered 429
+# with the time until the next token as Retry-After.
+#
+# Clients are told apart by their API key (RATE_LIMIT_KEY_HEADER), or by
+# their address when they send none. Buckets are kept in least recently
+# used order; one left alone for RATE_LIMIT_IDLE seconds has refilled and is
+# dropped, so memory follows the clients active in that time.
+# RATE_LIMIT_MAX_BUCKETS caps it when many addresses show up at once.
+#
+# Budgets are RATE_LIMIT_<PREFIX>=<rate>:<burst>, e.g. RATE_LIMIT_SEARCH=5:10.
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+RATE_LIMIT_KEY_HEADER = os.getenv('RATE_LIMIT_KEY_HEADER', 'X-API-Key')
+# Only behind a proxy that sets X-Forwarded-For; otherwise clients could pick their own address.
+RATE_LIMIT_TRUST_FORWARDED = os.getenv('RATE_LIMIT_TRUST_FORWARDED', 'false').lower() in ('1', 'true', 'yes')
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv('RATE_LIMIT_MAX_BUCKETS', '100000'))
+
+
+def parse_limit(value):
+    rate, _, burst = value.partition(':')
+    return float(rate), float(burst or rate)
+
+
+RATE_LIMITS = {
+    prefix: parse_limit(os.getenv(f'RATE_LIMIT_{prefix.upper()}', default))
+    for prefix, default in (
+        ('apartments', '50:100'),
+        ('bookings', '20:40'),
+        ('search', '10:20'),
+        ('composite', '10:20'),
+    )
+}
+
+# By then every bucket is full again, so dropping it loses nothing.
+RATE_LIMIT_IDLE = float(os.getenv('RATE_LIMIT_IDLE', str(max(burst / rate for rate, burst in RATE_LIMITS.values()))))
+
+_lock = threading.Lock()
+# (client, prefix) -> [tokens, monotonic time of the last update]
+_buckets = OrderedDict()
+_stats = {
+    'allowed': {prefix: 0 for prefix in RATE_LIMITS},
+    'limited': {prefix: 0 for prefix in RATE_LIMITS},
+    'evicted': 0,
+}
+
+
+def client_key(api_key, forwarded_for, remote_addr):
+    if api_key:
+        return 'key:' + api_key
+    if RATE_LIMIT_TRUST_FORWARDED and forwarded_for:
+        return 'ip:' + forwarded_for.split(',')[0].strip()
+    return 'ip:' + (remote_addr or '')
+
+
+def _evict(now):
+    """Under the lock: drop the buckets idle for RATE_LIMIT_IDLE, and the oldest ones past the cap."""
+    while _buckets:
+        key, bucket = next(iter(_buckets.items()))
+        if now - bucket[1] < RATE_LIMIT_IDLE and len(_buckets) < RATE_LIMIT_MAX_BUCKETS:
+            break
+        del _buckets[key]
+        _stats['evicted'] += 1
+
+
+def take(client, prefix):
+    """Take a token from client's bucket for prefix: 0 if the request may go on, else the seconds until it may."""
+    limit = RATE_LIMITS.get(prefix)
+    if limit is None or not RATE_LIMIT_ENABLED:
+        return 0
+
+    rate, burst = limit
+    key = (client, prefix)
+    now = time.monotonic()
+
+    with _lock:
+        _evict(now)
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = [burst, now]
+        else:
+            _buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            _stats['allowed'][prefix] += 1
+            return 0
+
+        _stats['limited'][prefix] += 1
+        return (1 - bucket[0]) / rate
+
+
+def get_rate_limit_stats():
+    with _lock:
+        return {
+            'enabled': RATE_LIMIT_ENABLED,
+            'limits': {prefix: {'rate': rate, 'burst': burst} for prefix, (rate, burst) in RATE_LIMITS.items()},
+            'allowed': dict(_stats['allowed']),
+            'limited': dict(_stats['limited']),
+            'buckets': len(_buckets),
+            'evicted': _stats['evicted'],
+        }
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+from utils.upstreams import UPSTREAMS, wants_ndjson
+
+
+# Request coalescing. Identical GETs that arrive while one of them is being
+# fetched from the upstream wait for that fetch instead of making their own,
+# and all of them get the same status, headers and body bytes. A body too
+# large to buffer is streamed to the first request only. Only routes
+# with bounded, buffered responses are coalesced; the NDJSON feeds, and
+# /apartments/list asked for as NDJSON, keep streaming one upstream call per
+# client.
+
+COALESCED_ROUTES = frozenset([
+    ('apartments', 'list'),
+    ('search', 'search'),
+])
+
+_lock = threading.Lock()
+_flights = {}
+_tasks = {}
+_stats = {
+    upstream: {'upstream_calls': 0, 'coalesced': 0, 'max_waiters': 0}
+    for upstream in UPSTREAMS
+}
+
+
+def is_coalesced(method, upstream, path, query_pairs, accept):
+    return method == 'GET' and (upstream, path) in COALESCED_ROUTES and not wants_ndjson(query_pairs, accept)
+
+
+def flight_key(method, upstream, path, query_pairs, accept, if_none_match, generation):
+    # Parameter order does not change the response. The cache generation keeps
+    # requests that arrive after an invalidation from joining a fetch that
+    # started before it.
+    return (method, upstream, path, tuple(sorted(query_pairs)), accept or '', if_none_match or '', generation)
+
+
+def _count(key, coalesced, waiters=0):
+    stats = _stats[key[1]]
+    if coalesced:
+        stats['coalesced'] += 1
+    else:
+        stats['upstream_calls'] += 1
+    stats['max_waiters'] = max(stats['max_waiters'], waiters)
+
+
+def _shared(result):
+    return result is not None and isinstance(result[2], bytes)
+
+
+def run_once(key, fetch):
+    """Return fetch(), or the result of the identical fetch already in flight for key."""
+    with _lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = {'done': threading.Event(), 'result': None, 'waiters': 0}
+            _count(key, False)
+            leader = True
+        else:
+            flight['waiters'] += 1
+            _count(key, True, flight['waiters'])
+            leader = False
+
+    if not leader:
+        flight['done'].wait()
+        return flight['result']
+
+    result = None
+    try:
+        result = fetch()
+    finally:
+        with _lock:
+            del _flights[key]
+        # A fetch that raised, or a streamed body, which only one client can
+        # read, leaves the waiters' result None; they then fetch on their own.
+        flight['result'] = result if _shared(result) else None
+        flight['done'].set()
+
+    return result
+
+
+async def run_once_async(key, fetch):
+    """Await fetch(), or the identical fetch already in flight for key.
+
+    The fetch runs as its own task, so a client that goes away does not
+    cancel it for the others. Returns None to a waiter that has to fetch on
+    its own.
+    """
+    task = _tasks.get(key)
+    leader = task is None
+
+    if leader:
+        task = _tasks[key] = asyncio.ensure_future(fetch())
+        task.add_done_callback(lambda _: _tasks.pop(key, None))
+        task.waiters = 0
+        _count(key, False)
+    else:
+        task.waiters += 1
+        _count(key, True, task.waiters)
+
+    result = await asyncio.shield(task)
+    # None for a waiter when the body was streamed to the first request.
+    return result if leader or _shared(result) else None
+
+
+def get_single_flight_stats():
+    with _lock:
+        stats = {upstream: dict(counts) for upstream, counts in _stats.items()}
+        in_flight = len(_flights) + len(_tasks)
+
+    for counts in stats.values():
+        requests = counts['upstream_calls'] + counts['coalesced']
+        counts['coalesced_ratio'] = counts['coalesced'] / requests if requests else None
+
+    return {'upstreams': stats, 'in_flight': in_flight}
@@ -0,0 +1,61 @@
+import os
+
+
+APARTMENT_SERVICE_URL = os.getenv('APARTMENT_SERVICE_URL', "http://apartments:5000")
+BOOKING_SERVICE_URL = os.getenv('BOOKING_SERVICE_URL', "http://booking:5000")
+SEARCH_SERVICE_URL = os.getenv('SEARCH_SERVICE_URL', "http://search:5000")
+
+UPSTREAMS = {
+    'apartments': APARTMENT_SERVICE_URL,
+    'bookings': BOOKING_SERVICE_URL,
+    'search': SEARCH_SERVICE_URL,
+}
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '100'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '2'))
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', '5'))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '65536'))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Headers that describe a single connection and must not be forwarded (RFC 7230, section 6.1).
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'proxy-connection',
+    'te',
+    'trailer',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+])
+
+
+def _connection_tokens(headers):
+    tokens = set()
+    for key, value in headers:
+        if key.lower() == 'connection':
+            tokens.update(token.strip().lower() for token in value.split(',') if token.strip())
+    return tokens
+
+
+def filter_request_headers(headers):
+    # Upstream bodies are always identity; the gateway does the content coding (see utils/encoding.py).
+    headers = list(headers)
+    dropped = HOP_BY_HOP_HEADERS | _connection_tokens(headers) | {'host', 'content-length', 'accept-encoding'}
+    return [(key, value) for key, value in headers if key.lower() not in dropped]
+
+
+def filter_response_headers(headers):
+    # The body is re-framed by our own server, so the upstream length is dropped as well.
+    headers = list(headers)
+    dropped = HOP_BY_HOP_HEADERS | _connection_tokens(headers) | {'content-length'}
+    return [(key, value) for key, value in headers if key.lower() not in dropped]
+
+
+def wants_ndjson(query_pairs, accept):
+    # The services' list routes answer format=ndjson, or an Accept that prefers
+    # NDJSON, with a feed. Any mention of it in Accept counts here: streaming
+    # is right for either format.
+    return ('format', 'ndjson') in query_pairs or NDJSON_MIMETYPE in (accept or '').lower()
@@ -1,8 +1,17 @@
-from flask import Flask, request, jsonify # type: ignore
+from flask import Flask, Response, request, jsonify, stream_with_context # type: ignore
 import threading
 import uuid
-from utils.rabbitmq import publish_message, listen_for_messages
-from utils.database import init_db, is_apartment_in_db, add_booking_to_db, change_booking_in_db, get_booking_apartment_from_db, is_apartment_available, cancel_booking_from_db, list_booking_from_db
+from utils.rabbitmq import start_outbox_relay, listen_for_messages, apply_events, get_publisher_stats, get_consumer_stats
+from utils.replication import catch_up_all
+from utils.dates import to_day
+from utils.database import init_db, load_apartment_ids_from_db, load_bookings_from_db, load_archived_before, iter_bookings_from_db, iter_bookings_snapshot, outbox_covers, iter_outbox_events
+from utils.index import build_index, has_apartment, get_index_stats
+from utils.writer import create_booking, reschedule_booking, remove_booking, get_writer_stats
+from utils.batch import BATCH_MAX_ITEMS, BATCH_MODES, book_batch
+from utils.archive import start_archiver, get_archive_stats
+from utils.streaming import NDJSON_MIMETYPE, ndjson_lines, json_document
+from utils.db import get_pool_stats
+from utils.version import data_etag, is_not_modified, get_version_stats
 
 app = Flask(__name__)
 
@@ -17,22 +26,23 @@ def add_booking():
     if not apartment_id or not start_date or not end_date or not guest_name:
         return jsonify({'error': 'Missing required parameters'}), 400
 
-    apartment = is_apartment_in_db(apartment_id)
+    try:
+        start_day = to_day(start_date)
+        end_day = to_day(end_date)
+    except ValueError:
+        return jsonify({'error': 'Dates must be valid YYYY-MM-DD values'}), 400
+
+    if start_day > end_day:
+        return jsonify({'error': 'The start date must not be after the end date'}), 400
 
-    if not apartment:
+    if not has_apartment(apartment_id):
         return jsonify({'error': 'Invalid apartment ID'}), 404
 
     try:
         booking_id = str(uuid.uuid4())
-        add_booking_to_db(booking_id, apartment_id, start_date, end_date, guest_name)
 
-        publish_message("booking_added", {
-            "booking_id": booking_id,
-            "apartment_id": apartment_id,
-            "start_date": start_date,
-            "end_date": end_date,
-            "guest_name": guest_name,
-        })
+        if not create_booking(booking_id, apartment_id, start_day, end_day, guest_name):
+            return jsonify({'error': 'Apartment is not available during the requested timeframe'}), 409
 
         return jsonify({'message': 'Booking added successfully'}), 201
 
@@ -40,6 +50,34 @@ def add_booking():
         return jsonify({'error': str(e)}), 500
     
     
+@app.route('/batch', methods=['POST'])
+def add_bookings():
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict) or not isinstance(body.get('bookings'), list):
+        return jsonify({'error': 'Expected a JSON object with a "bookings" list'}), 400
+
+    items = body['bookings']
+    mode = body.get('mode', 'atomic')
+
+    if mode not in BATCH_MODES:
+        return jsonify({'error': f"mode must be one of: {', '.join(BATCH_MODES)}"}), 400
+
+    if not items:
+        return jsonify({'error': 'The batch is empty'}), 400
+
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f"At most {BATCH_MAX_ITEMS} bookings per batch"}), 413
+
+    try:
+        booked, errors = book_batch(items, mode)
+
+        return jsonify({'mode': mode, 'booked': booked, 'errors': errors}), 201 if booked else 409
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/change', methods=['GET'])
 def change_booking():
     booking_id = request.args.get('id')
@@ -50,21 +88,22 @@ def change_booking():
         return jsonify({'error': 'Missing required parameters'}), 400
 
     try:
-        apartment_id = get_booking_apartment_from_db(booking_id)
+        new_start_day = to_day(new_start_date)
+        new_end_day = to_day(new_end_date)
+    except ValueError:
+        return jsonify({'error': 'Dates must be valid YYYY-MM-DD values'}), 400
+
+    if new_start_day > new_end_day:
+        return jsonify({'error': 'The start date must not be after the end date'}), 400
 
-        if apartment_id is None:
+    try:
+        changed = reschedule_booking(booking_id, new_start_day, new_end_day)
+
+        if changed is None:
             return jsonify({'error': 'Booking not found'}), 404
 
-        if not is_apartment_available(apartment_id, new_start_date, new_end_date, booking_id):
+        if not changed:
             return jsonify({'error': 'Apartment is not available during the requested timeframe'}), 409
-        
-        change_booking_in_db(booking_id, new_start_date, new_end_date)
-
-        publish_message("booking_changed", {
-            "booking_id": booking_id,
-            "new_start_date": new_start_date,
-            "new_end_date": new_end_date,
-        })
 
         return jsonify({'message': 'Booking updated successfully'}), 200
 
@@ -80,15 +119,11 @@ def cancel_booking():
         return jsonify({'error': 'Missing required parameter: id'}), 400
     
     try:
-        booking = cancel_booking_from_db(booking_id)
+        booking = remove_booking(booking_id)
 
         if booking is None:
             return jsonify({'error': 'Booking not found'}), 404
 
-        publish_message("booking_canceled", {
-            "booking_id": booking_id
-        })
-
         return jsonify({'message': 'Booking removed successfully'}), 200
 
     except Exception as e:
@@ -97,9 +132,56 @@ def cancel_booking():
 
 @app.route('/list', methods=['GET'])
 def list_bookings():
-    booking_list = list_booking_from_db()
+    after = request.args.get('after')
+    limit = request.args.get('limit', type=int)
+    # Past bookings are archived; history=true lists them too.
+    history = request.args.get('history', 'false').lower() in ('1', 'true', 'yes')
+    # apartment=<id>, repeatable, lists only the bookings of those apartments.
+    apartment_ids = request.args.getlist('apartment') or None
+
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
+
+    ndjson = request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == NDJSON_MIMETYPE
+    # Taken before the query: a change made while it runs gives the next request a new tag.
+    etag = data_etag(sorted(request.args.items(multi=True)), ndjson)
+    if is_not_modified(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers={'ETag': etag})
+
+    bookings = iter_bookings_from_db(after, limit, history, apartment_ids)
+
+    if ndjson:
+        return Response(stream_with_context(ndjson_lines(bookings)), mimetype=NDJSON_MIMETYPE, headers={'ETag': etag})
+
+    return Response(stream_with_context(json_document('bookings', bookings, limit)), mimetype='application/json', headers={'ETag': etag})
+
+
+@app.route('/snapshot', methods=['GET'])
+def snapshot():
+    # The first line carries the outbox sequence number the snapshot was taken at.
+    return Response(stream_with_context(ndjson_lines(iter_bookings_snapshot())), mimetype=NDJSON_MIMETYPE)
+
+
+@app.route('/events', methods=['GET'])
+def events():
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', type=int)
 
-    return jsonify({'bookings': booking_list}), 200
+    if after is None or after < 0:
+        return jsonify({'error': 'after must be a non-negative sequence number'}), 400
+
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
+
+    if not outbox_covers(after):
+        return jsonify({'error': 'Events after this sequence number are no longer available; load /snapshot instead'}), 410
+
+    return Response(stream_with_context(ndjson_lines(iter_outbox_events(after, limit))), mimetype=NDJSON_MIMETYPE)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({'publisher': get_publisher_stats(), 'consumer': get_consumer_stats(), 'writer': get_writer_stats(), 'index': get_index_stats(), 'archive': get_archive_stats(), 'db': get_pool_stats(), 'version': get_version_stats()}), 200
 
 
 @app.route('/')
@@ -109,6 +191,14 @@ def hello():
 
 init_db()
 
+catch_up_all(apply_events)
+
+build_index(load_apartment_ids_from_db(), load_bookings_from_db(), load_archived_before())
+
+start_outbox_relay()
+
+start_archiver()
+
 threading.Thread(target=listen_for_messages, daemon=True).start()
 
 if __name__ == "__main__":
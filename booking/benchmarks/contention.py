@@ -0,0 +1,109 @@
+"""Booking write contention benchmark.
+
+Books random stays from many concurrent clients against a scratch database
+and reports bookings/sec, once through the write engine (striped apartment
+locks plus group commit) and once with one BEGIN IMMEDIATE transaction per
+booking, which is how writes were done before the engine.
+
+    python benchmarks/contention.py --clients 1 8 64 --bookings 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.database import DATABASE, init_db, add_apartments_to_db, add_booking_to_db  # noqa: E402
+from utils.db import transaction, close_all  # noqa: E402
+from utils.index import build_index  # noqa: E402
+from utils.writer import create_booking, get_writer_stats  # noqa: E402
+
+
+def direct_booking(booking_id, apartment_id, start_day, end_day, guest_name):
+    with transaction(DATABASE) as conn:
+        return add_booking_to_db(conn, booking_id, apartment_id, start_day, end_day, guest_name)
+
+
+MODES = {
+    'engine': create_booking,
+    'direct': direct_booking,
+}
+
+
+def run(book, clients, bookings, apartments, seed):
+    rng = random.Random(seed)
+    # Short stays spread over two years: mostly free, with some real conflicts.
+    work = [
+        (rng.choice(apartments), day, day + rng.randint(1, 7))
+        for day in (738000 + rng.randrange(730) for _ in range(bookings))
+    ]
+    per_client = [work[index::clients] for index in range(clients)]
+    outcome = {'booked': 0, 'conflicts': 0}
+    outcome_lock = threading.Lock()
+    start = threading.Barrier(clients + 1)
+
+    def client(items):
+        booked = conflicts = 0
+        start.wait()
+        for apartment_id, start_day, end_day in items:
+            if book(str(uuid.uuid4()), apartment_id, start_day, end_day, 'benchmark'):
+                booked += 1
+            else:
+                conflicts += 1
+        with outcome_lock:
+            outcome['booked'] += booked
+            outcome['conflicts'] += conflicts
+
+    threads = [threading.Thread(target=client, args=(items,)) for items in per_client]
+    for thread in threads:
+        thread.start()
+
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return bookings / elapsed, outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--bookings', type=int, default=2000, help='booking attempts per run')
+    parser.add_argument('--apartments', type=int, default=500)
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=['direct', 'engine'])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'clients':>7} {'bookings/s':>12} {'booked':>8} {'conflicts':>10}")
+
+    for mode in args.modes:
+        for clients in args.clients:
+            # A fresh database per run, so every run sees the same free calendar.
+            with tempfile.TemporaryDirectory() as workdir:
+                os.chdir(workdir)
+                os.mkdir('data')
+                init_db()
+
+                apartments = [str(uuid.uuid4()) for _ in range(args.apartments)]
+                with transaction(DATABASE) as conn:
+                    add_apartments_to_db(conn, apartments)
+                build_index(apartments, [])
+
+                rate, outcome = run(MODES[mode], clients, args.bookings, apartments, args.seed)
+                print(f"{mode:<8} {clients:>7} {rate:>12.0f} {outcome['booked']:>8} {outcome['conflicts']:>10}", flush=True)
+
+                close_all()
+                os.chdir('/')
+
+    print(f"engine stats: {get_writer_stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+from datetime import date
+from utils.database import find_ended_bookings, count_bookings
+from utils.dates import from_day
+from utils.writer import archive_ended_bookings
+
+
+# Hot/cold split of the bookings. A background archiver moves the bookings
+# that have ended into bookings_archive, a chunk per transaction so writers
+# never wait long for the write lock, and drops them from the in-memory index.
+# Each chunk goes through the booking writer under its apartments' stripes.
+# Availability checks then only see the hot set, except for windows that
+# reach back before the archived day, which also probe the archive; /list
+# merges it back in with history=true.
+
+ARCHIVE_INTERVAL = float(os.getenv('BOOKINGS_ARCHIVE_INTERVAL', '3600'))
+# Bookings are archived once they ended more than this many days ago.
+ARCHIVE_AFTER_DAYS = int(os.getenv('BOOKINGS_ARCHIVE_AFTER_DAYS', '0'))
+ARCHIVE_CHUNK_SIZE = int(os.getenv('BOOKINGS_ARCHIVE_CHUNK_SIZE', '1000'))
+
+_stats_lock = threading.Lock()
+_stats = {
+    'runs': 0,
+    'failed_runs': 0,
+    'archived': 0,
+    'last_archived': 0,
+    'last_run_ms': None,
+    'max_run_ms': 0.0,
+    'total_run_ms': 0.0,
+    'hot_bookings': None,
+    'archived_bookings': None,
+}
+
+
+def archive_bookings():
+    """Move every booking that ended before the cut-off day; returns how many were moved."""
+    before_day = date.today().toordinal() - ARCHIVE_AFTER_DAYS
+    started = time.monotonic()
+    archived = 0
+
+    while True:
+        bookings = find_ended_bookings(before_day, ARCHIVE_CHUNK_SIZE)
+        archived += len(archive_ended_bookings(bookings, before_day))
+        if len(bookings) < ARCHIVE_CHUNK_SIZE:
+            break
+
+    hot, cold = count_bookings()
+    elapsed_ms = (time.monotonic() - started) * 1000
+
+    with _stats_lock:
+        _stats['runs'] += 1
+        _stats['archived'] += archived
+        _stats['last_archived'] = archived
+        _stats['last_run_ms'] = elapsed_ms
+        _stats['max_run_ms'] = max(_stats['max_run_ms'], elapsed_ms)
+        _stats['total_run_ms'] += elapsed_ms
+        _stats['hot_bookings'] = hot
+        _stats['archived_bookings'] = cold
+
+    print(f"Archived {archived} bookings that ended before {from_day(before_day)} in {elapsed_ms:.0f} ms.", flush=True)
+    return archived
+
+
+def _archiver_loop():
+    while True:
+        try:
+            archive_bookings()
+        except Exception as e:
+            print(f"Failed to archive past bookings: {e}", flush=True)
+            with _stats_lock:
+                _stats['failed_runs'] += 1
+
+        time.sleep(ARCHIVE_INTERVAL)
+
+
+def start_archiver():
+    threading.Thread(target=_archiver_loop, name='booking-archiver', daemon=True).start()
+
+
+def get_archive_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+
+    total_run_ms = stats.pop('total_run_ms')
+    stats['avg_run_ms'] = total_run_ms / stats['runs'] if stats['runs'] else None
+    stats['interval_s'] = ARCHIVE_INTERVAL
+    stats['after_days'] = ARCHIVE_AFTER_DAYS
+    return stats
@@ -0,0 +1,69 @@
+import os
+import uuid
+from utils.dates import to_day
+from utils.writer import create_bookings
+
+
+# Batch bookings: many (apartment, from, to, who) items checked and written
+# in one transaction. In atomic mode one rejected item rejects the batch, in
+# best_effort mode the remaining items are still booked.
+
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '1000'))
+BATCH_MODES = ('atomic', 'best_effort')
+
+
+def parse_item(item):
+    """Return ((apartment_id, start_day, end_day, guest_name), None) or (None, error)."""
+    if not isinstance(item, dict):
+        return None, 'Expected an object'
+
+    apartment_id = item.get('apartment')
+    start_date = item.get('from')
+    end_date = item.get('to')
+    guest_name = item.get('who')
+
+    if not all(isinstance(value, str) and value for value in (apartment_id, start_date, end_date, guest_name)):
+        return None, 'Missing required parameters'
+
+    try:
+        start_day = to_day(start_date)
+        end_day = to_day(end_date)
+    except ValueError:
+        return None, 'Dates must be valid YYYY-MM-DD values'
+
+    if start_day > end_day:
+        return None, 'The start date must not be after the end date'
+
+    return (apartment_id, start_day, end_day, guest_name), None
+
+
+def book_batch(items, mode):
+    """Book the items; returns (booked, errors) as lists of {position, ...}."""
+    atomic = mode == 'atomic'
+
+    bookings = []
+    positions = []
+    errors = {}
+    for position, item in enumerate(items):
+        values, error = parse_item(item)
+        if error is not None:
+            errors[position] = error
+            continue
+
+        bookings.append((str(uuid.uuid4()),) + values)
+        positions.append(position)
+
+    if bookings and not (atomic and errors):
+        for index, error in create_bookings(bookings, atomic).items():
+            errors[positions[index]] = error
+
+    if atomic and errors:
+        booked = []
+    else:
+        booked = [
+            {'position': position, 'id': booking[0]}
+            for position, booking in zip(positions, bookings)
+            if position not in errors
+        ]
+
+    return booked, [{'position': position, 'error': errors[position]} for position in sorted(errors)]
@@ -1,190 +1,514 @@
-import requests # type: ignore
-import sqlite3
+import json
 import os
+import threading
+import time
+import uuid
+from utils.dates import from_day
+from utils.db import connection, transaction, read_transaction
+from utils.migrations import run_migrations, MIGRATIONS
+from utils.streaming import chunks
 
 
 DATABASE = './data/bookings.db'
-APARTMENTS_SERVICE_URL = "http://apartments:5000/list"
+SERVICE_NAME = 'booking'
+# Published events are kept this long so replicas can catch up through /events.
+OUTBOX_RETENTION = float(os.getenv('OUTBOX_RETENTION', '86400'))
+INSERT_CHUNK_SIZE = 1000
+APPLIED_EVENTS_KEPT = int(os.getenv('APPLIED_EVENTS_KEPT', '100000'))
+# bookings_added carries rows as lists in this column order.
+BOOKING_EVENT_FIELDS = ["booking_id", "apartment_id", "start_date", "end_date", "guest_name"]
+
+outbox_ready = threading.Event()
 
 
 def init_db():
-    if not os.path.exists(DATABASE):
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bookings (
-                id TEXT PRIMARY KEY,
-                apartment_id TEXT NOT NULL,
-                start_date TEXT NOT NULL,
-                end_date TEXT NOT NULL,
-                guest_name TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS apartments (
-                id TEXT PRIMARY KEY
-            )
-        ''')
-        conn.commit()
-        conn.close()
+    with connection(DATABASE) as conn:
+        run_migrations(conn, MIGRATIONS)
 
-    initialize_apartments()
 
+def get_applied_seq(source):
+    with connection(DATABASE) as conn:
+        row = conn.execute('SELECT seq FROM replica_state WHERE source = ?', (source,)).fetchone()
 
-def initialize_apartments():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM apartments')
-    count = cursor.fetchone()[0]
+    return row[0] if row else None
 
-    if count == 0:
-        print("Initializing apartments from Apartments service...")
-        try:
-            response = requests.get(APARTMENTS_SERVICE_URL)
-            response.raise_for_status()
-            apartments = response.json().get('apartments', [])
 
-            for row in apartments:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO apartments (id)
-                    VALUES (?)
-                ''', (row['id'],))
+def get_applied_seqs(conn):
+    return dict(conn.execute('SELECT source, seq FROM replica_state').fetchall())
 
-            conn.commit()
-            print("Apartments initialized successfully.")
-        except Exception as e:
-            print(f"Failed to initialize apartments: {e}")
 
-    conn.close()
+def set_applied_seq(conn, source, seq):
+    conn.execute('INSERT OR REPLACE INTO replica_state (source, seq) VALUES (?, ?)', (source, seq))
 
 
-def is_apartment_available(apartment_id, new_start_date, new_end_date, booking_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM bookings
-        WHERE apartment_id = ?
-        AND id != ?
-        AND (
-            (start_date <= ? AND end_date >= ?)
-            OR (start_date <= ? AND end_date >= ?)
-            OR (start_date >= ? AND end_date <= ?)
-        )
-    ''', (apartment_id, booking_id, new_start_date, new_start_date, new_end_date, new_end_date, new_start_date, new_end_date))
-    overlapping_booking = cursor.fetchone()
-    conn.close()
-    return overlapping_booking is None
+def mark_event_applied(conn, event_id):
+    """Record event_id; False if it was applied before."""
+    if event_id is None:
+        return True
+
+    cursor = conn.execute('INSERT OR IGNORE INTO applied_events (event_id, applied_at) VALUES (?, ?)', (event_id, time.time()))
+    return cursor.rowcount == 1
+
+
+def prune_applied_events(conn):
+    conn.execute('''
+        DELETE FROM applied_events
+        WHERE rowid <= (SELECT MAX(rowid) FROM applied_events) - ?
+    ''', (APPLIED_EVENTS_KEPT,))
 
 
-def add_apartment_to_db(apartment_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+def add_dead_event(conn, message, error):
+    conn.execute(
+        'INSERT INTO dead_events (source, seq, event_id, message, error, failed_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (message.get('source'), message.get('seq'), message.get('event_id'), json.dumps(message), str(error), time.time())
+    )
+
+
+def load_apartments_snapshot(apartments, seq):
+    """Replace the local copy of the apartments with a snapshot taken at outbox position seq.
+
+    The rows are staged in chunked transactions and swapped in with the new
+    sequence number in one final transaction, so a failed load leaves the
+    previous copy and position untouched.
+    """
+    with transaction(DATABASE) as conn:
+        conn.execute('DROP TABLE IF EXISTS apartments_snapshot')
+        conn.execute('CREATE TABLE apartments_snapshot (id TEXT PRIMARY KEY)')
+
+    for chunk in chunks(apartments, INSERT_CHUNK_SIZE):
+        with transaction(DATABASE) as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO apartments_snapshot (id)
+                VALUES (?)
+            ''', [(row['id'],) for row in chunk])
+
+    with transaction(DATABASE) as conn:
+        conn.execute('DELETE FROM apartments')
+        conn.execute('INSERT INTO apartments (id) SELECT id FROM apartments_snapshot')
+        conn.execute('DROP TABLE apartments_snapshot')
+        conn.execute('INSERT OR REPLACE INTO replica_state (source, seq) VALUES (?, ?)', ('apartments', seq))
+
+
+def is_apartment_available(apartment_id, new_start_day, new_end_day, booking_id):
+    with connection(DATABASE) as conn:
+        return not _has_overlap(conn, apartment_id, new_start_day, new_end_day, booking_id)
+
+
+def write_outbox(cursor, event_type, data):
     cursor.execute('''
-        INSERT INTO apartments (id)
+        INSERT INTO outbox (event_id, event_type, payload, created_at)
+        VALUES (?, ?, ?, ?)
+    ''', (str(uuid.uuid4()), event_type, json.dumps(data), time.time()))
+
+
+def outbox_event(seq, event_id, event_type, payload):
+    return {
+        "event": event_type,
+        "data": json.loads(payload),
+        "seq": seq,
+        "event_id": event_id,
+        "source": SERVICE_NAME
+    }
+
+
+def _last_outbox_seq(conn):
+    # AUTOINCREMENT keeps the highest seq ever handed out, even after the rows are pruned.
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'outbox'").fetchone()
+    return row[0] if row else 0
+
+
+def fetch_outbox_batch(after_seq, limit):
+    with connection(DATABASE) as conn:
+        cursor = conn.execute('''
+            SELECT seq, event_id, event_type, payload FROM outbox
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+        ''', (after_seq, limit))
+        return cursor.fetchall()
+
+
+def get_published_seq():
+    with connection(DATABASE) as conn:
+        return conn.execute("SELECT value FROM outbox_state WHERE name = 'published_seq'").fetchone()[0]
+
+
+def mark_outbox_published(seq):
+    with transaction(DATABASE) as conn:
+        conn.execute("UPDATE outbox_state SET value = MAX(value, ?) WHERE name = 'published_seq'", (seq,))
+        conn.execute('DELETE FROM outbox WHERE seq <= ? AND created_at < ?', (seq, time.time() - OUTBOX_RETENTION))
+
+
+def count_outbox():
+    with connection(DATABASE) as conn:
+        return conn.execute('''
+            SELECT COUNT(*) FROM outbox
+            WHERE seq > (SELECT value FROM outbox_state WHERE name = 'published_seq')
+        ''').fetchone()[0]
+
+
+def outbox_covers(after_seq):
+    """Whether every event after after_seq is still in the outbox."""
+    with read_transaction(DATABASE) as conn:
+        first_seq = conn.execute('SELECT MIN(seq) FROM outbox').fetchone()[0]
+        last_seq = _last_outbox_seq(conn)
+
+    if first_seq is None:
+        return after_seq == last_seq
+    return first_seq - 1 <= after_seq <= last_seq
+
+
+def iter_outbox_events(after_seq, limit=None, batch_size=500):
+    with connection(DATABASE) as conn:
+        cursor = conn.execute('''
+            SELECT seq, event_id, event_type, payload FROM outbox
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+        ''', (after_seq, -1 if limit is None else limit))
+
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield outbox_event(*row)
+        finally:
+            cursor.close()
+
+
+def add_apartment_to_db(conn, apartment_id):
+    conn.execute('''
+        INSERT OR IGNORE INTO apartments (id)
         VALUES (?)
-    ''', (apartment_id))
-    conn.commit()
-    conn.close()
+    ''', (apartment_id,))
+
+
+def load_apartment_ids_from_db():
+    with connection(DATABASE) as conn:
+        return [row[0] for row in conn.execute('SELECT id FROM apartments')]
+
+
+def load_bookings_from_db():
+    with connection(DATABASE) as conn:
+        return conn.execute('SELECT id, apartment_id, start_date, end_date FROM bookings').fetchall()
 
 
 def is_apartment_in_db(apartment_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM apartments WHERE id = ?', (apartment_id,))
-    apartment = cursor.fetchone()
+    with connection(DATABASE) as conn:
+        return conn.execute('SELECT * FROM apartments WHERE id = ?', (apartment_id,)).fetchone()
 
-    return apartment
 
+def add_apartments_to_db(conn, apartment_ids):
+    conn.executemany('''
+        INSERT OR IGNORE INTO apartments (id)
+        VALUES (?)
+    ''', [(apartment_id,) for apartment_id in apartment_ids])
 
-def remove_apartment_from_db(apartment_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM apartments WHERE id = ?', (apartment_id,))
-    apartment = cursor.fetchone()
 
-    if apartment is None:
-        conn.close()
-        return None
+def remove_apartment_from_db(conn, apartment_id):
+    conn.execute('DELETE FROM apartments WHERE id = ?', (apartment_id,))
 
-    cursor.execute('DELETE FROM apartments WHERE id = ?', (apartment_id,))
-    conn.commit()
-    conn.close()
-    return apartment
 
+def _has_overlap(conn, apartment_id, start_day, end_day, booking_id):
+    # Two bounded comparisons instead of an OR: a range scan on idx_bookings_apartment_dates.
+    # Archived stays are probed by end day, which for a window after all of them finds nothing at once.
+    return conn.execute('''
+        SELECT 1 FROM bookings
+        WHERE apartment_id = ?
+        AND start_date <= ?
+        AND end_date >= ?
+        AND id != ?
+        UNION ALL
+        SELECT 1 FROM bookings_archive
+        WHERE apartment_id = ?
+        AND end_date >= ?
+        AND start_date <= ?
+        AND id != ?
+        LIMIT 1
+    ''', (apartment_id, end_day, start_day, booking_id, apartment_id, start_day, end_day, booking_id)).fetchone() is not None
 
-def add_booking_to_db(id, apartment_id, start_date, end_date, guest_name):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('''
+
+# The booking writes below run inside the group-commit writer's transaction
+# (see utils/writer.py); they re-check conflicts under the write lock.
+
+def add_booking_to_db(conn, id, apartment_id, start_day, end_day, guest_name):
+    """Insert the booking unless it overlaps another one; returns False on a conflict."""
+    if _has_overlap(conn, apartment_id, start_day, end_day, id):
+        return False
+
+    conn.execute('''
+        INSERT INTO bookings (id, apartment_id, start_date, end_date, guest_name)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (id, apartment_id, start_day, end_day, guest_name))
+    write_outbox(conn, "booking_added", {
+        "booking_id": id,
+        "apartment_id": apartment_id,
+        "start_date": from_day(start_day),
+        "end_date": from_day(end_day),
+        "guest_name": guest_name,
+    })
+    return True
+
+
+def add_bookings_to_db(conn, bookings, atomic):
+    """Check and insert a batch of (id, apartment_id, start_day, end_day, guest_name) rows.
+
+    Unknown apartments and overlaps, with existing bookings or with earlier
+    items of the same batch, are found with set-based queries against a
+    temporary table. Returns {position: error} for the rejected items; when
+    atomic and anything is rejected, nothing is written.
+    """
+    conn.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS batch_bookings (
+            position INTEGER PRIMARY KEY,
+            id TEXT NOT NULL,
+            apartment_id TEXT NOT NULL,
+            start_date INTEGER NOT NULL,
+            end_date INTEGER NOT NULL,
+            guest_name TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS temp.idx_batch_bookings_apartment ON batch_bookings (apartment_id, start_date)')
+    conn.execute('DELETE FROM batch_bookings')
+    conn.executemany('''
+        INSERT INTO batch_bookings (position, id, apartment_id, start_date, end_date, guest_name)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(position,) + tuple(booking) for position, booking in enumerate(bookings)])
+
+    errors = {}
+    for (position,) in conn.execute('''
+        SELECT position FROM batch_bookings
+        WHERE apartment_id NOT IN (SELECT id FROM apartments)
+    '''):
+        errors[position] = 'Invalid apartment ID'
+
+    for (position,) in conn.execute('''
+        SELECT n.position FROM batch_bookings AS n
+        WHERE EXISTS (
+            SELECT 1 FROM bookings AS b
+            WHERE b.apartment_id = n.apartment_id
+                AND b.start_date <= n.end_date
+                AND b.end_date >= n.start_date
+        ) OR EXISTS (
+            SELECT 1 FROM bookings_archive AS a
+            WHERE a.apartment_id = n.apartment_id
+                AND a.end_date >= n.start_date
+                AND a.start_date <= n.end_date
+        )
+    '''):
+        errors.setdefault(position, 'Apartment is not available during the requested timeframe')
+
+    # Overlaps inside the batch: the earlier item wins, unless it was rejected itself.
+    clashes = conn.execute('''
+        SELECT later.position, earlier.position FROM batch_bookings AS later
+        JOIN batch_bookings AS earlier
+            ON earlier.apartment_id = later.apartment_id
+            AND earlier.position < later.position
+            AND earlier.start_date <= later.end_date
+            AND earlier.end_date >= later.start_date
+        ORDER BY later.position
+    ''').fetchall()
+    for later, earlier in clashes:
+        if earlier not in errors and later not in errors:
+            errors[later] = f"Overlaps item {earlier} of this batch"
+
+    conn.execute('DELETE FROM batch_bookings')
+
+    accepted = [booking for position, booking in enumerate(bookings) if position not in errors]
+    if not accepted or (atomic and errors):
+        return errors
+
+    conn.executemany('''
         INSERT INTO bookings (id, apartment_id, start_date, end_date, guest_name)
         VALUES (?, ?, ?, ?, ?)
-    ''', (id, apartment_id, start_date, end_date, guest_name))
-    conn.commit()
-    conn.close()
+    ''', accepted)
+    write_outbox(conn, "bookings_added", {
+        "fields": BOOKING_EVENT_FIELDS,
+        "bookings": [
+            [id, apartment_id, from_day(start_day), from_day(end_day), guest_name]
+            for id, apartment_id, start_day, end_day, guest_name in accepted
+        ]
+    })
+    return errors
 
 
 def get_booking_apartment_from_db(booking_id):
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
+    with connection(DATABASE) as conn:
+        booking = conn.execute('SELECT apartment_id FROM bookings WHERE id = ?', (booking_id,)).fetchone()
 
-        cursor.execute('SELECT apartment_id FROM bookings WHERE id = ?', (booking_id,))
-        booking = cursor.fetchone()
+    if booking is None:
+        return None
 
-        if booking is None:
-            conn.close()
-            return None
+    apartment_id = booking[0]
+    return apartment_id
 
-        apartment_id = booking[0]
-        return apartment_id
 
-def change_booking_in_db(new_start_date, new_end_date, booking_id):
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
+def change_booking_in_db(conn, booking_id, new_start_day, new_end_day):
+    """Move the booking to new dates; None if it does not exist, False on a conflict."""
+    booking = conn.execute(
+        'SELECT apartment_id, start_date, end_date FROM bookings WHERE id = ?', (booking_id,)
+    ).fetchone()
 
-        cursor.execute('''
-            UPDATE bookings
-            SET start_date = ?, end_date = ?
-            WHERE id = ?
-        ''', (new_start_date, new_end_date, booking_id))
+    if booking is None:
+        return None
+
+    apartment_id, old_start_day, old_end_day = booking
 
-        conn.commit()
-        conn.close()
+    if _has_overlap(conn, apartment_id, new_start_day, new_end_day, booking_id):
+        return False
 
+    conn.execute('''
+        UPDATE bookings
+        SET start_date = ?, end_date = ?
+        WHERE id = ?
+    ''', (new_start_day, new_end_day, booking_id))
+    write_outbox(conn, "booking_changed", {
+        "booking_id": booking_id,
+        "apartment_id": apartment_id,
+        "old_start_date": from_day(old_start_day),
+        "old_end_date": from_day(old_end_day),
+        "new_start_date": from_day(new_start_day),
+        "new_end_date": from_day(new_end_day),
+    })
+    return True
 
-def cancel_booking_from_db(booking_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM bookings WHERE id = ?', (booking_id,))
-    booking = cursor.fetchone()
+
+def cancel_booking_from_db(conn, booking_id):
+    booking = conn.execute('SELECT * FROM bookings WHERE id = ?', (booking_id,)).fetchone()
 
     if booking is None:
-        conn.close()
         return None
 
-    cursor.execute('DELETE FROM bookings WHERE id = ?', (booking_id,))
+    conn.execute('DELETE FROM bookings WHERE id = ?', (booking_id,))
+    write_outbox(conn, "booking_canceled", {
+        "booking_id": booking_id,
+        "apartment_id": booking[1],
+        "start_date": from_day(booking[2]),
+        "end_date": from_day(booking[3]),
+    })
+    return booking
+
 
-    conn.commit()
-    conn.close()
+def _booking(row):
+    return {
+        'id': row[0],
+        'apartment_id': row[1],
+        'start_date': from_day(row[2]),
+        'end_date': from_day(row[3]),
+        'guest_name': row[4]
+    }
+
+
+def iter_bookings_from_db(after=None, limit=None, history=False, apartment_ids=None, batch_size=500):
+    """Yield bookings in id order, reading the cursor in batches rather than all at once.
+
+    With history the archived bookings are merged in, each booking marked
+    with whether it is archived. apartment_ids limits them to those apartments.
+    """
+    if apartment_ids is None:
+        apartment_filter = ''
+        apartment_params = ()
+    else:
+        apartment_filter = 'AND apartment_id IN (SELECT value FROM json_each(?))'
+        apartment_params = (json.dumps(list(apartment_ids)),)
+
+    with connection(DATABASE) as conn:
+        if history:
+            cursor = conn.execute(f'''
+                SELECT id, apartment_id, start_date, end_date, guest_name, 0 FROM bookings
+                WHERE id > ? {apartment_filter}
+                UNION ALL
+                SELECT id, apartment_id, start_date, end_date, guest_name, 1 FROM bookings_archive
+                WHERE id > ? {apartment_filter}
+                ORDER BY id
+                LIMIT ?
+            ''', (after or '',) + apartment_params + (after or '',) + apartment_params + (-1 if limit is None else limit,))
+        else:
+            cursor = conn.execute(f'''
+                SELECT id, apartment_id, start_date, end_date, guest_name FROM bookings
+                WHERE id > ? {apartment_filter}
+                ORDER BY id
+                LIMIT ?
+            ''', (after or '',) + apartment_params + (-1 if limit is None else limit,))
+
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    booking = _booking(row)
+                    if history:
+                        booking['archived'] = bool(row[5])
+                    yield booking
+        finally:
+            cursor.close()
+
+
+def iter_bookings_snapshot(batch_size=500):
+    """Yield a header with the outbox position, then every booking, all read from one snapshot.
+
+    Archived bookings are included: replicas rebuild their own archive from
+    them.
+    """
+    with read_transaction(DATABASE) as conn:
+        yield {'source': SERVICE_NAME, 'seq': _last_outbox_seq(conn)}
+
+        cursor = conn.execute('''
+            SELECT id, apartment_id, start_date, end_date, guest_name FROM bookings
+            UNION ALL
+            SELECT id, apartment_id, start_date, end_date, guest_name FROM bookings_archive
+            ORDER BY id
+        ''')
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield _booking(row)
+        finally:
+            cursor.close()
+
+
+def load_archived_before():
+    with connection(DATABASE) as conn:
+        return conn.execute("SELECT value FROM archive_state WHERE name = 'archived_before'").fetchone()[0]
+
+
+def find_ended_bookings(before_day, limit):
+    """Up to limit (id, apartment_id) of the bookings that ended before before_day."""
+    with read_transaction(DATABASE) as conn:
+        return conn.execute('SELECT id, apartment_id FROM bookings WHERE end_date < ? LIMIT ?', (before_day, limit)).fetchall()
+
+
+def archive_bookings_in_db(conn, before_day, booking_ids):
+    """Move those of booking_ids that still ended before before_day into bookings_archive; returns their ids."""
+    conn.execute("UPDATE archive_state SET value = MAX(value, ?) WHERE name = 'archived_before'", (before_day,))
+
+    params = (json.dumps(booking_ids), before_day)
+    moved = [row[0] for row in conn.execute('SELECT id FROM bookings WHERE id IN (SELECT value FROM json_each(?)) AND end_date < ?', params)]
+    if moved:
+        params = (json.dumps(moved),)
+        conn.execute('''
+            INSERT OR REPLACE INTO bookings_archive (id, apartment_id, start_date, end_date, guest_name)
+            SELECT id, apartment_id, start_date, end_date, guest_name FROM bookings
+            WHERE id IN (SELECT value FROM json_each(?))
+        ''', params)
+        conn.execute('DELETE FROM bookings WHERE id IN (SELECT value FROM json_each(?))', params)
+
+    return moved
 
-    return booking
 
+def count_bookings():
+    """(hot, archived) booking counts."""
+    with read_transaction(DATABASE) as conn:
+        hot = conn.execute('SELECT COUNT(*) FROM bookings').fetchone()[0]
+        archived = conn.execute('SELECT COUNT(*) FROM bookings_archive').fetchone()[0]
 
-def list_booking_from_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM bookings')
-    bookings = cursor.fetchall()
-    conn.close()
-
-    booking_list = [
-        {
-            'id': row[0],
-            'apartment_id': row[1],
-            'start_date': row[2],
-            'end_date': row[3],
-            'guest_name': row[4]
-        }
-        for row in bookings
-    ]
-
-    return booking_list
\ No newline at end of file
+    return hot, archived
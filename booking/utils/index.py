@@ -0,0 +1,251 @@
+import bisect
+import sys
+import threading
+from utils.dates import from_day
+from utils.database import is_apartment_in_db, is_apartment_available, get_booking_apartment_from_db
+from utils.version import bump_version
+
+
+# Warm in-memory view of the booking database, so validating a write needs
+# no disk reads: the set of known apartment ids and, per apartment, the
+# bookings sorted by start day with a running maximum of their end days.
+# Everything starting on or before `to` is a prefix of the list; walking that
+# prefix backwards can stop as soon as the running maximum drops below
+# `from`, so an overlap check only visits bookings that actually overlap.
+# Until build_index() has run the lookups fall back to SQLite.
+#
+# Only the hot set is kept: bookings that ended before _archived_before are
+# moved out by the archiver, so checks of windows reaching back before it go
+# to SQLite, which also looks at the archive.
+#
+# Every booking change reaches the index once committed, so it is also where
+# the data version behind the /list ETags is bumped.
+
+_lock = threading.RLock()
+_ready = False
+_archived_before = 0
+_apartments = set()
+_bookings = {}
+_intervals = {}
+_stats = {
+    'apartment_lookups': 0,
+    'unknown_apartments': 0,
+    'availability_checks': 0,
+    'conflicts': 0,
+    'booking_lookups': 0,
+    'fallbacks': 0,
+}
+
+
+def _new_intervals():
+    return {'starts': [], 'entries': [], 'max_ends': []}
+
+
+def _refresh_max_ends(intervals, position):
+    entries = intervals['entries']
+    max_ends = intervals['max_ends']
+    del max_ends[position:]
+
+    current = max_ends[-1] if max_ends else None
+    for _, end, _ in entries[position:]:
+        current = end if current is None or end > current else current
+        max_ends.append(current)
+
+
+def _insert_interval(apartment_id, booking_id, start_day, end_day):
+    intervals = _intervals.setdefault(apartment_id, _new_intervals())
+    entry = (start_day, end_day, booking_id)
+    position = bisect.bisect_right(intervals['entries'], entry)
+    intervals['entries'].insert(position, entry)
+    intervals['starts'].insert(position, start_day)
+    _refresh_max_ends(intervals, position)
+
+
+def _remove_interval(apartment_id, booking_id, start_day, end_day):
+    intervals = _intervals.get(apartment_id)
+    if intervals is None:
+        return
+
+    entry = (start_day, end_day, booking_id)
+    position = bisect.bisect_left(intervals['entries'], entry)
+    if position < len(intervals['entries']) and intervals['entries'][position] == entry:
+        del intervals['entries'][position]
+        del intervals['starts'][position]
+        _refresh_max_ends(intervals, position)
+
+    if not intervals['entries']:
+        del _intervals[apartment_id]
+
+
+def build_index(apartment_ids, bookings, archived_before=0):
+    global _ready, _archived_before
+
+    with _lock:
+        _archived_before = archived_before
+        _apartments.clear()
+        _bookings.clear()
+        _intervals.clear()
+
+        _apartments.update(apartment_ids)
+
+        for booking_id, apartment_id, start_day, end_day in sorted(bookings, key=lambda row: (row[1], row[2], row[3], row[0])):
+            _bookings[booking_id] = (apartment_id, start_day, end_day)
+            intervals = _intervals.setdefault(apartment_id, _new_intervals())
+            intervals['entries'].append((start_day, end_day, booking_id))
+            intervals['starts'].append(start_day)
+
+        for intervals in _intervals.values():
+            _refresh_max_ends(intervals, 0)
+
+        _ready = True
+
+
+def index_set_apartments(apartment_ids):
+    with _lock:
+        _apartments.clear()
+        _apartments.update(apartment_ids)
+
+
+def index_add_apartments(apartment_ids):
+    with _lock:
+        _apartments.update(apartment_ids)
+
+
+def index_remove_apartment(apartment_id):
+    with _lock:
+        _apartments.discard(apartment_id)
+
+
+def index_add_booking(booking_id, apartment_id, start_day, end_day):
+    with _lock:
+        index_remove_booking(booking_id)
+        _bookings[booking_id] = (apartment_id, start_day, end_day)
+        _insert_interval(apartment_id, booking_id, start_day, end_day)
+        bump_version()
+
+
+def index_change_booking(booking_id, new_start_day, new_end_day):
+    with _lock:
+        booking = _bookings.get(booking_id)
+        if booking is None:
+            return
+        index_add_booking(booking_id, booking[0], new_start_day, new_end_day)
+
+
+def index_remove_booking(booking_id):
+    with _lock:
+        booking = _bookings.pop(booking_id, None)
+        if booking is not None:
+            _remove_interval(booking[0], booking_id, booking[1], booking[2])
+            bump_version()
+
+
+def index_archive_bookings(booking_ids, archived_before):
+    """Drop bookings moved to the archive, which holds everything that ended before archived_before."""
+    global _archived_before
+
+    with _lock:
+        _archived_before = max(_archived_before, archived_before)
+        bump_version()
+
+        apartment_ids = set()
+        for booking_id in booking_ids:
+            booking = _bookings.pop(booking_id, None)
+            if booking is not None:
+                apartment_ids.add(booking[0])
+
+        # One rebuild per apartment rather than one list deletion per booking.
+        for apartment_id in apartment_ids:
+            intervals = _intervals[apartment_id]
+            intervals['entries'] = [entry for entry in intervals['entries'] if entry[2] in _bookings]
+            intervals['starts'] = [entry[0] for entry in intervals['entries']]
+            _refresh_max_ends(intervals, 0)
+
+            if not intervals['entries']:
+                del _intervals[apartment_id]
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def has_apartment(apartment_id):
+    if not _ready:
+        _count('fallbacks')
+        return is_apartment_in_db(apartment_id) is not None
+
+    with _lock:
+        _stats['apartment_lookups'] += 1
+        if apartment_id in _apartments:
+            return True
+        _stats['unknown_apartments'] += 1
+        return False
+
+
+def find_booking_apartment(booking_id):
+    if not _ready:
+        _count('fallbacks')
+        return get_booking_apartment_from_db(booking_id)
+
+    with _lock:
+        _stats['booking_lookups'] += 1
+        booking = _bookings.get(booking_id)
+        return booking[0] if booking is not None else None
+
+
+def is_free(apartment_id, start_day, end_day, booking_id):
+    """Whether no booking of the apartment other than booking_id overlaps [start_day, end_day]."""
+    if not _ready or start_day < _archived_before:
+        _count('fallbacks')
+        return is_apartment_available(apartment_id, start_day, end_day, booking_id)
+
+    with _lock:
+        _stats['availability_checks'] += 1
+
+        intervals = _intervals.get(apartment_id)
+        if intervals is None:
+            return True
+
+        position = bisect.bisect_right(intervals['starts'], end_day) - 1
+        while position >= 0 and intervals['max_ends'][position] >= start_day:
+            _, end, other_id = intervals['entries'][position]
+            if end >= start_day and other_id != booking_id:
+                _stats['conflicts'] += 1
+                return False
+            position -= 1
+
+        return True
+
+
+def _approximate_bytes():
+    # Containers are measured exactly, their entries from one sample each.
+    size = sys.getsizeof(_apartments) + sys.getsizeof(_bookings) + sys.getsizeof(_intervals)
+
+    if _apartments:
+        size += len(_apartments) * sys.getsizeof(next(iter(_apartments)))
+
+    if _bookings:
+        booking_id, booking = next(iter(_bookings.items()))
+        # The id string is shared with the interval entry, the tuples are not.
+        size += len(_bookings) * (sys.getsizeof(booking_id) + sys.getsizeof(booking) + sys.getsizeof((0, 0, booking_id)))
+
+    for intervals in _intervals.values():
+        size += sum(sys.getsizeof(values) for values in intervals.values())
+
+    return size
+
+
+def get_index_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['ready'] = _ready
+        stats['archived_before'] = from_day(_archived_before) if _archived_before else None
+        stats['apartments'] = len(_apartments)
+        stats['bookings'] = len(_bookings)
+        stats['apartments_with_bookings'] = len(_intervals)
+        stats['approximate_bytes'] = _approximate_bytes()
+
+    lookups = stats['apartment_lookups'] + stats['availability_checks'] + stats['booking_lookups']
+    stats['memory_hit_rate'] = lookups / (lookups + stats['fallbacks']) if lookups + stats['fallbacks'] else None
+    return stats
@@ -0,0 +1,194 @@
+from utils.dates import to_day_or_none
+
+
+# Schema changes are applied in order and recorded in PRAGMA user_version.
+# Each migration runs in its own BEGIN IMMEDIATE transaction against the
+# live database file, so an existing volume is upgraded in place on start-up
+# and a failed step leaves the previous version intact.
+
+def run_migrations(conn, migrations):
+    conn.isolation_level = None
+
+    for version, migration in enumerate(migrations, start=1):
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have applied it while we waited for the lock.
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                conn.execute('ROLLBACK')
+                continue
+
+            print(f"Applying migration {version}: {migration.__name__}", flush=True)
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+
+def create_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bookings (
+            id TEXT PRIMARY KEY,
+            apartment_id TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            guest_name TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS apartments (
+            id TEXT PRIMARY KEY
+        )
+    ''')
+
+
+def create_outbox(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+
+def convert_dates_to_days(conn):
+    conn.create_function('to_day', 1, to_day_or_none, deterministic=True)
+
+    conn.execute('''
+        CREATE TABLE bookings_rejected (
+            id TEXT,
+            apartment_id TEXT,
+            start_date TEXT,
+            end_date TEXT,
+            guest_name TEXT
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO bookings_rejected (id, apartment_id, start_date, end_date, guest_name)
+        SELECT id, apartment_id, start_date, end_date, guest_name FROM bookings
+        WHERE to_day(start_date) IS NULL
+            OR to_day(end_date) IS NULL
+            OR to_day(start_date) > to_day(end_date)
+    ''')
+    conn.execute('''
+        CREATE TABLE bookings_new (
+            id TEXT PRIMARY KEY,
+            apartment_id TEXT NOT NULL,
+            start_date INTEGER NOT NULL,
+            end_date INTEGER NOT NULL,
+            guest_name TEXT NOT NULL,
+            CHECK (start_date <= end_date)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO bookings_new (id, apartment_id, start_date, end_date, guest_name)
+        SELECT id, apartment_id, to_day(start_date), to_day(end_date), guest_name FROM bookings
+        WHERE to_day(start_date) IS NOT NULL
+            AND to_day(end_date) IS NOT NULL
+            AND to_day(start_date) <= to_day(end_date)
+    ''')
+    conn.execute('DROP TABLE bookings')
+    conn.execute('ALTER TABLE bookings_new RENAME TO bookings')
+    # Covers the overlap check: apartment_id is an equality, start_date a range, the rest is read from the index.
+    conn.execute('CREATE INDEX idx_bookings_apartment_dates ON bookings (apartment_id, start_date, end_date, id)')
+
+
+def create_outbox_state(conn):
+    # Published outbox rows are kept for a while so replicas can catch up from them.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    # Rows left in the outbox by the earlier relay have not been published yet.
+    conn.execute('''
+        INSERT OR IGNORE INTO outbox_state (name, value)
+        SELECT 'published_seq', COALESCE(
+            MIN(seq) - 1,
+            (SELECT seq FROM sqlite_sequence WHERE name = 'outbox'),
+            0
+        ) FROM outbox
+    ''')
+
+
+def create_replica_state(conn):
+    # The last source event reflected in the local copy, per source service.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS replica_state (
+            source TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )
+    ''')
+
+
+def create_applied_events(conn):
+    # Event ids already applied, so a redelivered message is a no-op. Only the most recent ids are kept.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS applied_events (
+            event_id TEXT PRIMARY KEY,
+            applied_at REAL NOT NULL
+        )
+    ''')
+
+
+def create_bookings_archive(conn):
+    # Bookings that ended before archive_state.archived_before are moved here
+    # by the archiver (utils/archive.py), so the bookings table only holds the
+    # hot set. Ordered by end day: an overlap probe for a window that starts
+    # after every archived stay ended is a single seek past the apartment's rows.
+    conn.execute('''
+        CREATE TABLE bookings_archive (
+            id TEXT PRIMARY KEY,
+            apartment_id TEXT NOT NULL,
+            start_date INTEGER NOT NULL,
+            end_date INTEGER NOT NULL,
+            guest_name TEXT NOT NULL,
+            CHECK (start_date <= end_date)
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_bookings_archive_apartment_ends ON bookings_archive (apartment_id, end_date, start_date, id)')
+    # Finds the bookings that have ended without scanning the hot set.
+    conn.execute('CREATE INDEX idx_bookings_end_date ON bookings (end_date)')
+    conn.execute('''
+        CREATE TABLE archive_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("INSERT INTO archive_state (name, value) VALUES ('archived_before', 0)")
+
+def create_dead_events(conn):
+    # Events that failed to apply even on their own. The replica moves its
+    # position past them so later events keep applying; they are kept here to
+    # be looked into and replayed by hand.
+    conn.execute('''
+        CREATE TABLE dead_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT,
+            seq INTEGER,
+            event_id TEXT,
+            message TEXT NOT NULL,
+            error TEXT NOT NULL,
+            failed_at REAL NOT NULL
+        )
+    ''')
+
+
+MIGRATIONS = [
+    create_base_tables,
+    create_outbox,
+    convert_dates_to_days,
+    create_outbox_state,
+    create_replica_state,
+    create_applied_events,
+    create_bookings_archive,
+    create_dead_events,
+]
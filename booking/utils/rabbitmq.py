@@ -1,52 +1,415 @@
 
 import pika # type: ignore
+import functools
 import json
+import sqlite3
+import queue
+import threading
 import time
 import os
-from utils.database import add_apartment_to_db, remove_apartment_from_db
+from utils.database import DATABASE, add_apartment_to_db, add_apartments_to_db, remove_apartment_from_db, get_applied_seqs, set_applied_seq, mark_event_applied, prune_applied_events, add_dead_event, outbox_ready, outbox_event, fetch_outbox_batch, get_published_seq, mark_outbox_published, count_outbox
+from utils.db import transaction
+from utils.index import index_add_apartments, index_remove_apartment
+from utils.replication import catch_up, catch_up_all
 
 
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
 APARTMENT_EXCHANGE = 'apartment_events'
 BOOKING_EXCHANGE = 'booking_events'
 
+PUBLISH_QUEUE_SIZE = int(os.getenv('PUBLISH_QUEUE_SIZE', '10000'))
+PUBLISH_BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE', '100'))
+PUBLISH_BATCH_WAIT = float(os.getenv('PUBLISH_BATCH_WAIT', '0.005'))
+RECONNECT_BACKOFF_MIN = 0.5
+RECONNECT_BACKOFF_MAX = 30.0
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1.0'))
 
-def publish_message(event_type, data):
-    max_retries = 5
-    for attempt in range(max_retries):
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', '1000'))
+CONSUMER_BATCH_SIZE = int(os.getenv('CONSUMER_BATCH_SIZE', '500'))
+CONSUMER_BATCH_WAIT = float(os.getenv('CONSUMER_BATCH_WAIT', '0.05'))
+CONSUMER_RETRY_DELAY = float(os.getenv('CONSUMER_RETRY_DELAY', '1.0'))
+
+_publish_queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+_publisher_thread = None
+_relay_thread = None
+_publisher_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    'published': 0,
+    'failed_batches': 0,
+    'reconnects': 0,
+    'connected': False,
+    'batches': 0,
+    'last_confirm_latency_ms': None,
+    'max_confirm_latency_ms': None,
+    'total_confirm_latency_ms': 0.0,
+    'outbox_relayed_seq': 0,
+    'outbox_confirmed_seq': 0,
+}
+_consumer_stats = {
+    'batches': 0,
+    'received': 0,
+    'applied': 0,
+    'duplicates': 0,
+    'gaps': 0,
+    'dead_lettered': 0,
+    'requeued_batches': 0,
+    'last_batch_size': 0,
+    'max_batch_size': 0,
+}
+
+
+def _start_publisher():
+    global _publisher_thread
+
+    with _publisher_lock:
+        if _publisher_thread is None or not _publisher_thread.is_alive():
+            _publisher_thread = threading.Thread(target=_publisher_loop, name='rabbitmq-publisher', daemon=True)
+            _publisher_thread.start()
+
+
+def _connect():
+    rabbit_credentials = pika.PlainCredentials(username="guest", password="guest")
+    rabbit_conn_params = pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=rabbit_credentials)
+
+    connection = pika.BlockingConnection(rabbit_conn_params)
+    channel = connection.channel()
+    channel.exchange_declare(exchange=BOOKING_EXCHANGE, exchange_type='fanout')
+    # A transaction per batch: the broker answers once for the whole of it,
+    # where confirms on a blocking channel wait on every message.
+    channel.tx_select()
+    return connection, channel
+
+
+def _next_batch():
+    batch = [_publish_queue.get()]
+    deadline = time.monotonic() + PUBLISH_BATCH_WAIT
+
+    while len(batch) < PUBLISH_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
         try:
-            print(f"Attempting to connect to RabbitMQ at {RABBITMQ_HOST}:5672... (attempt {attempt + 1})", flush=True)
+            if remaining > 0:
+                batch.append(_publish_queue.get(timeout=remaining))
+            else:
+                batch.append(_publish_queue.get_nowait())
+        except queue.Empty:
+            break
 
-            rabbit_credentials = pika.PlainCredentials(username="guest", password="guest")
-            rabbit_conn_params = pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=rabbit_credentials)
+    return batch
+
+
+def _record_batch(size, latency_ms):
+    with _stats_lock:
+        _stats['published'] += size
+        _stats['batches'] += 1
+        _stats['last_confirm_latency_ms'] = latency_ms
+        _stats['total_confirm_latency_ms'] += latency_ms
+        if _stats['max_confirm_latency_ms'] is None or latency_ms > _stats['max_confirm_latency_ms']:
+            _stats['max_confirm_latency_ms'] = latency_ms
+
+
+def _confirm_outbox(seq):
+    with _stats_lock:
+        _stats['outbox_confirmed_seq'] = seq
+
+    try:
+        mark_outbox_published(seq)
+    except Exception as e:
+        # The rows are re-sent after a restart; consumers skip sequence numbers they have applied.
+        print(f"Failed to mark the outbox published up to {seq}: {e}", flush=True)
+
+
+def _publisher_loop():
+    connection = None
+    channel = None
+    backoff = RECONNECT_BACKOFF_MIN
+    batch = None
+
+    while True:
+        if batch is None:
+            batch = _next_batch()
+
+        try:
+            if connection is None or connection.is_closed:
+                print(f"Connecting publisher to RabbitMQ at {RABBITMQ_HOST}:5672...", flush=True)
+                connection, channel = _connect()
+                backoff = RECONNECT_BACKOFF_MIN
+                with _stats_lock:
+                    _stats['connected'] = True
+
+            started = time.monotonic()
+            for message, _ in batch:
+                channel.basic_publish(exchange=BOOKING_EXCHANGE, routing_key='', body=message)
+            # Returns once the broker has taken every message of the batch.
+            channel.tx_commit()
+            _record_batch(len(batch), (time.monotonic() - started) * 1000)
+
+            confirmed_seq = max((seq for _, seq in batch if seq is not None), default=None)
+            batch = None
+            if confirmed_seq is not None:
+                _confirm_outbox(confirmed_seq)
 
-            connection = pika.BlockingConnection(rabbit_conn_params)
-            channel = connection.channel()
-            channel.exchange_declare(exchange=BOOKING_EXCHANGE, exchange_type='fanout')
-
-            message = json.dumps({"event": event_type, "data": data})
-            channel.basic_publish(exchange=BOOKING_EXCHANGE, routing_key='', body=message)
-            print(f"Message published: {message}", flush=True)
-            connection.close()
-            return
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"RabbitMQ connection error: {e}. Retrying in 3 seconds...", flush=True)
-            time.sleep(3)
         except Exception as e:
-            print(f"An unexpected error occurred while publishing the message: {e}", flush=True)
-            break
-    print("Failed to connect to RabbitMQ after multiple attempts. Message not published.", flush=True)
+            # Whatever went wrong, the batch is kept and sent again: its rows are
+            # only marked published once the broker has committed them.
+            print(f"RabbitMQ publish error: {e}. Reconnecting in {backoff:.1f} seconds...", flush=True)
+            with _stats_lock:
+                _stats['failed_batches'] += 1
+                _stats['reconnects'] += 1
+                _stats['connected'] = False
+            try:
+                if connection is not None and connection.is_open:
+                    connection.close()
+            except Exception:
+                pass
+            connection = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+
+def _outbox_relay_loop():
+    relayed_seq = None
+
+    while True:
+        try:
+            if relayed_seq is None:
+                relayed_seq = get_published_seq()
+            rows = fetch_outbox_batch(relayed_seq, PUBLISH_BATCH_SIZE)
+        except Exception as e:
+            print(f"Failed to read the outbox: {e}. Retrying in {OUTBOX_POLL_INTERVAL} seconds...", flush=True)
+            time.sleep(OUTBOX_POLL_INTERVAL)
+            continue
+
+        if not rows:
+            outbox_ready.wait(OUTBOX_POLL_INTERVAL)
+            outbox_ready.clear()
+            continue
+
+        for seq, event_id, event_type, payload in rows:
+            message = json.dumps(outbox_event(seq, event_id, event_type, payload))
+            # Blocks while the publish queue is full, so the outbox absorbs broker outages.
+            _publish_queue.put((message, seq))
+            relayed_seq = seq
+
+        with _stats_lock:
+            _stats['outbox_relayed_seq'] = relayed_seq
+
+
+def start_outbox_relay():
+    global _relay_thread
+
+    _start_publisher()
+    with _publisher_lock:
+        if _relay_thread is None or not _relay_thread.is_alive():
+            _relay_thread = threading.Thread(target=_outbox_relay_loop, name='outbox-relay', daemon=True)
+            _relay_thread.start()
+
+
+def get_publisher_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+
+    total_latency_ms = stats.pop('total_confirm_latency_ms')
+    stats['avg_confirm_latency_ms'] = total_latency_ms / stats['batches'] if stats['batches'] else None
+    stats['queue_depth'] = _publish_queue.qsize()
+    stats['queue_capacity'] = PUBLISH_QUEUE_SIZE
+    stats['outbox_backlog'] = count_outbox()
+    return stats
+
 
+# The handlers write through the batch's connection and return the matching
+# in-memory index update, which is applied only once the batch has committed.
 
-def handle_apartment_event(event_type, data):
+def handle_apartment_event(conn, event_type, data):
     apartment_id = data.get('apartment_id')
 
     if event_type == 'apartment_added':
-        add_apartment_to_db(apartment_id)
+        add_apartment_to_db(conn, apartment_id)
         print(f"Apartment {apartment_id} added to local copy.", flush=True)
+        return functools.partial(index_add_apartments, [apartment_id])
     elif event_type == 'apartment_removed':
-        remove_apartment_from_db(apartment_id)
+        remove_apartment_from_db(conn, apartment_id)
         print(f"Apartment {apartment_id} removed from local copy.", flush=True)
+        return functools.partial(index_remove_apartment, apartment_id)
+    elif event_type == 'apartments_added':
+        # A bulk import chunk: rows are lists in the order given by "fields".
+        id_column = data['fields'].index('apartment_id')
+        apartment_ids = [row[id_column] for row in data['apartments']]
+        add_apartments_to_db(conn, apartment_ids)
+        print(f"{len(apartment_ids)} apartments added to local copy.", flush=True)
+        return functools.partial(index_add_apartments, apartment_ids)
+
+
+EVENT_HANDLERS = {
+    'apartments': handle_apartment_event,
+}
+
+
+def apply_events(messages):
+    """Apply messages in one transaction and return the sources that need a catch-up.
+
+    Sequenced events are applied strictly in order: anything at or below the
+    recorded position is a redelivery, anything past the next position means
+    events were missed and is left for the catch-up to fetch.
+    """
+    gaps = set()
+    applied = 0
+    duplicates = 0
+    index_updates = []
+
+    with transaction(DATABASE) as conn:
+        positions = get_applied_seqs(conn)
+        advanced = {}
+
+        for message in messages:
+            source = message.get('source')
+            seq = message.get('seq')
+
+            if source not in EVENT_HANDLERS or source in gaps:
+                continue
+
+            if seq is not None:
+                applied_seq = advanced.get(source, positions.get(source))
+
+                if applied_seq is not None and seq <= applied_seq:
+                    duplicates += 1
+                    continue
+
+                if applied_seq is None or seq > applied_seq + 1:
+                    gaps.add(source)
+                    continue
+
+                advanced[source] = seq
+
+            if not mark_event_applied(conn, message.get('event_id')):
+                duplicates += 1
+                continue
+
+            index_update = EVENT_HANDLERS[source](conn, message['event'], message['data'])
+            if index_update is not None:
+                index_updates.append(index_update)
+            applied += 1
+
+        for source, seq in advanced.items():
+            set_applied_seq(conn, source, seq)
+        prune_applied_events(conn)
+
+    for index_update in index_updates:
+        index_update()
+
+    with _stats_lock:
+        _consumer_stats['applied'] += applied
+        _consumer_stats['duplicates'] += duplicates
+        _consumer_stats['gaps'] += len(gaps)
+
+    return gaps
+
+
+def dead_letter_event(message, error):
+    """Set aside an event that failed on its own, moving its source's position past it."""
+    source = message.get('source')
+    seq = message.get('seq')
+
+    with transaction(DATABASE) as conn:
+        positions = get_applied_seqs(conn)
+        if seq is not None:
+            # Only the next event in order was actually run; anything else was a duplicate or a gap.
+            if positions.get(source) is None or seq != positions[source] + 1:
+                return
+            set_applied_seq(conn, source, seq)
+            positions[source] = seq
+        mark_event_applied(conn, message.get('event_id'))
+        add_dead_event(conn, message, error)
+
+
+    with _stats_lock:
+        _consumer_stats['dead_lettered'] += 1
+
+
+def apply_events_or_dead_letter(messages):
+    """apply_events(), falling back to one event at a time when the batch fails.
+
+    An event that fails on its own is dead-lettered, so the events after it
+    from the same source still apply instead of waiting on it for good. A
+    database error (sqlite3.OperationalError: locked, disk full) is not the
+    event's fault and is raised, for the caller to retry the batch.
+    """
+    try:
+        return apply_events(messages)
+    except sqlite3.OperationalError:
+        raise
+    except Exception as e:
+        print(f"Failed to apply a batch of {len(messages)} events: {e}. Retrying one by one...", flush=True)
+
+    gaps = set()
+    for message in messages:
+        try:
+            gaps |= apply_events([message])
+        except sqlite3.OperationalError:
+            raise
+        except Exception as e:
+            print(f"Dead-lettering event {message.get('event_id')} (seq {message.get('seq')}): {e}", flush=True)
+            dead_letter_event(message, e)
+
+    return gaps
+
+
+def _apply_batch(channel, batch):
+    messages = []
+    for _, body in batch:
+        try:
+            messages.append(json.loads(body))
+        except ValueError:
+            print(f"Dropping malformed message: {body!r}", flush=True)
+
+    try:
+        gaps = apply_events_or_dead_letter(messages)
+    except Exception as e:
+        # Not the events' fault: hand the batch back. What did commit is
+        # skipped as a redelivery when it comes round again.
+        print(f"Failed to apply a batch of {len(messages)} events: {e}. Requeueing it...", flush=True)
+        channel.basic_nack(delivery_tag=batch[-1][0].delivery_tag, multiple=True, requeue=True)
+        with _stats_lock:
+            _consumer_stats['requeued_batches'] += 1
+        time.sleep(CONSUMER_RETRY_DELAY)
+        return
+
+    # The batch is committed: one ack covers every delivery up to the last one.
+    channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+
+    with _stats_lock:
+        _consumer_stats['batches'] += 1
+        _consumer_stats['received'] += len(batch)
+        _consumer_stats['last_batch_size'] = len(batch)
+        _consumer_stats['max_batch_size'] = max(_consumer_stats['max_batch_size'], len(batch))
+
+    for source in gaps:
+        try:
+            catch_up(source, apply_events_or_dead_letter)
+        except Exception as e:
+            print(f"Failed to catch up with the {source} service: {e}", flush=True)
+
+
+def _consume_batches(channel, queue_name):
+    batch = []
+    deadline = None
+
+    # inactivity_timeout makes consume() yield (None, None, None) when the queue goes quiet.
+    for method, _, body in channel.consume(queue_name, inactivity_timeout=CONSUMER_BATCH_WAIT):
+        if method is not None:
+            batch.append((method, body))
+            if deadline is None:
+                deadline = time.monotonic() + CONSUMER_BATCH_WAIT
+
+        if batch and (method is None or len(batch) >= CONSUMER_BATCH_SIZE or time.monotonic() >= deadline):
+            _apply_batch(channel, batch)
+            batch = []
+            deadline = None
+
+
+def get_consumer_stats():
+    with _stats_lock:
+        return dict(_consumer_stats)
 
 
 def listen_for_messages():
@@ -58,20 +421,17 @@ def listen_for_messages():
             connection = pika.BlockingConnection(rabbit_conn_params)
             channel = connection.channel()
             channel.exchange_declare(exchange=APARTMENT_EXCHANGE, exchange_type='fanout')
+            channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
 
             result = channel.queue_declare('', exclusive=True)
             queue_name = result.method.queue
             channel.queue_bind(exchange=APARTMENT_EXCHANGE, queue=queue_name)
 
-            def callback(ch, method, properties, body):
-                message = json.loads(body)
-                event_type = message['event']
-                data = message['data']
-                handle_apartment_event(event_type, data)
+            # Anything published before the queue was bound is fetched from the source instead.
+            catch_up_all(apply_events_or_dead_letter)
 
-            channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
             print("Listening for apartment events...", flush=True)
-            channel.start_consuming()
+            _consume_batches(channel, queue_name)
         except pika.exceptions.AMQPConnectionError:
             print("RabbitMQ not available. Retrying in 3 seconds...", flush=True)
-            time.sleep(3)
\ No newline at end of file
+            time.sleep(3)
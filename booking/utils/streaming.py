@@ -0,0 +1,41 @@
+import itertools
+import json
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def json_document(key, rows, limit=None):
+    """Write {"<key>": [...], "next_after": ...} row by row instead of building it in memory."""
+    yield '{"%s": [' % key
+
+    last_id = None
+    count = 0
+    for row in rows:
+        yield (', ' if count else '') + json.dumps(row)
+        last_id = row['id']
+        count += 1
+
+    # A full page may be followed by more rows; a short one is the last.
+    next_after = last_id if limit is not None and count == limit else None
+    yield '], "next_after": %s}' % json.dumps(next_after)
+
+
+def read_ndjson(response):
+    for line in response.iter_lines():
+        if line:
+            yield json.loads(line)
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            break
+        yield chunk
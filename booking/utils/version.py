@@ -0,0 +1,57 @@
+import hashlib
+import threading
+import uuid
+
+
+# Data version of this service: a counter bumped after every committed change
+# to what the read endpoints return. Responses carry a weak ETag derived from
+# it, and a client that sends that ETag back in If-None-Match gets 304 before
+# any query runs. The counter starts over with the process, so the tags also
+# carry an id of the process's run.
+
+_lock = threading.Lock()
+_run_id = uuid.uuid4().hex[:12]
+_version = 0
+_stats = {
+    'conditional_requests': 0,
+    'not_modified': 0,
+}
+
+
+def bump_version():
+    global _version
+
+    with _lock:
+        _version += 1
+
+
+def data_etag(*variant):
+    """The ETag of the current data version for one variant of a response, e.g. its query and format."""
+    with _lock:
+        version = _version
+    digest = hashlib.sha1(repr(variant).encode()).hexdigest()[:16]
+    return f'W/"{_run_id}-{version}-{digest}"'
+
+
+def _opaque(tag):
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def is_not_modified(if_none_match, etag):
+    """Whether the If-None-Match header value names etag (weak comparison, as for GET)."""
+    if not if_none_match:
+        return False
+
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    matched = '*' in tags or _opaque(etag) in (_opaque(tag) for tag in tags)
+
+    with _lock:
+        _stats['conditional_requests'] += 1
+        if matched:
+            _stats['not_modified'] += 1
+    return matched
+
+
+def get_version_stats():
+    with _lock:
+        return dict(_stats, version=_version)
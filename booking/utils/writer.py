@@ -0,0 +1,214 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from utils.database import DATABASE, outbox_ready, add_booking_to_db, add_bookings_to_db, change_booking_in_db, cancel_booking_from_db, archive_bookings_in_db
+from utils.db import transaction
+from utils.index import is_free, find_booking_apartment, index_add_booking, index_change_booking, index_remove_booking, index_archive_bookings
+
+
+# Booking write engine. Request threads first take the lock stripe of the
+# apartment they touch, so writes to one apartment are serialized while
+# different apartments proceed in parallel, and the availability check they
+# do under it cannot be invalidated by a concurrent writer. The write itself
+# is handed to a single writer thread that coalesces whatever is queued into
+# one BEGIN IMMEDIATE transaction (group commit). Every write runs in its own
+# savepoint, so a failing one does not take the rest of the group with it.
+
+LOCK_STRIPES = int(os.getenv('BOOKING_LOCK_STRIPES', '256'))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '256'))
+WRITE_BATCH_WAIT = float(os.getenv('WRITE_BATCH_WAIT', '0'))
+
+_stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    'writes': 0,
+    'failed_writes': 0,
+    'groups': 0,
+    'failed_groups': 0,
+    'max_group_size': 0,
+    'total_commit_ms': 0.0,
+}
+
+
+@contextmanager
+def _locked(apartment_ids):
+    # Stripes are always taken in index order, so multi-apartment writers cannot deadlock.
+    stripes = sorted(set(hash(apartment_id) % LOCK_STRIPES for apartment_id in apartment_ids))
+
+    with ExitStack() as stack:
+        for stripe in stripes:
+            stack.enter_context(_stripes[stripe])
+        yield
+
+
+def _start_writer():
+    global _writer_thread
+
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name='booking-writer', daemon=True)
+            _writer_thread.start()
+
+
+def _next_group():
+    group = [_write_queue.get()]
+    deadline = time.monotonic() + WRITE_BATCH_WAIT
+
+    while len(group) < WRITE_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0:
+                group.append(_write_queue.get(timeout=remaining))
+            else:
+                group.append(_write_queue.get_nowait())
+        except queue.Empty:
+            break
+
+    return group
+
+
+def _run_group(group):
+    results = []
+
+    with transaction(DATABASE) as conn:
+        for function, args, future in group:
+            conn.execute('SAVEPOINT booking_write')
+            try:
+                results.append((future, function(conn, *args), None))
+                conn.execute('RELEASE booking_write')
+            except Exception as e:
+                conn.execute('ROLLBACK TO booking_write')
+                conn.execute('RELEASE booking_write')
+                results.append((future, None, e))
+
+    return results
+
+
+def _writer_loop():
+    while True:
+        group = _next_group()
+        started = time.monotonic()
+
+        try:
+            results = _run_group(group)
+        except Exception as e:
+            print(f"Failed to commit a group of {len(group)} booking writes: {e}", flush=True)
+            with _stats_lock:
+                _stats['failed_groups'] += 1
+                _stats['failed_writes'] += len(group)
+            for _, _, future in group:
+                future.set_exception(e)
+            continue
+
+        outbox_ready.set()
+
+        with _stats_lock:
+            _stats['groups'] += 1
+            _stats['writes'] += len(group)
+            _stats['max_group_size'] = max(_stats['max_group_size'], len(group))
+            _stats['total_commit_ms'] += (time.monotonic() - started) * 1000
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                with _stats_lock:
+                    _stats['failed_writes'] += 1
+                future.set_exception(error)
+
+
+def _submit(function, *args):
+    """Run function(conn, *args) in the next group commit and return its result."""
+    _start_writer()
+
+    future = Future()
+    _write_queue.put((function, args, future))
+    return future.result()
+
+
+# The in-memory index is updated after the commit, while the stripe lock is
+# still held, so the next writer for the apartment already sees the change.
+
+def create_booking(booking_id, apartment_id, start_day, end_day, guest_name):
+    """Returns False if the dates overlap another booking of the apartment."""
+    with _locked([apartment_id]):
+        # Fails fast without a trip through the writer; it re-checks under the write lock anyway.
+        if not is_free(apartment_id, start_day, end_day, booking_id):
+            return False
+
+        booked = _submit(add_booking_to_db, booking_id, apartment_id, start_day, end_day, guest_name)
+        if booked:
+            index_add_booking(booking_id, apartment_id, start_day, end_day)
+        return booked
+
+
+def create_bookings(bookings, atomic):
+    with _locked([booking[1] for booking in bookings]):
+        errors = _submit(add_bookings_to_db, bookings, atomic)
+
+        if not (atomic and errors):
+            for position, (booking_id, apartment_id, start_day, end_day, _) in enumerate(bookings):
+                if position not in errors:
+                    index_add_booking(booking_id, apartment_id, start_day, end_day)
+        return errors
+
+
+def reschedule_booking(booking_id, new_start_day, new_end_day):
+    """Returns None if the booking does not exist, False if the new dates overlap another booking."""
+    apartment_id = find_booking_apartment(booking_id)
+
+    if apartment_id is None:
+        return None
+
+    with _locked([apartment_id]):
+        if not is_free(apartment_id, new_start_day, new_end_day, booking_id):
+            return False
+
+        changed = _submit(change_booking_in_db, booking_id, new_start_day, new_end_day)
+        if changed:
+            index_change_booking(booking_id, new_start_day, new_end_day)
+        return changed
+
+
+def remove_booking(booking_id):
+    """Returns the removed booking, or None if it does not exist."""
+    apartment_id = find_booking_apartment(booking_id)
+
+    if apartment_id is None:
+        return None
+
+    with _locked([apartment_id]):
+        booking = _submit(cancel_booking_from_db, booking_id)
+        if booking is not None:
+            index_remove_booking(booking_id)
+        return booking
+
+
+def archive_ended_bookings(bookings, before_day):
+    """Move the (id, apartment_id) bookings that ended before before_day to the archive; returns the moved ids.
+
+    Under the stripes of their apartments, like any other write, so a
+    booking cannot be archived between a writer's check and its write.
+    """
+    with _locked([apartment_id for _, apartment_id in bookings]):
+        booking_ids = _submit(archive_bookings_in_db, before_day, [booking_id for booking_id, _ in bookings])
+        index_archive_bookings(booking_ids, before_day)
+        return booking_ids
+
+
+def get_writer_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+
+    total_commit_ms = stats.pop('total_commit_ms')
+    stats['avg_group_size'] = stats['writes'] / stats['groups'] if stats['groups'] else None
+    stats['avg_commit_ms'] = total_commit_ms / stats['groups'] if stats['groups'] else None
+    stats['queue_depth'] = _write_queue.qsize()
+    stats['lock_stripes'] = LOCK_STRIPES
+    return stats
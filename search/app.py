@@ -1,7 +1,15 @@
-from flask import Flask, request, jsonify # type: ignore
+from flask import Flask, Response, request, jsonify # type: ignore
 import threading
-from utils.database import init_db, search_apartments_in_db
-from utils.rabbitmq import listen_for_messages
+from utils.filters import parse_search
+from utils.database import init_db, search_apartments_in_db, get_text_matches, load_applied_seqs, load_archived_before, load_apartments_from_db, load_bookings_from_db
+from utils.archive import reaches_archive, search_archived, start_archiver, get_archive_stats
+from utils.matches import search_text
+from utils.index import build_index, search_index, compare_with_sql, get_index_stats
+from utils.batch import BATCH_MAX_QUERIES, query_key, search_batch
+from utils.rabbitmq import listen_for_messages, apply_events, get_consumer_stats
+from utils.replication import catch_up_all
+from utils.db import get_pool_stats
+from utils.version import data_etag, is_not_modified, get_version_stats
 
 app = Flask(__name__)
 
@@ -14,19 +22,94 @@ def hello():
 @app.route('/search', methods=['GET'])
 def search():
     try:
-        date_from = request.args.get('from')
-        date_to = request.args.get('to')
+        params = parse_search(request.args)
+        archived = reaches_archive(params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        apartments_list = search_apartments_in_db(date_from, date_to)
+    # Taken before the search: a change made while it runs gives the next request a new tag.
+    etag = data_etag(sorted(request.args.items(multi=True)))
+    if is_not_modified(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers={'ETag': etag})
 
-        return jsonify({'apartments': apartments_list}), 200
+    try:
+        if params['text'] is not None:
+            apartments_list = search_text(params, archived)
+        elif archived:
+            apartments_list = search_archived(params)
+        else:
+            apartments_list = search_index(params['day_from'], params['day_to'], params['ranges'], params['sort'], params['limit'], None, params['stay'])
+
+        response = jsonify({'apartments': apartments_list})
+        response.headers['ETag'] = etag
+        return response, 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/batch', methods=['POST'])
+def batch_search():
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict) or not isinstance(body.get('queries'), list):
+        return jsonify({'error': 'Expected a JSON object with a "queries" list'}), 400
+
+    queries = body['queries']
+
+    if not queries:
+        return jsonify({'error': 'The batch is empty'}), 400
+
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({'error': f"At most {BATCH_MAX_QUERIES} queries per batch"}), 413
+
+    keys = [query_key(query, position) for position, query in enumerate(queries)]
+    if len(set(keys)) != len(keys):
+        return jsonify({'error': 'Query ids must be unique'}), 400
+
+    try:
+        apartments, results = search_batch(queries)
+
+        return jsonify({'apartments': apartments, 'results': results}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/consistency', methods=['GET'])
+def consistency():
+    try:
+        params = parse_search(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        # Compares the matching sets, so sort, limit and nights are not applied.
+        text_ids = get_text_matches(params['text']) if params['text'] is not None else None
+        sql_apartments = search_apartments_in_db(params['day_from'], params['day_to'], params['ranges'], text_ids=text_ids)
+        report = compare_with_sql(sql_apartments, params['day_from'], params['day_to'], params['ranges'], text_ids)
+
+        return jsonify(report), 200 if report['consistent'] else 409
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({'index': get_index_stats(), 'consumer': get_consumer_stats(), 'archive': get_archive_stats(), 'db': get_pool_stats(), 'version': get_version_stats()}), 200
+
+
 init_db()
 
+# The index, and with it the occupancy files, is loaded at the position the
+# local copy is at; the catch-up then applies what was missed on top of it.
+build_index(load_apartments_from_db(), load_bookings_from_db(), load_applied_seqs(), load_archived_before())
+
+catch_up_all(apply_events)
+
+start_archiver()
+
 threading.Thread(target=listen_for_messages, daemon=True).start()
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+"""Batch search benchmark.
+
+Answers the same set of date-window queries (one per week, as a calendar
+page asks them) once as separate searches and once as one batch, and
+reports the time of each. In-process by default, on a synthetic index;
+with --url it sends the requests to a running gateway or search service
+instead (GET <url>/search per window against POST <url>/batch).
+
+    python benchmarks/batch.py --apartments 20000 --windows 4 12 52
+    python benchmarks/batch.py --url http://localhost:5000/search --windows 52
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.batch import search_batch  # noqa: E402
+from utils.filters import parse_search  # noqa: E402
+from utils.index import build_index, search_index  # noqa: E402
+
+
+def seed_index(apartments, bookings, seed):
+    rng = random.Random(seed)
+    rows = [
+        {'id': str(uuid.uuid4()), 'name': f'Apartment {index}', 'address': f'Street {index}', 'noise_level': rng.randint(0, 10), 'floor': rng.randint(0, 20)}
+        for index in range(apartments)
+    ]
+    first_day = date.today().toordinal()
+    booking_rows = []
+    for _ in range(bookings):
+        start_day = first_day + rng.randrange(365)
+        booking_rows.append((str(uuid.uuid4()), rng.choice(rows)['id'], start_day, start_day + rng.randint(1, 7)))
+    build_index(rows, booking_rows)
+
+
+def weekly_queries(windows, filters):
+    monday = date.today() + timedelta(days=7 - date.today().weekday())
+    return [
+        dict(filters, id=f'week-{week}', **{'from': (monday + timedelta(weeks=week)).isoformat(), 'to': (monday + timedelta(weeks=week, days=6)).isoformat()})
+        for week in range(windows)
+    ]
+
+
+def single_in_process(queries):
+    for query in queries:
+        params = parse_search(query)
+        apartments = search_index(params['day_from'], params['day_to'], params['ranges'], params['sort'], params['limit'], None, params['stay'])
+        json.dumps({'apartments': apartments})
+
+
+def batch_in_process(queries):
+    apartments, results = search_batch(queries)
+    json.dumps({'apartments': apartments, 'results': results})
+
+
+def single_http(url, queries):
+    import requests  # type: ignore
+
+    with requests.Session() as session:
+        for query in queries:
+            session.get(f'{url}/search', params={key: value for key, value in query.items() if key != 'id'}).raise_for_status()
+
+
+def batch_http(url, queries):
+    import requests  # type: ignore
+
+    requests.post(f'{url}/batch', json={'queries': queries}).raise_for_status()
+
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--windows', type=int, nargs='+', default=[4, 12, 52], help='weekly windows per page')
+    parser.add_argument('--apartments', type=int, default=20000)
+    parser.add_argument('--bookings', type=int, default=40000)
+    parser.add_argument('--noise-max', type=int, help='add a noise_max filter to every query')
+    parser.add_argument('--url', help='base URL of the search API, e.g. http://localhost:5000/search')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    filters = {'noise_max': args.noise_max} if args.noise_max is not None else {}
+
+    if args.url is None:
+        seed_index(args.apartments, args.bookings, args.seed)
+
+    print(f"{'windows':>7} {'single ms':>10} {'batch ms':>10} {'speedup':>8}")
+
+    for windows in args.windows:
+        queries = weekly_queries(windows, filters)
+
+        if args.url is None:
+            single = timed(single_in_process, queries)
+            batch = timed(batch_in_process, queries)
+        else:
+            single = timed(single_http, args.url, queries)
+            batch = timed(batch_http, args.url, queries)
+
+        print(f"{windows:>7} {single * 1000:>10.1f} {batch * 1000:>10.1f} {single / batch:>7.1f}x", flush=True)
+
+
+if __name__ == '__main__':
+    main()
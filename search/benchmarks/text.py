@@ -0,0 +1,116 @@
+"""Text search benchmark.
+
+Times /search with q= for a rare word, a common word and a prefix, each
+with a few limits, and reports the latency of each. In-process by default,
+on a synthetic SQLite copy in a temporary directory (FTS5 lives there) and
+the index built from it; with --url it sends the requests to a running
+gateway or search service instead (GET <url>/search).
+
+    python benchmarks/text.py --apartments 50000 --limits 10 100 1000
+    python benchmarks/text.py --url http://localhost:5000/search --limits 10 100
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.database import add_apartments_to_db, init_db, load_apartments_from_db, DATABASE  # noqa: E402
+from utils.db import transaction  # noqa: E402
+from utils.filters import parse_search  # noqa: E402
+from utils.index import build_index  # noqa: E402
+from utils.matches import search_text  # noqa: E402
+
+STREETS = ['Main', 'Station', 'Garden', 'Harbour', 'Castle', 'Lake', 'Market', 'River']
+WORDS = ['quiet', 'bright', 'cosy', 'large', 'central', 'modern', 'old', 'terrace']
+
+
+def seed_database(apartments, bookings, seed):
+    rng = random.Random(seed)
+    rows = [
+        {
+            'id': str(uuid.uuid4()),
+            'name': f"{rng.choice(WORDS)} {'penthouse' if index % 1000 == 0 else 'apartment'} {index}",
+            'address': f'{rng.choice(STREETS)} Street {index}',
+            'noise_level': rng.randint(0, 10),
+            'floor': rng.randint(0, 20),
+        }
+        for index in range(apartments)
+    ]
+
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs(os.path.dirname(DATABASE), exist_ok=True)
+    init_db()
+    with transaction(DATABASE) as conn:
+        add_apartments_to_db(conn, rows)
+
+    first_day = date.today().toordinal()
+    booking_rows = []
+    for _ in range(bookings):
+        start_day = first_day + rng.randrange(365)
+        booking_rows.append((str(uuid.uuid4()), rng.choice(rows)['id'], start_day, start_day + rng.randint(1, 7)))
+    build_index(load_apartments_from_db(), booking_rows)
+
+
+def text_queries(limit):
+    monday = date.today() + timedelta(days=7 - date.today().weekday())
+    window = {'from': monday.isoformat(), 'to': (monday + timedelta(days=6)).isoformat(), 'limit': limit}
+    return [
+        ('rare', dict(window, q='penthouse')),
+        ('common', dict(window, q='street')),
+        ('prefix', dict(window, q='harb*')),
+        ('two words', dict(window, q='quiet garden')),
+    ]
+
+
+def search_in_process(query):
+    search_text(parse_search(query))
+
+
+def search_http(url, query):
+    import requests  # type: ignore
+
+    requests.get(f'{url}/search', params=query).raise_for_status()
+
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--limits', type=int, nargs='+', default=[10, 100, 1000], help='limit of each search')
+    parser.add_argument('--apartments', type=int, default=50000)
+    parser.add_argument('--bookings', type=int, default=100000)
+    parser.add_argument('--url', help='base URL of the search API, e.g. http://localhost:5000/search')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.url is None:
+        seed_database(args.apartments, args.bookings, args.seed)
+
+    print(f"{'query':>10} {'limit':>6} {'ms':>10}")
+
+    for limit in args.limits:
+        for name, query in text_queries(limit):
+            if args.url is None:
+                elapsed = timed(search_in_process, query)
+            else:
+                elapsed = timed(search_http, args.url, query)
+
+            print(f"{name:>10} {limit:>6} {elapsed * 1000:>10.1f}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import itertools
+import os
+import threading
+import time
+from datetime import date
+from utils.database import DATABASE, archive_bookings_chunk, count_bookings, load_booking_spans, search_apartments_in_db
+from utils.dates import from_day
+from utils.db import transaction
+from utils.index import index_archive_bookings, get_archived_before, with_gaps
+
+
+# Hot/cold split of the local copy of the bookings. A background archiver
+# moves the bookings that have ended into bookings_archive, a chunk per
+# transaction so the event consumer never waits long for the write lock, and
+# drops them from the in-memory index and occupancy bitmaps. Searches then
+# only see the hot set, except for windows that start before the archived
+# day, which are answered from SQLite with the archive included.
+
+ARCHIVE_INTERVAL = float(os.getenv('BOOKINGS_ARCHIVE_INTERVAL', '3600'))
+# Bookings are archived once they ended more than this many days ago.
+ARCHIVE_AFTER_DAYS = int(os.getenv('BOOKINGS_ARCHIVE_AFTER_DAYS', '0'))
+ARCHIVE_CHUNK_SIZE = int(os.getenv('BOOKINGS_ARCHIVE_CHUNK_SIZE', '1000'))
+
+_stats_lock = threading.Lock()
+_stats = {
+    'runs': 0,
+    'failed_runs': 0,
+    'archived': 0,
+    'last_archived': 0,
+    'last_run_ms': None,
+    'max_run_ms': 0.0,
+    'total_run_ms': 0.0,
+    'hot_bookings': None,
+    'archived_bookings': None,
+}
+
+
+def archive_bookings():
+    """Move every booking that ended before the cut-off day; returns how many were moved."""
+    before_day = date.today().toordinal() - ARCHIVE_AFTER_DAYS
+    started = time.monotonic()
+    archived = 0
+
+    while True:
+        with transaction(DATABASE) as conn:
+            booking_ids = archive_bookings_chunk(conn, before_day, ARCHIVE_CHUNK_SIZE)
+        index_archive_bookings(booking_ids, before_day)
+
+        archived += len(booking_ids)
+        if len(booking_ids) < ARCHIVE_CHUNK_SIZE:
+            break
+
+    hot, cold = count_bookings()
+    elapsed_ms = (time.monotonic() - started) * 1000
+
+    with _stats_lock:
+        _stats['runs'] += 1
+        _stats['archived'] += archived
+        _stats['last_archived'] = archived
+        _stats['last_run_ms'] = elapsed_ms
+        _stats['max_run_ms'] = max(_stats['max_run_ms'], elapsed_ms)
+        _stats['total_run_ms'] += elapsed_ms
+        _stats['hot_bookings'] = hot
+        _stats['archived_bookings'] = cold
+
+    print(f"Archived {archived} bookings that ended before {from_day(before_day)} in {elapsed_ms:.0f} ms.", flush=True)
+    return archived
+
+
+def _archiver_loop():
+    while True:
+        try:
+            archive_bookings()
+        except Exception as e:
+            print(f"Failed to archive past bookings: {e}", flush=True)
+            with _stats_lock:
+                _stats['failed_runs'] += 1
+
+        time.sleep(ARCHIVE_INTERVAL)
+
+
+def start_archiver():
+    threading.Thread(target=_archiver_loop, name='search-archiver', daemon=True).start()
+
+
+def get_archive_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+
+    total_run_ms = stats.pop('total_run_ms')
+    stats['avg_run_ms'] = total_run_ms / stats['runs'] if stats['runs'] else None
+    stats['interval_s'] = ARCHIVE_INTERVAL
+    stats['after_days'] = ARCHIVE_AFTER_DAYS
+    return stats
+
+
+def reaches_archive(params):
+    """Whether the window of a search (parse_search result) starts before the archived day.
+
+    Such a window can overlap archived bookings, which only SQLite has; see
+    search_archived.
+    """
+    archived_before = get_archived_before()
+    return params['day_from'] is not None and params['day_to'] is not None and params['day_from'] < archived_before
+
+
+def search_archived(params, text_ids=None):
+    """search_index's result for a search that reaches the archive, from SQLite with the archive included.
+
+    Stay searches get the filtered apartments in their order from SQLite,
+    then the free gaps from their hot and archived bookings in the window.
+    """
+    day_from, day_to = params['day_from'], params['day_to']
+    if params['stay'] is None:
+        return search_apartments_in_db(day_from, day_to, params['ranges'], params['sort'], params['limit'], text_ids, archived=True)
+
+    candidates = search_apartments_in_db(day_from, day_to, params['ranges'], params['sort'], text_ids=text_ids, available=False)
+    spans = load_booking_spans([apartment['id'] for apartment in candidates], day_from, day_to)
+    return list(itertools.islice(with_gaps(candidates, day_from, day_to, *params['stay'], spans=spans), params['limit']))
@@ -0,0 +1,67 @@
+import os
+from utils.archive import reaches_archive, search_archived
+from utils.filters import parse_search
+from utils.index import search_index_batch
+from utils.matches import search_text
+
+
+# Batch search: many /search queries (calendar weeks, date pairs) answered
+# together. They share one pass over the apartments, and the response lists
+# every apartment once, with each query's result as a list of ids (or of
+# {id, earliest|gaps} for stay searches) keyed by the query's id, or by its
+# position when it has none.
+
+BATCH_MAX_QUERIES = int(os.getenv('SEARCH_BATCH_MAX_QUERIES', '100'))
+APARTMENT_FIELDS = ('id', 'name', 'address', 'noise_level', 'floor')
+
+
+def query_key(query, position):
+    if isinstance(query, dict) and query.get('id') is not None:
+        return str(query['id'])
+    return str(position)
+
+
+def search_batch(queries):
+    """Return (apartments by id, results by query key); invalid queries get {'error': ...}."""
+    results = {}
+    valid = []
+    archived = []
+    texts = []
+
+    for position, query in enumerate(queries):
+        key = query_key(query, position)
+        if not isinstance(query, dict):
+            results[key] = {'error': 'Expected an object'}
+            continue
+
+        try:
+            params = parse_search(query)
+            reaches = reaches_archive(params)
+        except ValueError as e:
+            results[key] = {'error': str(e)}
+            continue
+
+        if params['text'] is not None:
+            # Ranked matches, taken a page at a time; one by one like in search_index_batch.
+            texts.append((key, params, reaches))
+        else:
+            (archived if reaches else valid).append((key, params))
+
+    answered = list(zip(valid, search_index_batch([params for _, params in valid])))
+    for key, params in archived:
+        answered.append(((key, params), search_archived(params)))
+    for key, params, reaches in texts:
+        answered.append(((key, params), search_text(params, reaches)))
+
+    apartments = {}
+    for (key, params), matches in answered:
+        if params['stay'] is None:
+            apartments.update((match['id'], match) for match in matches)
+            entries = [match['id'] for match in matches]
+        else:
+            apartments.update((match['id'], {field: match[field] for field in APARTMENT_FIELDS}) for match in matches)
+            entries = [{field: value for field, value in match.items() if field == 'id' or field not in APARTMENT_FIELDS} for match in matches]
+
+        results[key] = {'apartments': entries}
+
+    return apartments, results
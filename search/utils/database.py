@@ -1,108 +1,194 @@
-
-import requests # type: ignore
+import json
 import os
-import sqlite3
+import time
+from utils.dates import to_day_or_none
+from utils.db import connection, transaction, read_transaction
+from utils.migrations import run_migrations, MIGRATIONS
+from utils.streaming import chunks
+from utils.text import tokens, match_expression, matches_words
 
 DATABASE = './data/search.db'
-APARTMENTS_SERVICE_URL = "http://apartments:5000/list"
-BOOKINGS_SERVICE_URL = "http://booking:5000/list"
+INSERT_CHUNK_SIZE = 1000
+TEXT_PAGE_SIZE = int(os.getenv('SEARCH_TEXT_PAGE_SIZE', '200'))
+TEXT_SAMPLE_SIZE = 256
+APPLIED_EVENTS_KEPT = int(os.getenv('APPLIED_EVENTS_KEPT', '100000'))
+
 
+def init_db():
+    with connection(DATABASE) as conn:
+        run_migrations(conn, MIGRATIONS)
 
-def initialize_apartments(conn):
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM apartments')
-    count = cursor.fetchone()[0]
 
-    if count == 0:
-        print("Initializing apartments from Apartments service...")
-        try:
-            response = requests.get(APARTMENTS_SERVICE_URL)
-            response.raise_for_status()
-            apartments = response.json().get('apartments', [])
+def get_applied_seq(source):
+    with connection(DATABASE) as conn:
+        row = conn.execute('SELECT seq FROM replica_state WHERE source = ?', (source,)).fetchone()
 
-            for row in apartments:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO apartments (id, name, address, noise_level, floor)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (row['id'], row['name'], row['address'], row['noise_level'], row['floor']))
+    return row[0] if row else None
 
-            conn.commit()
-            print("Apartments initialized successfully.")
-        except Exception as e:
-            print(f"Failed to initialize apartments: {e}")
 
+def get_applied_seqs(conn):
+    return dict(conn.execute('SELECT source, seq FROM replica_state').fetchall())
 
 
-def initialize_bookings(conn):
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM bookings')
-    count = cursor.fetchone()[0]
+def load_applied_seqs():
+    with connection(DATABASE) as conn:
+        return get_applied_seqs(conn)
 
-    if count == 0:
-        print("Initializing bookings from Bookings service...")
-        try:
-            response = requests.get(BOOKINGS_SERVICE_URL)
-            response.raise_for_status()
-            bookings = response.json().get('bookings', [])
 
-            for row in bookings:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO bookings (id, apartment_id, start_date, end_date)
-                    VALUES (?, ?, ?, ?)
-                ''', (row['id'], row['apartment_id'], row['start_date'], row['end_date']))
+def set_applied_seq(conn, source, seq):
+    conn.execute('INSERT OR REPLACE INTO replica_state (source, seq) VALUES (?, ?)', (source, seq))
 
-            conn.commit()
-            print("Bookings initialized successfully.")
-        except Exception as e:
-            print(f"Failed to initialize bookings: {e}")
 
+def mark_event_applied(conn, event_id):
+    """Record event_id; False if it was applied before."""
+    if event_id is None:
+        return True
 
-def init_db():
-    if not os.path.exists(DATABASE):
-
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bookings (
-                id TEXT PRIMARY KEY,
-                apartment_id TEXT NOT NULL,
-                start_date TEXT NOT NULL,
-                end_date TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS apartments (
-                id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                address TEXT NOT NULL,
-                noise_level REAL NOT NULL,
-                floor INTEGER NOT NULL
-            )
-        ''')
-        conn.commit()
-
-        initialize_apartments(conn)
-        initialize_bookings(conn)
-
-        conn.close()
-
-
-def search_apartments_in_db(date_from, date_to):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM apartments AS a
-        LEFT JOIN bookings AS b
-        ON a.id = b.apartment_id
-            AND (
-                (b.start_date <= ? AND b.end_date >= ?)
-                OR (b.start_date <= ? AND b.end_date >= ?)
-                OR (b.start_date >= ? AND b.end_date <= ?)
-            )
-        WHERE b.id IS NULL;
-    ''', (date_from, date_from, date_to, date_to, date_from, date_to))
-    apartments = cursor.fetchall()
-    conn.close()
+    cursor = conn.execute('INSERT OR IGNORE INTO applied_events (event_id, applied_at) VALUES (?, ?)', (event_id, time.time()))
+    return cursor.rowcount == 1
+
+
+def prune_applied_events(conn):
+    conn.execute('''
+        DELETE FROM applied_events
+        WHERE rowid <= (SELECT MAX(rowid) FROM applied_events) - ?
+    ''', (APPLIED_EVENTS_KEPT,))
+
+
+def add_dead_event(conn, message, error):
+    conn.execute(
+        'INSERT INTO dead_events (source, seq, event_id, message, error, failed_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (message.get('source'), message.get('seq'), message.get('event_id'), json.dumps(message), str(error), time.time())
+    )
+
+
+def _load_snapshot(source, table, columns, rows, seq, after_swap=None):
+    """Replace table with a snapshot taken at the source's outbox position seq.
+
+    The rows are staged in chunked transactions and swapped in with the new
+    sequence number in one final transaction, so a failed load leaves the
+    previous copy and position untouched. after_swap(conn), if given, runs
+    in that transaction too.
+    """
+    staging = f'{table}_snapshot'
+    column_list = ', '.join(columns)
+    placeholders = ', '.join('?' for _ in columns)
+
+    with transaction(DATABASE) as conn:
+        conn.execute(f'DROP TABLE IF EXISTS {staging}')
+        conn.execute(f'CREATE TABLE {staging} AS SELECT {column_list} FROM {table} WHERE 0')
+
+    for chunk in chunks(rows, INSERT_CHUNK_SIZE):
+        with transaction(DATABASE) as conn:
+            conn.executemany(f'INSERT INTO {staging} ({column_list}) VALUES ({placeholders})', chunk)
+
+    with transaction(DATABASE) as conn:
+        conn.execute(f'DELETE FROM {table}')
+        conn.execute(f'INSERT OR REPLACE INTO {table} ({column_list}) SELECT {column_list} FROM {staging}')
+        conn.execute(f'DROP TABLE {staging}')
+        if after_swap is not None:
+            after_swap(conn)
+        conn.execute('INSERT OR REPLACE INTO replica_state (source, seq) VALUES (?, ?)', (source, seq))
+
+
+def booking_rows(bookings):
+    for row in bookings:
+        start_day = to_day_or_none(row['start_date'])
+        end_day = to_day_or_none(row['end_date'])
+
+        if start_day is None or end_day is None or start_day > end_day:
+            print(f"Skipping booking {row['id']} with invalid dates.")
+            continue
+
+        yield (row['id'], row['apartment_id'], start_day, end_day)
+
+
+def load_apartments_snapshot(apartments, seq):
+    rows = ((row['id'], row['name'], row['address'], row['noise_level'], row['floor']) for row in apartments)
+    _load_snapshot('apartments', 'apartments', ('id', 'name', 'address', 'noise_level', 'floor'), rows, seq)
+
+    # The swap deleted and re-added every row through the triggers, leaving
+    # apartments_fts as a stack of segments full of delete markers that every
+    # text query would have to merge; rewrite it as one segment.
+    with transaction(DATABASE) as conn:
+        conn.execute("INSERT INTO apartments_fts (apartments_fts) VALUES ('optimize')")
+
+
+def _refill_bookings_archive(conn):
+    # The snapshot has the archived bookings too. The archive is rebuilt from
+    # it with this replica's own cut-off, so it drops what was cancelled or
+    # changed in the meantime and the hot set is the same as before.
+    archived_before = "(SELECT value FROM archive_state WHERE name = 'archived_before')"
+    conn.execute('DELETE FROM bookings_archive')
+    conn.execute(f'''
+        INSERT INTO bookings_archive (id, apartment_id, start_date, end_date)
+        SELECT id, apartment_id, start_date, end_date FROM bookings WHERE end_date < {archived_before}
+    ''')
+    conn.execute(f'DELETE FROM bookings WHERE end_date < {archived_before}')
+
+
+def load_bookings_snapshot(bookings, seq):
+    _load_snapshot('booking', 'bookings', ('id', 'apartment_id', 'start_date', 'end_date'), booking_rows(bookings), seq, _refill_bookings_archive)
+
+
+def search_apartments_in_db(day_from, day_to, ranges=None, sort=None, limit=None, text_ids=None, archived=False, available=True):
+    """The apartments free from day_from to day_to, among the hot bookings and, if archived, the archived ones too.
+
+    With available=False the window is not checked: every apartment that
+    matches the filters, for a stay search to find the gaps of.
+    """
+    tables = 'apartments AS a'
+    conditions = []
+    params = []
+    if text_ids is not None:
+        # Restricted to the ids found by get_text_matches, in their order.
+        tables = 'json_each(?) AS matches JOIN apartments AS a ON a.id = matches.value'
+        params.append(json.dumps(text_ids))
+
+    for field, (low, high) in (ranges or {}).items():
+        if low is not None:
+            conditions.append(f'a.{field} >= ?')
+            params.append(low)
+        if high is not None:
+            conditions.append(f'a.{field} <= ?')
+            params.append(high)
+
+    # The attribute ranges are served by idx_apartments_noise_floor or
+    # idx_apartments_floor_noise, and the correlated probe is a range scan on
+    # idx_bookings_apartment_dates for each remaining apartment.
+    if available:
+        conditions.append('''NOT EXISTS (
+                SELECT 1 FROM bookings AS b
+                WHERE b.apartment_id = a.id
+                    AND b.start_date <= ?
+                    AND b.end_date >= ?
+            )''')
+        params.extend((day_to, day_from))
+        if archived:
+            conditions.append('''NOT EXISTS (
+                SELECT 1 FROM bookings_archive AS h
+                WHERE h.apartment_id = a.id
+                    AND h.end_date >= ?
+                    AND h.start_date <= ?
+            )''')
+            params.extend((day_from, day_to))
+
+    query = f'''
+        SELECT a.id, a.name, a.address, a.noise_level, a.floor FROM {tables}
+        WHERE {' AND '.join(conditions) or '1'}
+    '''
+    if sort is not None:
+        field, descending = sort
+        direction = 'DESC' if descending else 'ASC'
+        query += f' ORDER BY a.{field} {direction}, a.id {direction}'
+    elif text_ids is not None:
+        query += ' ORDER BY matches.key'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    with connection(DATABASE) as conn:
+        apartments = conn.execute(query, params).fetchall()
 
     apartments_list = [
         {
@@ -118,76 +204,221 @@ def search_apartments_in_db(date_from, date_to):
     return apartments_list
 
 
-def add_apartment_to_db(id, name, address, noise_level, floor):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+def _is_common(conn, word):
+    # Estimated from where the first TEXT_SAMPLE_SIZE matches of the word end.
+    rows = conn.execute(
+        'SELECT rowid FROM apartments_fts WHERE apartments_fts MATCH ? LIMIT ?',
+        (match_expression([word]), TEXT_SAMPLE_SIZE)
+    ).fetchall()
+    if len(rows) < TEXT_SAMPLE_SIZE:
+        return False
+
+    # Common if those matches are more than half of the apartments up to there.
+    scanned = conn.execute(
+        'SELECT COUNT(*) FROM (SELECT 1 FROM apartments WHERE rowid <= ? LIMIT ?)',
+        (rows[-1][0], 2 * TEXT_SAMPLE_SIZE)
+    ).fetchone()[0]
+    return scanned < 2 * TEXT_SAMPLE_SIZE
+
+
+def iter_text_matches(words, page_size=TEXT_PAGE_SIZE):
+    """Pages of the ids of the apartments matching every word, best BM25 match first.
+
+    FTS5's BM25 counts the documents of each word on every query, a full pass
+    over its postings. A word found in most apartments (an estimated half or
+    more) gets no weight from BM25 anyway, so such words are left out of the
+    FTS5 query and checked here on the rows it returns. Every match is
+    ranked before the first page comes out; the pages let a caller stop once
+    the matches it has are enough.
+    """
+    with connection(DATABASE) as conn:
+        common = [word for word in words if _is_common(conn, word)]
+        ranked = [word for word in words if word not in common]
+
+        if ranked:
+            cursor = conn.execute('''
+                SELECT a.id, a.name, a.address FROM (
+                    SELECT rowid, rank FROM apartments_fts WHERE apartments_fts MATCH ? ORDER BY rank
+                ) AS matches
+                JOIN apartments AS a ON a.rowid = matches.rowid
+                ORDER BY matches.rank, a.id
+            ''', (match_expression(ranked),))
+        else:
+            # Every word is common, so every match scores the same.
+            cursor = conn.execute('''
+                SELECT a.id, a.name, a.address FROM (
+                    SELECT rowid FROM apartments_fts WHERE apartments_fts MATCH ?
+                ) AS matches
+                JOIN apartments AS a ON a.rowid = matches.rowid
+                ORDER BY a.id
+            ''', (match_expression(common),))
+            common = []
+
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield [
+                row[0]
+                for row in rows
+                if not common or matches_words(tokens(row[1]) + tokens(row[2]), common)
+            ]
+
+
+def get_text_matches(words):
+    """Ids of all the apartments matching every word, best BM25 match first."""
+    return [apartment_id for page in iter_text_matches(words) for apartment_id in page]
+
+
+def load_apartments_from_db():
+    with connection(DATABASE) as conn:
+        apartments = conn.execute('SELECT id, name, address, noise_level, floor FROM apartments').fetchall()
+
+    return [
+        {
+            'id': row[0],
+            'name': row[1],
+            'address': row[2],
+            'noise_level': row[3],
+            'floor': row[4]
+        }
+        for row in apartments
+    ]
 
-    cursor.execute('''
-        INSERT OR REPLACE INTO apartments (id, name, address, noise_level, floor)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (id, name, address, noise_level, floor))
 
-    conn.commit()
-    conn.close()
+def load_bookings_from_db():
+    with connection(DATABASE) as conn:
+        return conn.execute('SELECT id, apartment_id, start_date, end_date FROM bookings').fetchall()
 
 
-def remove_apartment_from_db(id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+# An upsert rather than INSERT OR REPLACE: a replace deletes the old row
+# without firing the delete trigger that keeps apartments_fts in sync.
+UPSERT_APARTMENT = '''
+    ON CONFLICT (id) DO UPDATE SET
+        name = excluded.name,
+        address = excluded.address,
+        noise_level = excluded.noise_level,
+        floor = excluded.floor
+'''
 
-    cursor.execute('SELECT COUNT(*) FROM apartments WHERE id = ?', (id,))
-    count = cursor.fetchone()[0]
 
-    if count > 0:
-        cursor.execute('DELETE FROM apartments WHERE id = ?', (id,))
-        conn.commit()
+def add_apartment_to_db(conn, id, name, address, noise_level, floor):
+    conn.execute('''
+        INSERT INTO apartments (id, name, address, noise_level, floor)
+        VALUES (?, ?, ?, ?, ?)
+    ''' + UPSERT_APARTMENT, (id, name, address, noise_level, floor))
 
-    conn.close()
 
-    
-def add_booking_to_db(id, apartment_id, start_date, end_date):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT OR REPLACE INTO bookings (id, apartment_id, start_date, end_date)
-        VALUES (?, ?, ?, ?)
-    ''', (id, apartment_id, start_date, end_date))
+def add_apartments_to_db(conn, apartments):
+    conn.executemany('''
+        INSERT INTO apartments (id, name, address, noise_level, floor)
+        VALUES (:id, :name, :address, :noise_level, :floor)
+    ''' + UPSERT_APARTMENT, apartments)
 
-    conn.commit()
-    conn.close()
 
+def remove_apartment_from_db(conn, id):
+    conn.execute('DELETE FROM apartments WHERE id = ?', (id,))
 
-def change_booking_in_db(id, new_start_date, new_end_date):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
 
-    cursor.execute('SELECT COUNT(*) FROM bookings WHERE id = ?', (id,))
-    count = cursor.fetchone()[0]
+def add_booking_to_db(conn, id, apartment_id, start_day, end_day):
+    conn.execute('''
+        INSERT OR REPLACE INTO bookings (id, apartment_id, start_date, end_date)
+        VALUES (?, ?, ?, ?)
+    ''', (id, apartment_id, start_day, end_day))
 
-    if count > 0:
-        cursor.execute('''
-            UPDATE bookings
-            SET start_date = ?, end_date = ?
-            WHERE id = ?
-        ''', (new_start_date, new_end_date, id))
-        conn.commit()
-        
-    conn.close()
+
+def add_bookings_to_db(conn, bookings):
+    conn.executemany('''
+        INSERT OR REPLACE INTO bookings (id, apartment_id, start_date, end_date)
+        VALUES (?, ?, ?, ?)
+    ''', bookings)
 
 
-def remove_booking_from_db(id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+def change_booking_in_db(conn, id, new_start_day, new_end_day):
+    """Move the booking to new dates. Returns its apartment id if it was brought back from the archive."""
+    cursor = conn.execute('''
+        UPDATE bookings
+        SET start_date = ?, end_date = ?
+        WHERE id = ?
+    ''', (new_start_day, new_end_day, id))
 
-    cursor.execute('SELECT COUNT(*) FROM bookings WHERE id = ?', (id,))
-    count = cursor.fetchone()[0]
+    if cursor.rowcount:
+        conn.execute('DELETE FROM bookings_archive WHERE id = ?', (id,))
+        return None
 
-    if count > 0:
-        cursor.execute('''
-            DELETE FROM bookings WHERE id = ?
-        ''', (id,))
-        conn.commit()
-    
-    conn.close()
+    # Archived here, but still hot at the source, which has now moved it.
+    row = conn.execute('SELECT apartment_id FROM bookings_archive WHERE id = ?', (id,)).fetchone()
+    if row is None:
+        return None
 
+    conn.execute('''
+        INSERT INTO bookings (id, apartment_id, start_date, end_date)
+        VALUES (?, ?, ?, ?)
+    ''', (id, row[0], new_start_day, new_end_day))
+    conn.execute('DELETE FROM bookings_archive WHERE id = ?', (id,))
+    return row[0]
+
+
+def remove_booking_from_db(conn, id):
+    conn.execute('''
+        DELETE FROM bookings WHERE id = ?
+    ''', (id,))
+    conn.execute('''
+        DELETE FROM bookings_archive WHERE id = ?
+    ''', (id,))
+
+
+def load_booking_spans(apartment_ids, day_from, day_to):
+    """{apartment id: [(start, end), ...] by start day} of the hot and archived bookings that reach into the window."""
+    ids = json.dumps(apartment_ids)
+    spans = {}
+
+    with read_transaction(DATABASE) as conn:
+        rows = conn.execute('''
+            SELECT apartment_id, start_date, end_date FROM bookings
+            WHERE apartment_id IN (SELECT value FROM json_each(?))
+                AND start_date <= ?
+                AND end_date >= ?
+            UNION ALL
+            SELECT apartment_id, start_date, end_date FROM bookings_archive
+            WHERE apartment_id IN (SELECT value FROM json_each(?))
+                AND end_date >= ?
+                AND start_date <= ?
+            ORDER BY 1, 2
+        ''', (ids, day_to, day_from, ids, day_from, day_to))
+
+        for apartment_id, start, end in rows:
+            spans.setdefault(apartment_id, []).append((start, end))
+
+    return spans
+
+
+def load_archived_before():
+    with connection(DATABASE) as conn:
+        return conn.execute("SELECT value FROM archive_state WHERE name = 'archived_before'").fetchone()[0]
+
+
+def archive_bookings_chunk(conn, before_day, limit):
+    """Move up to limit bookings that ended before before_day into bookings_archive; returns their ids."""
+    conn.execute("UPDATE archive_state SET value = MAX(value, ?) WHERE name = 'archived_before'", (before_day,))
+
+    booking_ids = [row[0] for row in conn.execute('SELECT id FROM bookings WHERE end_date < ? LIMIT ?', (before_day, limit))]
+    if booking_ids:
+        params = (json.dumps(booking_ids),)
+        conn.execute('''
+            INSERT OR REPLACE INTO bookings_archive (id, apartment_id, start_date, end_date)
+            SELECT id, apartment_id, start_date, end_date FROM bookings
+            WHERE id IN (SELECT value FROM json_each(?))
+        ''', params)
+        conn.execute('DELETE FROM bookings WHERE id IN (SELECT value FROM json_each(?))', params)
+
+    return booking_ids
+
+
+def count_bookings():
+    """(hot, archived) booking counts."""
+    with read_transaction(DATABASE) as conn:
+        hot = conn.execute('SELECT COUNT(*) FROM bookings').fetchone()[0]
+        archived = conn.execute('SELECT COUNT(*) FROM bookings_archive').fetchone()[0]
+
+    return hot, archived
@@ -0,0 +1,22 @@
+from datetime import date
+
+
+# Dates are stored as proleptic Gregorian day numbers (date.toordinal), so
+# range comparisons are plain integer comparisons that an index can serve.
+# The HTTP API and the events keep using ISO 'YYYY-MM-DD' strings.
+
+def to_day(value):
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid date: {value!r}")
+    return date.fromisoformat(value).toordinal()
+
+
+def to_day_or_none(value):
+    try:
+        return to_day(value)
+    except ValueError:
+        return None
+
+
+def from_day(day):
+    return date.fromordinal(day).isoformat()
@@ -0,0 +1,133 @@
+import os
+from utils.dates import to_day
+from utils.text import parse_text
+
+
+# Search parameters shared by the in-memory index and the SQL query:
+# from/to, q for prefix full-text search over name and address, inclusive
+# attribute ranges, sort=<field> or sort=-<field> for descending, and limit
+# for the top k. Text matches come best BM25 match first unless sorted.
+# nights=<n> turns from/to into a flexible window: an apartment matches if a
+# stay of n nights fits anywhere in it, and gaps=earliest|all picks whether
+# it comes with its earliest stay or with every free gap long enough.
+# Sorted results break ties by apartment id, so both paths return the same
+# apartments in the same order. Without sort or q the order is unspecified:
+# each path returns matches in whatever order it finds them (bitmap column,
+# index or table order), and with limit, whichever `limit` matches it finds
+# first, so the search can stop there.
+
+SEARCH_MAX_LIMIT = int(os.getenv('SEARCH_MAX_LIMIT', '1000'))
+SORT_FIELDS = ('noise_level', 'floor', 'name')
+GAP_MODES = ('earliest', 'all')
+# Attribute -> (lower bound parameter, upper bound parameter).
+RANGE_FILTERS = {
+    'noise_level': ('noise_min', 'noise_max'),
+    'floor': ('floor_min', 'floor_max'),
+}
+
+
+def _number(name, value):
+    if isinstance(value, bool):
+        raise ValueError(f"{name} must be a number")
+    if isinstance(value, (int, float)):
+        return value
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number")
+
+
+def parse_search(args):
+    """Return the search parameters in args (a query string or JSON object).
+
+    Raises ValueError with a message for the client on invalid input.
+    """
+    date_from = args.get('from')
+    date_to = args.get('to')
+
+    try:
+        day_from = to_day(date_from) if date_from else None
+        day_to = to_day(date_to) if date_to else None
+    except ValueError:
+        raise ValueError('Dates must be valid YYYY-MM-DD values')
+
+    stay = None
+    nights = args.get('nights')
+    if nights not in (None, ''):
+        try:
+            nights = int(nights)
+        except (TypeError, ValueError):
+            nights = 0
+        if isinstance(args.get('nights'), bool) or nights < 1:
+            raise ValueError('nights must be a positive integer')
+        if day_from is None or day_to is None:
+            raise ValueError('nights needs a window: from and to')
+        if day_to - day_from < nights:
+            raise ValueError('The window is shorter than the stay')
+
+        gaps = args.get('gaps') or 'earliest'
+        if gaps not in GAP_MODES:
+            raise ValueError(f"gaps must be one of {', '.join(GAP_MODES)}")
+        stay = (nights, gaps == 'all')
+
+    text = args.get('q') or None
+    if text is not None:
+        text = parse_text(text) if isinstance(text, str) else None
+        if text is None:
+            raise ValueError('q must contain at least one letter or digit')
+
+    ranges = {}
+    for field, (low_name, high_name) in RANGE_FILTERS.items():
+        low = args.get(low_name)
+        high = args.get(high_name)
+        low = _number(low_name, low) if low not in (None, '') else None
+        high = _number(high_name, high) if high not in (None, '') else None
+
+        if low is not None and high is not None and low > high:
+            raise ValueError(f"{low_name} must not be greater than {high_name}")
+        if low is not None or high is not None:
+            ranges[field] = (low, high)
+
+    sort = args.get('sort') or None
+    if sort is not None:
+        descending = sort.startswith('-') if isinstance(sort, str) else False
+        field = sort[1:] if descending else sort
+        if field not in SORT_FIELDS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}, optionally prefixed with -")
+        sort = (field, descending)
+
+    limit = args.get('limit')
+    if limit not in (None, ''):
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            limit = 0
+        if isinstance(args.get('limit'), bool) or not 0 < limit <= SEARCH_MAX_LIMIT:
+            raise ValueError(f"limit must be an integer between 1 and {SEARCH_MAX_LIMIT}")
+    else:
+        limit = None
+
+    return {
+        'day_from': day_from,
+        'day_to': day_to,
+        'stay': stay,
+        'text': text,
+        'ranges': ranges,
+        'sort': sort,
+        'limit': limit,
+    }
+
+
+def matches_ranges(apartment, ranges):
+    for field, (low, high) in ranges.items():
+        value = apartment[field]
+        if low is not None and value < low:
+            return False
+        if high is not None and value > high:
+            return False
+    return True
@@ -0,0 +1,533 @@
+import bisect
+import heapq
+import itertools
+import operator
+import threading
+from utils.dates import from_day
+from utils.filters import RANGE_FILTERS, matches_ranges
+from utils.version import bump_version
+from utils.occupancy import (
+    load_occupancy, reset_occupancy, checkpoint_occupancy, occupancy_add_apartment, occupancy_remove_apartment,
+    occupancy_mark, occupancy_set, occupancy_roll, occupancy_covers, occupancy_free, occupancy_column, occupancy_ids,
+    get_occupancy_stats,
+)
+
+
+# In-memory availability index. For every apartment the bookings are kept
+# sorted by start day, together with a running maximum of their end days,
+# so "is anything booked between from and to" is a single bisect:
+# the bookings starting on or before `to` are a prefix of the list, and one
+# of them overlaps the window iff the largest end day in that prefix is on
+# or after `from`.
+#
+# Apartments are also kept in one sorted (value, id) list per filterable
+# attribute. A filtered search bisects every bounded attribute and scans
+# only the narrowest range; a search sorted by one of them walks its list in
+# order and stops after `limit` matches.
+#
+# Windows inside the occupancy horizon are checked against the day bitmaps
+# of utils.occupancy instead, for all apartments at once; the intervals
+# answer the rest and compute the free gaps of stay searches.
+#
+# Every change reaches the index once committed, so it is also where the
+# data version behind the /search ETags is bumped.
+
+_lock = threading.RLock()
+# Bookings that ended before this day are in the archive, not here (see utils/archive.py).
+_archived_before = 0
+_apartments = {}
+_bookings = {}
+_intervals = {}
+_orders = {field: {'values': [], 'entries': []} for field in RANGE_FILTERS}
+_stats = {
+    'searches': 0,
+    'batch_searches': 0,
+    'bitmap_searches': 0,
+    'built_apartments': 0,
+    'built_bookings': 0,
+}
+
+
+def _new_intervals():
+    return {'starts': [], 'entries': [], 'max_ends': []}
+
+
+def _refresh_max_ends(intervals, position):
+    entries = intervals['entries']
+    max_ends = intervals['max_ends']
+    del max_ends[position:]
+
+    current = max_ends[-1] if max_ends else None
+    for _, end, _ in entries[position:]:
+        current = end if current is None or end > current else current
+        max_ends.append(current)
+
+
+def _insert_interval(apartment_id, booking_id, start_day, end_day):
+    intervals = _intervals.setdefault(apartment_id, _new_intervals())
+    entry = (start_day, end_day, booking_id)
+    position = bisect.bisect_right(intervals['entries'], entry)
+    intervals['entries'].insert(position, entry)
+    intervals['starts'].insert(position, start_day)
+    _refresh_max_ends(intervals, position)
+    occupancy_mark(apartment_id, start_day, end_day)
+
+
+def _remove_interval(apartment_id, booking_id, start_day, end_day):
+    intervals = _intervals.get(apartment_id)
+    if intervals is None:
+        return
+
+    entry = (start_day, end_day, booking_id)
+    position = bisect.bisect_left(intervals['entries'], entry)
+    if position < len(intervals['entries']) and intervals['entries'][position] == entry:
+        del intervals['entries'][position]
+        del intervals['starts'][position]
+        _refresh_max_ends(intervals, position)
+        occupancy_set(apartment_id, _spans(intervals))
+
+    if not intervals['entries']:
+        del _intervals[apartment_id]
+
+
+def _spans(intervals, day_from=None, day_to=None):
+    """(start, end) of the bookings in intervals that reach into the days from day_from to day_to."""
+    # max_ends never decreases, so the first booking that can reach the window is a bisect away.
+    position = bisect.bisect_left(intervals['max_ends'], day_from) if day_from is not None else 0
+    for start, end, _ in itertools.islice(intervals['entries'], position, None):
+        if day_to is not None and start > day_to:
+            return
+        yield start, end
+
+
+def _bookings_between(day_from, day_to):
+    for apartment_id, intervals in _intervals.items():
+        for start, end in _spans(intervals, day_from, day_to):
+            yield apartment_id, start, end
+
+
+def _order_insert(apartment):
+    for field, order in _orders.items():
+        entry = (apartment[field], apartment['id'])
+        position = bisect.bisect_right(order['entries'], entry)
+        order['entries'].insert(position, entry)
+        order['values'].insert(position, entry[0])
+
+
+def _order_remove(apartment):
+    for field, order in _orders.items():
+        entry = (apartment[field], apartment['id'])
+        position = bisect.bisect_left(order['entries'], entry)
+        if position < len(order['entries']) and order['entries'][position] == entry:
+            del order['entries'][position]
+            del order['values'][position]
+
+
+def _put_apartment(apartment):
+    previous = _apartments.get(apartment['id'])
+    if previous is not None:
+        _order_remove(previous)
+
+    _apartments[apartment['id']] = apartment
+    _order_insert(apartment)
+
+    # Bookings may have arrived before the apartment.
+    if occupancy_add_apartment(apartment) and apartment['id'] in _intervals:
+        occupancy_set(apartment['id'], _spans(_intervals[apartment['id']]))
+
+
+def build_index(apartments, bookings, seqs=None, archived_before=0):
+    """Rebuild the index from apartments and (id, apartment_id, start_day, end_day) bookings.
+
+    With seqs, the replica positions the rows were read at, the occupancy
+    bitmaps are mapped from their files, and only rebuilt if the files were
+    not checkpointed at seqs. Without, they are kept in memory.
+    """
+    global _archived_before
+
+    with _lock:
+        _archived_before = archived_before
+        _apartments.clear()
+        _bookings.clear()
+        _intervals.clear()
+
+        for apartment in apartments:
+            _apartments[apartment['id']] = apartment
+
+        for field in _orders:
+            entries = sorted((apartment[field], apartment_id) for apartment_id, apartment in _apartments.items())
+            _orders[field] = {'values': [entry[0] for entry in entries], 'entries': entries}
+
+        for booking_id, apartment_id, start_day, end_day in sorted(bookings, key=lambda row: (row[1], row[2], row[3], row[0])):
+            _bookings[booking_id] = (apartment_id, start_day, end_day)
+            intervals = _intervals.setdefault(apartment_id, _new_intervals())
+            intervals['entries'].append((start_day, end_day, booking_id))
+            intervals['starts'].append(start_day)
+
+        for intervals in _intervals.values():
+            _refresh_max_ends(intervals, 0)
+
+        if seqs is None or not load_occupancy(_apartments.values(), RANGE_FILTERS, seqs):
+            reset_occupancy(list(_apartments.values()), RANGE_FILTERS, seqs is not None)
+            for apartment_id, start_day, end_day in _bookings.values():
+                occupancy_mark(apartment_id, start_day, end_day)
+        occupancy_roll(_bookings_between)
+        if seqs is not None:
+            checkpoint_occupancy(seqs)
+
+        _stats['built_apartments'] = len(_apartments)
+        _stats['built_bookings'] = len(_bookings)
+        bump_version()
+
+
+def index_add_apartment(apartment):
+    with _lock:
+        _put_apartment(apartment)
+        bump_version()
+
+
+def index_add_apartments(apartments):
+    with _lock:
+        for apartment in apartments:
+            _put_apartment(apartment)
+        bump_version()
+
+
+def index_remove_apartment(apartment_id):
+    with _lock:
+        apartment = _apartments.pop(apartment_id, None)
+        if apartment is not None:
+            _order_remove(apartment)
+            occupancy_remove_apartment(apartment_id)
+            bump_version()
+
+
+def index_add_booking(booking_id, apartment_id, start_day, end_day):
+    with _lock:
+        index_remove_booking(booking_id)
+        _bookings[booking_id] = (apartment_id, start_day, end_day)
+        _insert_interval(apartment_id, booking_id, start_day, end_day)
+        bump_version()
+
+
+def index_add_bookings(bookings):
+    with _lock:
+        for booking_id, apartment_id, start_day, end_day in bookings:
+            index_add_booking(booking_id, apartment_id, start_day, end_day)
+
+
+def index_change_booking(booking_id, new_start_day, new_end_day):
+    with _lock:
+        booking = _bookings.get(booking_id)
+        if booking is None:
+            return
+        index_add_booking(booking_id, booking[0], new_start_day, new_end_day)
+
+
+def index_remove_booking(booking_id):
+    with _lock:
+        booking = _bookings.pop(booking_id, None)
+        if booking is not None:
+            _remove_interval(booking[0], booking_id, booking[1], booking[2])
+            bump_version()
+
+
+def index_archive_bookings(booking_ids, archived_before):
+    """Drop bookings moved to the archive, which holds everything that ended before archived_before."""
+    global _archived_before
+
+    with _lock:
+        _archived_before = max(_archived_before, archived_before)
+        bump_version()
+        # Once the horizon starts today, bookings that ended before it have no bits to clear.
+        occupancy_roll(_bookings_between)
+
+        apartment_ids = set()
+        for booking_id in booking_ids:
+            booking = _bookings.get(booking_id)
+            # An event may have brought it back with new dates since its chunk committed.
+            if booking is not None and booking[2] < archived_before:
+                del _bookings[booking_id]
+                apartment_ids.add(booking[0])
+
+        # One rebuild per apartment rather than one list deletion per booking.
+        for apartment_id in apartment_ids:
+            intervals = _intervals[apartment_id]
+            intervals['entries'] = [entry for entry in intervals['entries'] if entry[2] in _bookings]
+            intervals['starts'] = [entry[0] for entry in intervals['entries']]
+            _refresh_max_ends(intervals, 0)
+
+            if not intervals['entries']:
+                del _intervals[apartment_id]
+
+
+def get_archived_before():
+    return _archived_before
+
+
+def is_available(apartment_id, day_from, day_to):
+    intervals = _intervals.get(apartment_id)
+    if intervals is None:
+        return True
+
+    position = bisect.bisect_right(intervals['starts'], day_to)
+    return position == 0 or intervals['max_ends'][position - 1] < day_from
+
+
+def gaps_between(spans, day_from, day_to, nights, first_only=False):
+    """Maximal free runs of days [start, end] within the window that fit a stay of `nights`.
+
+    spans are the (start, end) of the bookings that reach into the window,
+    by start day. A stay is booked as [start, start + nights], so it needs
+    nights + 1 free days. One pass over the spans, whatever the window's
+    length.
+    """
+    gaps = []
+    cursor = day_from
+
+    for start, end in spans:
+        if end < cursor:
+            continue
+        if start - 1 - cursor >= nights:
+            gaps.append((cursor, start - 1))
+            if first_only:
+                return gaps
+        cursor = end + 1
+
+    if day_to - cursor >= nights:
+        gaps.append((cursor, day_to))
+    return gaps
+
+
+def free_gaps(apartment_id, day_from, day_to, nights, first_only=False):
+    """gaps_between for the apartment's bookings in the index."""
+    intervals = _intervals.get(apartment_id)
+    spans = _spans(intervals, day_from, day_to) if intervals is not None else ()
+    return gaps_between(spans, day_from, day_to, nights, first_only)
+
+
+def _span(field, low, high):
+    values = _orders[field]['values']
+    start = bisect.bisect_left(values, low) if low is not None else 0
+    stop = bisect.bisect_right(values, high) if high is not None else len(values)
+    return start, max(start, stop)
+
+
+def _walk(field, ranges, descending=False):
+    """Apartments in (field, id) order, limited to the range filter on field."""
+    low, high = ranges.get(field, (None, None))
+    start, stop = _span(field, low, high)
+    entries = _orders[field]['entries']
+    positions = range(stop - 1, start - 1, -1) if descending else range(start, stop)
+    return (_apartments[entries[position][1]] for position in positions)
+
+
+def _narrowest(ranges):
+    # Like the SQL planner picking one of the composite indexes: the attribute whose range holds the fewest apartments.
+    spans = {field: _span(field, *bounds) for field, bounds in ranges.items()}
+    return min(spans, key=lambda name: spans[name][1] - spans[name][0])
+
+
+def _candidates(ranges):
+    if not ranges:
+        return iter(_apartments.values())
+    return _walk(_narrowest(ranges), ranges)
+
+
+def with_gaps(apartments, day_from, day_to, nights, all_gaps, spans=None):
+    """The apartments that fit the stay, with their earliest stay or all their gaps.
+
+    spans, {apartment id: (start, end) by start day}, has the bookings to
+    check when they do not come from the index.
+    """
+    for apartment in apartments:
+        if spans is None:
+            gaps = free_gaps(apartment['id'], day_from, day_to, nights, not all_gaps)
+        else:
+            gaps = gaps_between(spans.get(apartment['id'], ()), day_from, day_to, nights, not all_gaps)
+        if not gaps:
+            continue
+
+        if all_gaps:
+            yield dict(apartment, gaps=[{'from': from_day(start), 'to': from_day(end)} for start, end in gaps])
+        else:
+            start = gaps[0][0]
+            yield dict(apartment, earliest={'from': from_day(start), 'to': from_day(start + nights)})
+
+
+def search_index(day_from, day_to, ranges=None, sort=None, limit=None, text_ids=None, stay=None):
+    """Free apartments matching the range filters, optionally sorted and cut to the top `limit`.
+
+    text_ids, the ids matching a full-text query in rank order, restricts
+    the search to those apartments and is the order when sort is not given.
+    With neither, the order is unspecified (see utils/filters.py).
+    With stay=(nights, all_gaps) an apartment only has to fit a stay of that
+    many nights somewhere in the window; it comes with its earliest stay, or
+    with all free gaps that fit one.
+    """
+    ranges = ranges or {}
+    walked = text_ids is None and sort is not None and sort[0] in _orders
+
+    with _lock:
+        _stats['searches'] += 1
+        occupancy_roll(_bookings_between)
+
+        # Whether each apartment is free and within ranges, when the window is inside the horizon.
+        free = occupancy_free(day_from, day_to, ranges) if stay is None else None
+        if free is not None:
+            _stats['bitmap_searches'] += 1
+
+        if text_ids is not None:
+            # The store may be a batch ahead of the index; ids it does not know yet are skipped.
+            candidates = (_apartments[apartment_id] for apartment_id in text_ids if apartment_id in _apartments)
+        elif walked:
+            candidates = _walk(sort[0], ranges, sort[1])
+        elif free is None:
+            candidates = _candidates(ranges)
+
+        if free is not None and text_ids is None and not walked:
+            # In column order, cut to the limit unless they are sorted below.
+            matches = [_apartments[apartment_id] for apartment_id in occupancy_ids(free, limit if sort is None else None)]
+        elif free is not None:
+            matches = (apartment for apartment in candidates if free[occupancy_column(apartment['id'])])
+        elif stay is not None:
+            matches = with_gaps((apartment for apartment in candidates if matches_ranges(apartment, ranges)), day_from, day_to, *stay)
+        else:
+            matches = (
+                apartment
+                for apartment in candidates
+                if matches_ranges(apartment, ranges)
+                # Without both bounds there is no window to check.
+                and (day_from is None or day_to is None or is_available(apartment['id'], day_from, day_to))
+            )
+
+        if sort is None or walked:
+            return list(itertools.islice(matches, limit))
+
+        field, descending = sort
+        key = operator.itemgetter(field, 'id')
+        if limit is None:
+            return sorted(matches, key=key, reverse=descending)
+        return (heapq.nlargest if descending else heapq.nsmallest)(limit, matches, key=key)
+
+
+def _is_complete(query):
+    # An unsorted query has its result once it has `limit` matches.
+    params = query['params']
+    return params['sort'] is None and len(query['matches']) == params['limit']
+
+
+def search_index_batch(queries):
+    """search_index for each of queries (parse_search results), in one pass over the apartments.
+
+    Queries with the same attribute filters are checked together: the
+    filters once per apartment, then every window of the group against the
+    apartment's bookings, or none at all when the apartment is free over the
+    whole span of the group's windows. Results, their order and limits are
+    those of separate search_index calls. Text queries, which start from
+    their own ranked ids, and windows the occupancy bitmaps answer for all
+    apartments at once are run one by one.
+    """
+    results = [None] * len(queries)
+    groups = {}
+
+    with _lock:
+        _stats['batch_searches'] += 1
+        occupancy_roll(_bookings_between)
+
+        for position, params in enumerate(queries):
+            if params.get('text_ids') is not None or (params['stay'] is None and occupancy_covers(params['day_from'], params['day_to'])):
+                results[position] = search_index(
+                    params['day_from'], params['day_to'], params['ranges'], params['sort'], params['limit'], params.get('text_ids'), params['stay']
+                )
+                continue
+
+            _stats['searches'] += 1
+
+            # Without both bounds there is no window to check.
+            window = (params['day_from'], params['day_to']) if params['day_from'] is not None and params['day_to'] is not None else None
+            key = tuple(sorted(params['ranges'].items()))
+            groups.setdefault(key, []).append({'position': position, 'params': params, 'window': window, 'stay': params['stay'], 'matches': []})
+
+        for group in groups.values():
+            ranges = group[0]['params']['ranges']
+            windows = [query['window'] for query in group if query['window'] is not None]
+            span_from = min((window[0] for window in windows), default=None)
+            span_to = max((window[1] for window in windows), default=None)
+            pending = [query for query in group if query['stay'] is None]
+            stays = [query for query in group if query['stay'] is not None]
+            limited = any(query['params']['sort'] is None and query['params']['limit'] is not None for query in group)
+
+            # The group shares the ranges, so the apartments come in the order a single search would scan them.
+            for apartment in _candidates(ranges):
+                if not matches_ranges(apartment, ranges):
+                    continue
+
+                intervals = _intervals.get(apartment['id'])
+                if intervals is None or span_from is None or is_available(apartment['id'], span_from, span_to):
+                    for query in pending:
+                        query['matches'].append(apartment)
+                else:
+                    starts = intervals['starts']
+                    max_ends = intervals['max_ends']
+                    for query in pending:
+                        window = query['window']
+                        if window is not None:
+                            position = bisect.bisect_right(starts, window[1])
+                            if position and max_ends[position - 1] >= window[0]:
+                                continue
+                        query['matches'].append(apartment)
+
+                for query in stays:
+                    query['matches'].extend(with_gaps((apartment,), query['params']['day_from'], query['params']['day_to'], *query['stay']))
+
+                if limited and any(_is_complete(query) for query in itertools.chain(pending, stays)):
+                    pending = [query for query in pending if not _is_complete(query)]
+                    stays = [query for query in stays if not _is_complete(query)]
+                    if not pending and not stays:
+                        break
+
+            for query in group:
+                sort = query['params']['sort']
+                limit = query['params']['limit']
+                matches = query['matches']
+                if sort is not None:
+                    field, descending = sort
+                    key = operator.itemgetter(field, 'id')
+                    if limit is None:
+                        matches = sorted(matches, key=key, reverse=descending)
+                    else:
+                        matches = (heapq.nlargest if descending else heapq.nsmallest)(limit, matches, key=key)
+                results[query['position']] = matches
+
+    return results
+
+
+def checkpoint_index(seqs):
+    """Record that the occupancy files reflect the replica positions seqs."""
+    with _lock:
+        checkpoint_occupancy(seqs)
+
+
+def compare_with_sql(sql_apartments, day_from, day_to, ranges=None, text_ids=None):
+    index_ids = set(apartment['id'] for apartment in search_index(day_from, day_to, ranges, text_ids=text_ids))
+    sql_ids = set(apartment['id'] for apartment in sql_apartments)
+
+    return {
+        'consistent': index_ids == sql_ids,
+        'index_count': len(index_ids),
+        'sql_count': len(sql_ids),
+        'missing_from_index': sorted(sql_ids - index_ids),
+        'unexpected_in_index': sorted(index_ids - sql_ids),
+    }
+
+
+def get_index_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['apartments'] = len(_apartments)
+        stats['bookings'] = len(_bookings)
+        stats['apartments_with_bookings'] = len(_intervals)
+        stats['archived_before'] = from_day(_archived_before) if _archived_before else None
+        stats['occupancy'] = get_occupancy_stats()
+    return stats
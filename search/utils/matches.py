@@ -0,0 +1,34 @@
+import contextlib
+from utils.archive import search_archived
+from utils.database import TEXT_PAGE_SIZE, get_text_matches, iter_text_matches
+from utils.index import search_index
+
+
+# Text searches (q=). FTS5 gives the matching apartments in BM25 order; the
+# attribute, date and stay filters then run on them in memory, or in SQLite
+# for windows that reach the archive. An unsorted search with a limit takes
+# the matches a page at a time, best first, until the filters have let
+# `limit` through, so a broad query neither ranks rows it will not return
+# nor comes back short because the first matches were booked. A sorted or
+# unlimited search needs every match.
+
+def _search_page(params, text_ids, limit, archived):
+    if archived:
+        return search_archived(dict(params, limit=limit), text_ids)
+    return search_index(params['day_from'], params['day_to'], params['ranges'], params['sort'], limit, text_ids, params['stay'])
+
+
+def search_text(params, archived=False):
+    """The result of a search (parse_search result) with text, in the order of the matches unless sorted."""
+    if params['sort'] is not None or params['limit'] is None:
+        return _search_page(params, get_text_matches(params['text']), params['limit'], archived)
+
+    found = []
+    page_size = max(params['limit'], TEXT_PAGE_SIZE)
+    with contextlib.closing(iter_text_matches(params['text'], page_size)) as pages:
+        for text_ids in pages:
+            found.extend(_search_page(params, text_ids, params['limit'] - len(found), archived))
+            if len(found) >= params['limit']:
+                break
+
+    return found
@@ -0,0 +1,206 @@
+from utils.dates import to_day_or_none
+
+
+# Schema changes are applied in order and recorded in PRAGMA user_version.
+# Each migration runs in its own BEGIN IMMEDIATE transaction against the
+# live database file, so an existing volume is upgraded in place on start-up
+# and a failed step leaves the previous version intact.
+
+def run_migrations(conn, migrations):
+    conn.isolation_level = None
+
+    for version, migration in enumerate(migrations, start=1):
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have applied it while we waited for the lock.
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                conn.execute('ROLLBACK')
+                continue
+
+            print(f"Applying migration {version}: {migration.__name__}", flush=True)
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+
+def create_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bookings (
+            id TEXT PRIMARY KEY,
+            apartment_id TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS apartments (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            address TEXT NOT NULL,
+            noise_level REAL NOT NULL,
+            floor INTEGER NOT NULL
+        )
+    ''')
+
+
+def convert_dates_to_days(conn):
+    conn.create_function('to_day', 1, to_day_or_none, deterministic=True)
+
+    conn.execute('''
+        CREATE TABLE bookings_rejected (
+            id TEXT,
+            apartment_id TEXT,
+            start_date TEXT,
+            end_date TEXT
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO bookings_rejected (id, apartment_id, start_date, end_date)
+        SELECT id, apartment_id, start_date, end_date FROM bookings
+        WHERE to_day(start_date) IS NULL
+            OR to_day(end_date) IS NULL
+            OR to_day(start_date) > to_day(end_date)
+    ''')
+    conn.execute('''
+        CREATE TABLE bookings_new (
+            id TEXT PRIMARY KEY,
+            apartment_id TEXT NOT NULL,
+            start_date INTEGER NOT NULL,
+            end_date INTEGER NOT NULL,
+            CHECK (start_date <= end_date)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO bookings_new (id, apartment_id, start_date, end_date)
+        SELECT id, apartment_id, to_day(start_date), to_day(end_date) FROM bookings
+        WHERE to_day(start_date) IS NOT NULL
+            AND to_day(end_date) IS NOT NULL
+            AND to_day(start_date) <= to_day(end_date)
+    ''')
+    conn.execute('DROP TABLE bookings')
+    conn.execute('ALTER TABLE bookings_new RENAME TO bookings')
+    # Serves the NOT EXISTS probe in search_apartments_in_db as a covering range scan per apartment.
+    conn.execute('CREATE INDEX idx_bookings_apartment_dates ON bookings (apartment_id, start_date, end_date)')
+
+
+def create_replica_state(conn):
+    # The last source event reflected in the local copy, per source service.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS replica_state (
+            source TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )
+    ''')
+
+
+def create_applied_events(conn):
+    # Event ids already applied, so a redelivered message is a no-op. Only the most recent ids are kept.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS applied_events (
+            event_id TEXT PRIMARY KEY,
+            applied_at REAL NOT NULL
+        )
+    ''')
+
+
+def create_apartment_attribute_indexes(conn):
+    # Serve the noise_level/floor range filters of /search, whichever one is the more selective.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_apartments_noise_floor ON apartments (noise_level, floor)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_apartments_floor_noise ON apartments (floor, noise_level)')
+
+
+def create_apartments_fts(conn):
+    # Full-text index over name and address for /search?q=. It is an
+    # external-content table that reads the text from apartments, kept in
+    # sync by triggers, so events, bulk events and snapshots all update it.
+    # Prefix indexes serve prefixes of up to four characters, which expand to
+    # the most words.
+    conn.execute('''
+        CREATE VIRTUAL TABLE apartments_fts USING fts5 (
+            name,
+            address,
+            content = 'apartments',
+            content_rowid = 'rowid',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3 4'
+        )
+    ''')
+    # BM25 with a name match weighing twice an address match.
+    conn.execute("INSERT INTO apartments_fts (apartments_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')")
+    conn.execute('''
+        CREATE TRIGGER apartments_fts_insert AFTER INSERT ON apartments BEGIN
+            INSERT INTO apartments_fts (rowid, name, address) VALUES (new.rowid, new.name, new.address);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER apartments_fts_delete AFTER DELETE ON apartments BEGIN
+            INSERT INTO apartments_fts (apartments_fts, rowid, name, address) VALUES ('delete', old.rowid, old.name, old.address);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER apartments_fts_update AFTER UPDATE OF name, address ON apartments BEGIN
+            INSERT INTO apartments_fts (apartments_fts, rowid, name, address) VALUES ('delete', old.rowid, old.name, old.address);
+            INSERT INTO apartments_fts (rowid, name, address) VALUES (new.rowid, new.name, new.address);
+        END
+    ''')
+    conn.execute("INSERT INTO apartments_fts (apartments_fts) VALUES ('rebuild')")
+
+
+def create_bookings_archive(conn):
+    # Bookings that ended before archive_state.archived_before are moved here
+    # by the archiver (utils/archive.py), so the bookings table only holds the
+    # hot set. Ordered by end day: the probe for a window that starts after
+    # every archived stay ended is a single seek past the apartment's rows.
+    conn.execute('''
+        CREATE TABLE bookings_archive (
+            id TEXT PRIMARY KEY,
+            apartment_id TEXT NOT NULL,
+            start_date INTEGER NOT NULL,
+            end_date INTEGER NOT NULL,
+            CHECK (start_date <= end_date)
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_bookings_archive_apartment_ends ON bookings_archive (apartment_id, end_date, start_date)')
+    # Finds the bookings that have ended without scanning the hot set.
+    conn.execute('CREATE INDEX idx_bookings_end_date ON bookings (end_date)')
+    conn.execute('''
+        CREATE TABLE archive_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("INSERT INTO archive_state (name, value) VALUES ('archived_before', 0)")
+
+def create_dead_events(conn):
+    # Events that failed to apply even on their own. The replica moves its
+    # position past them so later events keep applying; they are kept here to
+    # be looked into and replayed by hand.
+    conn.execute('''
+        CREATE TABLE dead_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT,
+            seq INTEGER,
+            event_id TEXT,
+            message TEXT NOT NULL,
+            error TEXT NOT NULL,
+            failed_at REAL NOT NULL
+        )
+    ''')
+
+
+MIGRATIONS = [
+    create_base_tables,
+    convert_dates_to_days,
+    create_replica_state,
+    create_applied_events,
+    create_apartment_attribute_indexes,
+    create_apartments_fts,
+    create_bookings_archive,
+    create_dead_events,
+]
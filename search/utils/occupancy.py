@@ -0,0 +1,364 @@
+import json
+import os
+from datetime import date
+import numpy as np # type: ignore
+
+
+# Day-occupancy bitmaps over a rolling horizon of days starting today. Row
+# day % OCCUPANCY_HORIZON of the matrix holds one bit per apartment column,
+# set when the apartment is booked that day, so whether each apartment is
+# free over a window is an OR over the window's rows followed by a NOT,
+# for all apartments at once. When today moves on, the rows of the days
+# that fell out are cleared and reused for the days that came in.
+#
+# The matrix and the column ids are .npy files memory-mapped from
+# OCCUPANCY_DIR. state.json records the replica positions they reflect and
+# is removed on the first change after a checkpoint, so on start-up the
+# files are used as they are only if they match the database.
+#
+# Everything here is called with the index lock held (see utils.index).
+
+OCCUPANCY_DIR = os.getenv('SEARCH_OCCUPANCY_DIR', './data/occupancy')
+OCCUPANCY_HORIZON = int(os.getenv('SEARCH_OCCUPANCY_HORIZON', '730'))
+OCCUPANCY_MIN_COLUMNS = 1024
+# Longer ids are still served, but do not survive a restart: the files no longer match and are rebuilt.
+OCCUPANCY_ID_SIZE = 64
+DAYS_FILE = 'days.npy'
+IDS_FILE = 'ids.npy'
+STATE_FILE = 'state.json'
+
+_persistent = False
+_days = None
+_ids = None
+_first_day = None
+_column_ids = []
+_columns = {}
+_spare = []
+_live = np.zeros(0, dtype=bool)
+_values = {}
+_dirty = False
+_stats = {
+    'loaded_from_files': False,
+    'rebuilds': 0,
+    'rolls': 0,
+}
+
+
+def _path(name):
+    return os.path.join(OCCUPANCY_DIR, name)
+
+
+def _today():
+    return date.today().toordinal()
+
+
+def _allocate(name, dtype, shape):
+    if not _persistent:
+        return np.zeros(shape, dtype=dtype)
+    # A new file rather than one rewritten in place, which an old mapping may still point to.
+    if os.path.exists(_path(name)):
+        os.remove(_path(name))
+    return np.lib.format.open_memmap(_path(name), mode='w+', dtype=dtype, shape=shape)
+
+
+def _touch():
+    global _dirty
+
+    # The files are about to differ from the last checkpoint.
+    if _persistent and not _dirty:
+        _dirty = True
+        if os.path.exists(_path(STATE_FILE)):
+            os.remove(_path(STATE_FILE))
+
+
+def _reset_columns(capacity, fields):
+    global _live, _values
+
+    _column_ids.clear()
+    _columns.clear()
+    _spare.clear()
+    _live = np.zeros(capacity, dtype=bool)
+    _values = {field: np.full(capacity, np.nan) for field in fields}
+
+
+def _set_values(column, apartment):
+    _live[column] = True
+    for field, values in _values.items():
+        values[column] = apartment[field]
+
+
+def _grow():
+    """Double the number of columns, copying the matrix and ids into larger files."""
+    global _days, _ids, _live
+
+    capacity = _ids.shape[0]
+    days = _allocate(DAYS_FILE + '.new', np.uint8, (OCCUPANCY_HORIZON, capacity // 4))
+    ids = _allocate(IDS_FILE + '.new', f'S{OCCUPANCY_ID_SIZE}', (capacity * 2,))
+    days[:, :capacity // 8] = _days
+    ids[:capacity] = _ids
+
+    if _persistent:
+        days.flush()
+        ids.flush()
+        os.replace(_path(DAYS_FILE + '.new'), _path(DAYS_FILE))
+        os.replace(_path(IDS_FILE + '.new'), _path(IDS_FILE))
+
+    _days = days
+    _ids = ids
+    _live = np.concatenate((_live, np.zeros(capacity, dtype=bool)))
+    for field in _values:
+        _values[field] = np.concatenate((_values[field], np.full(capacity, np.nan)))
+    _spare.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+
+def reset_occupancy(apartments, fields, persistent):
+    """Start over with empty bitmaps for apartments; bookings are then added with occupancy_mark."""
+    global _persistent, _days, _ids, _first_day, _dirty
+
+    _persistent = persistent
+    _days = _ids = None
+    _dirty = False
+    if persistent:
+        os.makedirs(OCCUPANCY_DIR, exist_ok=True)
+    _touch()
+
+    capacity = OCCUPANCY_MIN_COLUMNS
+    while capacity < len(apartments):
+        capacity *= 2
+
+    _days = _allocate(DAYS_FILE, np.uint8, (OCCUPANCY_HORIZON, capacity // 8))
+    _ids = _allocate(IDS_FILE, f'S{OCCUPANCY_ID_SIZE}', (capacity,))
+    _first_day = _today()
+    _reset_columns(capacity, fields)
+    _spare.extend(range(capacity - 1, -1, -1))
+    _stats['loaded_from_files'] = False
+    _stats['rebuilds'] += 1
+
+    for apartment in apartments:
+        occupancy_add_apartment(apartment)
+
+
+def load_occupancy(apartments, fields, seqs):
+    """Map the files if they were checkpointed at seqs for exactly these apartments; False if they cannot be used."""
+    global _persistent, _days, _ids, _first_day, _dirty
+
+    try:
+        with open(_path(STATE_FILE)) as f:
+            state = json.load(f)
+        days = np.lib.format.open_memmap(_path(DAYS_FILE), mode='r+')
+        ids = np.lib.format.open_memmap(_path(IDS_FILE), mode='r+')
+    except (OSError, ValueError):
+        return False
+
+    if (
+        state.get('horizon') != OCCUPANCY_HORIZON
+        or state.get('seqs') != seqs
+        or state.get('first_day', _today() + 1) > _today()
+        or ids.dtype != np.dtype(f'S{OCCUPANCY_ID_SIZE}')
+        or days.shape != (OCCUPANCY_HORIZON, ids.shape[0] // 8)
+    ):
+        return False
+
+    by_id = {apartment['id']: apartment for apartment in apartments}
+    # An id longer than OCCUPANCY_ID_SIZE was cut, maybe inside a character; it then fails the match below and the files are rebuilt.
+    column_ids = [value.decode(errors='replace') if value else None for value in ids.tolist()]
+    if sorted(column_id for column_id in column_ids if column_id is not None) != sorted(by_id):
+        return False
+
+    _persistent = True
+    _days = days
+    _ids = ids
+    _first_day = state['first_day']
+    _dirty = False
+    _reset_columns(ids.shape[0], fields)
+
+    for column, column_id in enumerate(column_ids):
+        _column_ids.append(column_id)
+        if column_id is None:
+            _spare.append(column)
+        else:
+            _columns[column_id] = column
+            _set_values(column, by_id[column_id])
+    _spare.reverse()
+
+    _stats['loaded_from_files'] = True
+    return True
+
+
+def checkpoint_occupancy(seqs):
+    """Flush the files and record that they reflect the replica positions seqs."""
+    global _dirty
+
+    if not _persistent or not _dirty:
+        return
+
+    _days.flush()
+    _ids.flush()
+    state = {'horizon': OCCUPANCY_HORIZON, 'first_day': _first_day, 'seqs': seqs}
+    with open(_path(STATE_FILE + '.new'), 'w') as f:
+        json.dump(state, f)
+    os.replace(_path(STATE_FILE + '.new'), _path(STATE_FILE))
+    _dirty = False
+
+
+def occupancy_horizon():
+    """The first and last day the bitmaps cover."""
+    return _first_day, _first_day + OCCUPANCY_HORIZON - 1
+
+
+def occupancy_add_apartment(apartment):
+    """Give apartment a column, or update the attributes of the one it has. True if the column is new."""
+    if _days is None:
+        return False
+
+    column = _columns.get(apartment['id'])
+    if column is not None:
+        _set_values(column, apartment)
+        return False
+
+    _touch()
+    if not _spare:
+        _grow()
+
+    column = _spare.pop()
+    _columns[apartment['id']] = column
+    if column < len(_column_ids):
+        _column_ids[column] = apartment['id']
+    else:
+        _column_ids.extend([None] * (column - len(_column_ids)) + [apartment['id']])
+    _ids[column] = apartment['id'].encode()[:OCCUPANCY_ID_SIZE]
+    _set_values(column, apartment)
+    return True
+
+
+def occupancy_remove_apartment(apartment_id):
+    column = _columns.pop(apartment_id, None)
+    if column is None:
+        return
+
+    _touch()
+    _clear_column(column)
+    _column_ids[column] = None
+    _ids[column] = b''
+    _live[column] = False
+    for values in _values.values():
+        values[column] = np.nan
+    _spare.append(column)
+
+
+def _rows(start_day, end_day):
+    """Row slices for the days from start_day to end_day, both within the horizon."""
+    first = start_day % OCCUPANCY_HORIZON
+    last = end_day % OCCUPANCY_HORIZON
+    if first <= last:
+        return (slice(first, last + 1),)
+    return (slice(first, OCCUPANCY_HORIZON), slice(0, last + 1))
+
+
+def _clear_column(column):
+    _days[:, column >> 3] &= np.uint8(~(1 << (column & 7)) & 0xFF)
+
+
+def occupancy_mark(apartment_id, start_day, end_day):
+    """Set the bits of a booking of apartment_id, clipped to the horizon."""
+    column = _columns.get(apartment_id)
+    first_day, last_day = occupancy_horizon()
+    start_day = max(start_day, first_day)
+    end_day = min(end_day, last_day)
+    if column is None or start_day > end_day:
+        return
+
+    _touch()
+    bit = np.uint8(1 << (column & 7))
+    for rows in _rows(start_day, end_day):
+        _days[rows, column >> 3] |= bit
+
+
+def occupancy_set(apartment_id, bookings):
+    """Rewrite the column of apartment_id from all its (start_day, end_day) bookings."""
+    column = _columns.get(apartment_id)
+    if column is None:
+        return
+
+    _touch()
+    _clear_column(column)
+    for start_day, end_day in bookings:
+        occupancy_mark(apartment_id, start_day, end_day)
+
+
+def occupancy_roll(bookings_between):
+    """Move the horizon to start today.
+
+    bookings_between(first_day, last_day) yields (apartment_id, start_day,
+    end_day) for the bookings reaching into those days; they are marked on
+    the rows taken over by the days that came in.
+    """
+    global _first_day
+
+    today = _today()
+    if _days is None or today <= _first_day:
+        return
+
+    _touch()
+    previous_last = _first_day + OCCUPANCY_HORIZON - 1
+    _first_day = today
+    first_new = max(previous_last + 1, today)
+    last_new = today + OCCUPANCY_HORIZON - 1
+
+    for rows in _rows(first_new, last_new):
+        _days[rows] = 0
+    for apartment_id, start_day, end_day in bookings_between(first_new, last_new):
+        occupancy_mark(apartment_id, max(start_day, first_new), end_day)
+
+    _stats['rolls'] += 1
+
+
+def occupancy_covers(day_from, day_to):
+    if _days is None or day_from is None or day_to is None:
+        return False
+    first_day, last_day = occupancy_horizon()
+    return first_day <= day_from <= day_to <= last_day
+
+
+def occupancy_free(day_from, day_to, ranges):
+    """Boolean mask over columns of the apartments free from day_from to day_to and within ranges.
+
+    None when the window is not inside the horizon.
+    """
+    if not occupancy_covers(day_from, day_to):
+        return None
+
+    booked = None
+    for rows in _rows(day_from, day_to):
+        part = np.bitwise_or.reduce(_days[rows], axis=0)
+        booked = part if booked is None else booked | part
+
+    mask = np.unpackbits(~booked, bitorder='little').view(bool) & _live
+    for field, (low, high) in ranges.items():
+        if low is not None:
+            mask &= _values[field] >= low
+        if high is not None:
+            mask &= _values[field] <= high
+    return mask
+
+
+def occupancy_column(apartment_id):
+    return _columns.get(apartment_id)
+
+
+def occupancy_ids(mask, limit=None):
+    """Apartment ids of the columns set in mask, in column order."""
+    columns = np.flatnonzero(mask)
+    if limit is not None:
+        columns = columns[:limit]
+    return [_column_ids[column] for column in columns.tolist()]
+
+
+def get_occupancy_stats():
+    stats = dict(_stats)
+    stats['persistent'] = _persistent
+    stats['horizon_days'] = OCCUPANCY_HORIZON
+    stats['columns'] = 0 if _ids is None else _ids.shape[0]
+    stats['apartments'] = len(_columns)
+    stats['first_day'] = None if _first_day is None else date.fromordinal(_first_day).isoformat()
+    return stats
@@ -1,15 +1,47 @@
 import pika # type: ignore
+import functools
 import os
 import json
+import sqlite3
+import threading
 import time
-from utils.database import add_apartment_to_db, remove_apartment_from_db, add_booking_to_db, change_booking_in_db, remove_booking_from_db
+from utils.database import DATABASE, booking_rows, get_applied_seqs, set_applied_seq, mark_event_applied, prune_applied_events, add_dead_event, add_apartment_to_db, add_apartments_to_db, remove_apartment_from_db, add_booking_to_db, add_bookings_to_db, change_booking_in_db, remove_booking_from_db
+from utils.dates import to_day_or_none
+from utils.db import transaction
+from utils.index import checkpoint_index, index_add_apartment, index_add_apartments, index_remove_apartment, index_add_booking, index_add_bookings, index_change_booking, index_remove_booking
+from utils.replication import catch_up, catch_up_all
 
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
 APARTMENT_EXCHANGE = 'apartment_events'
 BOOKING_EXCHANGE = 'booking_events'
+EXCHANGE_SOURCES = {
+    APARTMENT_EXCHANGE: 'apartments',
+    BOOKING_EXCHANGE: 'booking',
+}
 
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', '1000'))
+CONSUMER_BATCH_SIZE = int(os.getenv('CONSUMER_BATCH_SIZE', '500'))
+CONSUMER_BATCH_WAIT = float(os.getenv('CONSUMER_BATCH_WAIT', '0.05'))
+CONSUMER_RETRY_DELAY = float(os.getenv('CONSUMER_RETRY_DELAY', '1.0'))
 
-def handle_apartment_event(event_type, data):
+_stats_lock = threading.Lock()
+_consumer_stats = {
+    'batches': 0,
+    'received': 0,
+    'applied': 0,
+    'duplicates': 0,
+    'gaps': 0,
+    'dead_lettered': 0,
+    'requeued_batches': 0,
+    'last_batch_size': 0,
+    'max_batch_size': 0,
+}
+
+
+# The handlers write through the batch's connection and return the matching
+# index update, which is applied only once the batch has committed.
+
+def handle_apartment_event(conn, event_type, data):
     apartment_id = data.get('apartment_id')
     apartment_name = data.get('name')
     apartment_address = data.get('address')
@@ -17,37 +49,268 @@ def handle_apartment_event(event_type, data):
     apartment_floor = data.get('floor')
 
     if event_type == 'apartment_added':
-        add_apartment_to_db(apartment_id, apartment_name, apartment_address, apartment_noise_level, apartment_floor)
+        add_apartment_to_db(conn, apartment_id, apartment_name, apartment_address, apartment_noise_level, apartment_floor)
         print(f"Apartment {apartment_id} added to local copy.", flush=True)
+        return functools.partial(index_add_apartment, {
+            'id': apartment_id,
+            'name': apartment_name,
+            'address': apartment_address,
+            'noise_level': apartment_noise_level,
+            'floor': apartment_floor
+        })
     elif event_type == 'apartment_removed':
-        remove_apartment_from_db(apartment_id)
+        remove_apartment_from_db(conn, apartment_id)
         print(f"Apartment {apartment_id} removed from local copy.", flush=True)
+        return functools.partial(index_remove_apartment, apartment_id)
+    elif event_type == 'apartments_added':
+        # A bulk import chunk: rows are lists in the order given by "fields".
+        apartments = [
+            {
+                'id': values['apartment_id'],
+                'name': values['name'],
+                'address': values['address'],
+                'noise_level': values['noise_level'],
+                'floor': values['floor']
+            }
+            for values in (dict(zip(data['fields'], row)) for row in data['apartments'])
+        ]
+        add_apartments_to_db(conn, apartments)
+        print(f"{len(apartments)} apartments added to local copy.", flush=True)
+        return functools.partial(index_add_apartments, apartments)
 
 
-def handle_booking_event(event_type, data):
+def handle_booking_event(conn, event_type, data):
     booking_id = data.get('booking_id')
 
     if event_type == 'booking_added':
         booking_apartment_id = data.get('apartment_id')
-        booking_start_date = data.get('start_date')
-        booking_end_date = data.get('end_date')
-        
-        add_booking_to_db(booking_id, booking_apartment_id, booking_start_date, booking_end_date)
-        
+        booking_start_day = to_day_or_none(data.get('start_date'))
+        booking_end_day = to_day_or_none(data.get('end_date'))
+
+        if booking_start_day is None or booking_end_day is None:
+            print(f"Ignoring booking {booking_id} with invalid dates.", flush=True)
+            return None
+
+        add_booking_to_db(conn, booking_id, booking_apartment_id, booking_start_day, booking_end_day)
+
         print(f"Booking added for apartment {booking_apartment_id}.")
+        return functools.partial(index_add_booking, booking_id, booking_apartment_id, booking_start_day, booking_end_day)
+
+    elif event_type == 'bookings_added':
+        # A batch booking: rows are lists in the order given by "fields".
+        bookings = list(booking_rows(
+            {
+                'id': values['booking_id'],
+                'apartment_id': values['apartment_id'],
+                'start_date': values['start_date'],
+                'end_date': values['end_date']
+            }
+            for values in (dict(zip(data['fields'], row)) for row in data['bookings'])
+        ))
+        add_bookings_to_db(conn, bookings)
+
+        print(f"{len(bookings)} bookings added.")
+        return functools.partial(index_add_bookings, bookings)
 
     elif event_type == 'booking_changed':
-        booking_new_start_date = data.get('new_start_date')
-        booking_new_end_date = data.get('new_end_date')
-        
-        change_booking_in_db(booking_id, booking_new_start_date, booking_new_end_date)
-        
+        booking_new_start_day = to_day_or_none(data.get('new_start_date'))
+        booking_new_end_day = to_day_or_none(data.get('new_end_date'))
+
+        if booking_new_start_day is None or booking_new_end_day is None:
+            print(f"Ignoring change of booking {booking_id} with invalid dates.", flush=True)
+            return None
+
+        revived_apartment_id = change_booking_in_db(conn, booking_id, booking_new_start_day, booking_new_end_day)
+
         print(f"Booking {booking_id} updated.")
+        if revived_apartment_id is not None:
+            return functools.partial(index_add_booking, booking_id, revived_apartment_id, booking_new_start_day, booking_new_end_day)
+        return functools.partial(index_change_booking, booking_id, booking_new_start_day, booking_new_end_day)
+
+    elif event_type in ('booking_canceled', 'booking_removed'):
+        remove_booking_from_db(conn, booking_id)
 
-    elif event_type == 'booking_removed':        
-        remove_booking_from_db(booking_id)
-        
         print(f"Booking {booking_id} removed.")
+        return functools.partial(index_remove_booking, booking_id)
+
+
+EVENT_HANDLERS = {
+    'apartments': handle_apartment_event,
+    'booking': handle_booking_event,
+}
+
+
+def apply_events(messages):
+    """Apply messages in one transaction and return the sources that need a catch-up.
+
+    Sequenced events are applied strictly in order: anything at or below the
+    recorded position is a redelivery, anything past the next position means
+    events were missed and is left for the catch-up to fetch.
+    """
+    gaps = set()
+    applied = 0
+    duplicates = 0
+    index_updates = []
+
+    with transaction(DATABASE) as conn:
+        positions = get_applied_seqs(conn)
+        advanced = {}
+
+        for message in messages:
+            source = message.get('source')
+            seq = message.get('seq')
+
+            if source not in EVENT_HANDLERS or source in gaps:
+                continue
+
+            if seq is not None:
+                applied_seq = advanced.get(source, positions.get(source))
+
+                if applied_seq is not None and seq <= applied_seq:
+                    duplicates += 1
+                    continue
+
+                if applied_seq is None or seq > applied_seq + 1:
+                    gaps.add(source)
+                    continue
+
+                advanced[source] = seq
+
+            if not mark_event_applied(conn, message.get('event_id')):
+                duplicates += 1
+                continue
+
+            index_update = EVENT_HANDLERS[source](conn, message['event'], message['data'])
+            if index_update is not None:
+                index_updates.append(index_update)
+            applied += 1
+
+        for source, seq in advanced.items():
+            set_applied_seq(conn, source, seq)
+        prune_applied_events(conn)
+
+    for index_update in index_updates:
+        index_update()
+    checkpoint_index(dict(positions, **advanced))
+
+    with _stats_lock:
+        _consumer_stats['applied'] += applied
+        _consumer_stats['duplicates'] += duplicates
+        _consumer_stats['gaps'] += len(gaps)
+
+    return gaps
+
+
+def dead_letter_event(message, error):
+    """Set aside an event that failed on its own, moving its source's position past it."""
+    source = message.get('source')
+    seq = message.get('seq')
+
+    with transaction(DATABASE) as conn:
+        positions = get_applied_seqs(conn)
+        if seq is not None:
+            # Only the next event in order was actually run; anything else was a duplicate or a gap.
+            if positions.get(source) is None or seq != positions[source] + 1:
+                return
+            set_applied_seq(conn, source, seq)
+            positions[source] = seq
+        mark_event_applied(conn, message.get('event_id'))
+        add_dead_event(conn, message, error)
+
+    checkpoint_index(positions)
+
+    with _stats_lock:
+        _consumer_stats['dead_lettered'] += 1
+
+
+def apply_events_or_dead_letter(messages):
+    """apply_events(), falling back to one event at a time when the batch fails.
+
+    An event that fails on its own is dead-lettered, so the events after it
+    from the same source still apply instead of waiting on it for good. A
+    database error (sqlite3.OperationalError: locked, disk full) is not the
+    event's fault and is raised, for the caller to retry the batch.
+    """
+    try:
+        return apply_events(messages)
+    except sqlite3.OperationalError:
+        raise
+    except Exception as e:
+        print(f"Failed to apply a batch of {len(messages)} events: {e}. Retrying one by one...", flush=True)
+
+    gaps = set()
+    for message in messages:
+        try:
+            gaps |= apply_events([message])
+        except sqlite3.OperationalError:
+            raise
+        except Exception as e:
+            print(f"Dead-lettering event {message.get('event_id')} (seq {message.get('seq')}): {e}", flush=True)
+            dead_letter_event(message, e)
+
+    return gaps
+
+
+def _apply_batch(channel, batch):
+    messages = []
+    for method, body in batch:
+        try:
+            message = json.loads(body)
+        except ValueError:
+            print(f"Dropping malformed message: {body!r}", flush=True)
+            continue
+
+        message.setdefault('source', EXCHANGE_SOURCES.get(method.exchange))
+        messages.append(message)
+
+    try:
+        gaps = apply_events_or_dead_letter(messages)
+    except Exception as e:
+        # Not the events' fault: hand the batch back. What did commit is
+        # skipped as a redelivery when it comes round again.
+        print(f"Failed to apply a batch of {len(messages)} events: {e}. Requeueing it...", flush=True)
+        channel.basic_nack(delivery_tag=batch[-1][0].delivery_tag, multiple=True, requeue=True)
+        with _stats_lock:
+            _consumer_stats['requeued_batches'] += 1
+        time.sleep(CONSUMER_RETRY_DELAY)
+        return
+
+    # The batch is committed: one ack covers every delivery up to the last one.
+    channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+
+    with _stats_lock:
+        _consumer_stats['batches'] += 1
+        _consumer_stats['received'] += len(batch)
+        _consumer_stats['last_batch_size'] = len(batch)
+        _consumer_stats['max_batch_size'] = max(_consumer_stats['max_batch_size'], len(batch))
+
+    for source in gaps:
+        try:
+            catch_up(source, apply_events_or_dead_letter)
+        except Exception as e:
+            print(f"Failed to catch up with the {source} service: {e}", flush=True)
+
+
+def _consume_batches(channel, queue_name):
+    batch = []
+    deadline = None
+
+    # inactivity_timeout makes consume() yield (None, None, None) when the queue goes quiet.
+    for method, _, body in channel.consume(queue_name, inactivity_timeout=CONSUMER_BATCH_WAIT):
+        if method is not None:
+            batch.append((method, body))
+            if deadline is None:
+                deadline = time.monotonic() + CONSUMER_BATCH_WAIT
+
+        if batch and (method is None or len(batch) >= CONSUMER_BATCH_SIZE or time.monotonic() >= deadline):
+            _apply_batch(channel, batch)
+            batch = []
+            deadline = None
+
+
+def get_consumer_stats():
+    with _stats_lock:
+        return dict(_consumer_stats)
 
 
 def listen_for_messages():
@@ -61,33 +324,19 @@ def listen_for_messages():
 
             channel.exchange_declare(exchange=APARTMENT_EXCHANGE, exchange_type='fanout')
             channel.exchange_declare(exchange=BOOKING_EXCHANGE, exchange_type='fanout')
+            channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
 
-            apartment_result = channel.queue_declare('', exclusive=True)
-            apartment_queue_name = apartment_result.method.queue
-            channel.queue_bind(exchange=APARTMENT_EXCHANGE, queue=apartment_queue_name)
-
-            booking_result = channel.queue_declare('', exclusive=True)
-            booking_queue_name = booking_result.method.queue
-            channel.queue_bind(exchange=BOOKING_EXCHANGE, queue=booking_queue_name)
-
-            def callback(ch, method, properties, body):
-                message = json.loads(body)
-                event_type = message['event']
-                data = message['data']
-
-                if method.exchange == APARTMENT_EXCHANGE:
-                    print(f"Apartment event received: {event_type}", flush=True)
-                    handle_apartment_event(event_type, data)
-                elif method.exchange == BOOKING_EXCHANGE:
-                    handle_booking_event(event_type, data)
-                    print(f"Booking event received: {event_type}", flush=True)
-
+            # One queue for both exchanges, so a batch can mix apartment and booking events.
+            result = channel.queue_declare('', exclusive=True)
+            queue_name = result.method.queue
+            channel.queue_bind(exchange=APARTMENT_EXCHANGE, queue=queue_name)
+            channel.queue_bind(exchange=BOOKING_EXCHANGE, queue=queue_name)
 
-            channel.basic_consume(queue=apartment_queue_name, on_message_callback=callback, auto_ack=True)
-            channel.basic_consume(queue=booking_queue_name, on_message_callback=callback, auto_ack=True)
+            # Anything published before the queue was bound is fetched from the sources instead.
+            catch_up_all(apply_events_or_dead_letter)
 
             print("Listening for apartment and booking events...", flush=True)
-            channel.start_consuming()
+            _consume_batches(channel, queue_name)
         except pika.exceptions.AMQPConnectionError:
             print("RabbitMQ not available. Retrying in 3 seconds...", flush=True)
             time.sleep(3)
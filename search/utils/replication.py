@@ -0,0 +1,75 @@
+import os
+import requests # type: ignore
+from utils.database import get_applied_seq, load_applied_seqs, load_archived_before, load_apartments_snapshot, load_bookings_snapshot, load_apartments_from_db, load_bookings_from_db
+from utils.index import build_index
+from utils.streaming import read_ndjson
+
+
+# Replicas start from a snapshot of the source tagged with the source's outbox
+# sequence number and from then on only apply the events after it: on restart
+# from the source's /events, live from RabbitMQ. If the source no longer has
+# the missing range (410), the replica falls back to a fresh snapshot.
+
+SOURCES = {
+    'apartments': os.getenv('APARTMENT_SERVICE_URL', 'http://apartments:5000'),
+    'booking': os.getenv('BOOKING_SERVICE_URL', 'http://booking:5000'),
+}
+SNAPSHOT_LOADERS = {
+    'apartments': load_apartments_snapshot,
+    'booking': load_bookings_snapshot,
+}
+CATCH_UP_BATCH_SIZE = int(os.getenv('CATCH_UP_BATCH_SIZE', '1000'))
+HTTP_TIMEOUT = (5, 60)
+
+
+def load_snapshot(source):
+    print(f"Loading a snapshot from the {source} service...", flush=True)
+
+    with requests.get(f"{SOURCES[source]}/snapshot", stream=True, timeout=HTTP_TIMEOUT) as response:
+        response.raise_for_status()
+
+        lines = read_ndjson(response)
+        header = next(lines)
+        SNAPSHOT_LOADERS[source](lines, header['seq'])
+
+    # The tables were swapped wholesale, so incremental index updates no longer apply.
+    build_index(load_apartments_from_db(), load_bookings_from_db(), load_applied_seqs(), load_archived_before())
+
+    print(f"Snapshot of {source} loaded at sequence number {header['seq']}.", flush=True)
+
+
+def catch_up(source, apply_events):
+    """Bring the local copy of source up to date. apply_events(messages) must record each message's seq."""
+    if get_applied_seq(source) is None:
+        load_snapshot(source)
+
+    while True:
+        after = get_applied_seq(source)
+        params = {'after': after, 'limit': CATCH_UP_BATCH_SIZE}
+
+        with requests.get(f"{SOURCES[source]}/events", params=params, stream=True, timeout=HTTP_TIMEOUT) as response:
+            if response.status_code == 410:
+                print(f"The {source} service no longer has the events after {after}.", flush=True)
+                load_snapshot(source)
+                continue
+
+            response.raise_for_status()
+
+            # One page is applied in one transaction.
+            messages = list(read_ndjson(response))
+            if messages:
+                apply_events(messages)
+            applied = len(messages)
+
+        if applied:
+            print(f"Caught up with {applied} {source} events after {after}.", flush=True)
+        if applied < CATCH_UP_BATCH_SIZE:
+            return
+
+
+def catch_up_all(apply_events):
+    for source in SOURCES:
+        try:
+            catch_up(source, apply_events)
+        except Exception as e:
+            print(f"Failed to catch up with the {source} service: {e}", flush=True)
@@ -0,0 +1,43 @@
+import re
+import unicodedata
+
+
+# Full-text queries over apartment name and address. A query is a list of
+# (word, prefix) pairs that must all match: every word of q is a prefix,
+# except single characters, which as a prefix would expand to a large part
+# of the vocabulary. Words are folded the way the apartments_fts tokenizer
+# (unicode61, remove_diacritics 2) folds the text, so a few common words can
+# be matched in Python on rows FTS5 already found.
+
+_WORD = re.compile(r'[^\W_]+')
+
+
+def fold(text):
+    text = text.lower()
+    if not text.isascii():
+        text = ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    return text
+
+
+def tokens(text):
+    return _WORD.findall(fold(text))
+
+
+def parse_text(text):
+    """The words of a q= parameter, or None if it has none."""
+    return [(word, len(word) > 1) for word in tokens(text)] or None
+
+
+def match_expression(words):
+    # Words are quoted, so FTS5 operators and column filters in user input are taken literally.
+    return ' '.join(f'"{word}"*' if prefix else f'"{word}"' for word, prefix in words)
+
+
+def matches_words(text_tokens, words):
+    for word, prefix in words:
+        if prefix:
+            if not any(token.startswith(word) for token in text_tokens):
+                return False
+        elif word not in text_tokens:
+            return False
+    return True